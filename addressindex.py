@@ -0,0 +1,138 @@
+from unittest import TestCase
+
+from ecc import PrivateKey
+from network import BlockMessage
+from script import Script, address_to_script, p2pkh_script, p2sh_script, p2wpkh_script, p2wsh_script
+from tx import Tx, TxIn, TxOut
+
+
+# Index of watched addresses by the ScriptPubKey they correspond to.
+# Addresses are decoded once when they are added, so matching an output is a single dict lookup on its
+# serialized ScriptPubKey and no address strings are produced while scanning.
+class AddressIndex:
+
+    def __init__(self, addresses=()):
+        # serialized ScriptPubKey (without length) -> address.
+        self.scripts = {}
+        for address in addresses:
+            self.add(address)
+
+    def __len__(self):
+        return len(self.scripts)
+
+    # An address that can't be decoded is not in the index.
+    def __contains__(self, address):
+        try:
+            script_pubkey, _ = address_to_script(address)
+        except ValueError:
+            return False
+        return script_pubkey.raw_serialize() in self.scripts
+
+    # Starts watching an address. Raises ValueError if it can't be decoded, or if a different address with the
+    # same ScriptPubKey, like the same key on the other network, is already watched.
+    def add(self, address):
+        script_pubkey, _ = address_to_script(address)
+        key = script_pubkey.raw_serialize()
+        watched = self.scripts.get(key)
+        if watched is not None and watched != address:
+            raise ValueError('{} has the same ScriptPubKey as {}'.format(address, watched))
+        self.scripts[key] = address
+
+    # Stops watching an address.
+    def remove(self, address):
+        script_pubkey, _ = address_to_script(address)
+        self.scripts.pop(script_pubkey.raw_serialize(), None)
+
+    # Returns the watched address paying to script_pubkey, or None.
+    def match(self, script_pubkey):
+        return self.scripts.get(script_pubkey.raw_serialize())
+
+    # Returns (output index, TxOut, address) for every output of the transaction paying to a watched address.
+    def scan_tx(self, tx):
+        scripts = self.scripts
+        result = []
+        for i, tx_out in enumerate(tx.tx_outputs):
+            address = scripts.get(tx_out.script_pubkey.raw_serialize())
+            if address is not None:
+                result.append((i, tx_out, address))
+        return result
+
+    # Returns (txid, output index, TxOut, address) for every output in the block paying to a watched address.
+    # block_message is a BlockMessage, or anything with the list of transactions in txns.
+    def scan_block(self, block_message):
+        result = []
+        for tx in block_message.txns:
+            matches = self.scan_tx(tx)
+            if matches:
+                tx_hash = tx.hash()
+                for i, tx_out, address in matches:
+                    result.append((tx_hash, i, tx_out, address))
+        return result
+
+
+class AddressIndexTest(TestCase):
+
+    def test_address_to_script(self):
+        point = PrivateKey(8675309).point
+        h160 = point.hash160()
+        h256 = bytes(range(32))
+        scripts = [
+            p2pkh_script(h160),
+            p2sh_script(h160),
+            p2wpkh_script(h160),
+            p2wsh_script(h256),
+        ]
+        for testnet in (False, True):
+            for script_pubkey in scripts:
+                address = script_pubkey.address(testnet)
+                decoded, decoded_testnet = address_to_script(address)
+                self.assertEqual(decoded.raw_serialize(), script_pubkey.raw_serialize())
+                self.assertEqual(decoded_testnet, testnet)
+        # bech32 addresses can be upper case.
+        address = p2wpkh_script(h160).address()
+        self.assertEqual(address_to_script(address.upper())[0].raw_serialize(),
+                         p2wpkh_script(h160).raw_serialize())
+        with self.assertRaises(ValueError):
+            address_to_script('mqdZtV16UixrjvkW5eQfpMiyspZYEoJSxW')
+        with self.assertRaises(ValueError):
+            address_to_script('bc1qqqqqqqqqqqqqqqqqqqqq')
+        # too long to fit in 25 bytes.
+        with self.assertRaises(ValueError):
+            address_to_script('mqdZtV16UixrjvkW5eQfpMiyspZYEoJSxWmqdZtV16UixrjvkW5eQfpMiyspZYEoJSxW')
+
+    def test_scan_block(self):
+        watched = [PrivateKey(secret).point.address(testnet=True) for secret in range(1, 101)]
+        index = AddressIndex(watched)
+        self.assertEqual(len(index), 100)
+        self.assertIn(watched[50], index)
+        self.assertNotIn('not an address', index)
+        self.assertNotIn(watched[50] * 2, index)
+        h160 = PrivateKey(1000).point.hash160()
+        tx_1 = Tx(1, [TxIn(b'\x01' * 32, 0)], [
+            TxOut(1000, p2pkh_script(h160)),
+            TxOut(2000, address_to_script(watched[7])[0]),
+        ], 0, testnet=True)
+        tx_2 = Tx(1, [TxIn(b'\x02' * 32, 0)], [
+            TxOut(3000, p2wpkh_script(h160)),
+            TxOut(0, Script([0x6a, b'data'])),
+        ], 0, testnet=True)
+        tx_3 = Tx(1, [TxIn(b'\x03' * 32, 1)], [
+            TxOut(4000, address_to_script(watched[99])[0]),
+            TxOut(5000, address_to_script(watched[7])[0]),
+        ], 0, testnet=True)
+        block = BlockMessage(1, b'\x00' * 32, b'\x00' * 32, 0, b'\xff\xff\x00\x1d', b'\x00' * 4, 3,
+                             [tx_1, tx_2, tx_3])
+        matches = index.scan_block(block)
+        self.assertEqual([(txid, i, tx_out.amount, address) for txid, i, tx_out, address in matches], [
+            (tx_1.hash(), 1, 2000, watched[7]),
+            (tx_3.hash(), 0, 4000, watched[99]),
+            (tx_3.hash(), 1, 5000, watched[7]),
+        ])
+        self.assertIsNone(index.match(p2pkh_script(h160)))
+        index.remove(watched[7])
+        self.assertEqual(len(index.scan_block(block)), 1)
+        # the mainnet address of a watched testnet one pays to the same ScriptPubKey.
+        index.add(watched[99])
+        with self.assertRaises(ValueError):
+            index.add(PrivateKey(100).point.address())
+        self.assertEqual(index.match(address_to_script(watched[99])[0]), watched[99])
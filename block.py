@@ -1,3 +1,8 @@
+import hashlib
+
+from io import BytesIO
+from unittest import TestCase
+
 from helper import (
     hash256,
     hash160,
@@ -7,14 +12,64 @@ from helper import (
     encode_varint,
     SIGHASH_ALL,
     bits_to_target,
-    merkle_root
+    merkle_root,
 )
+from merkle import txids_merkle_root
 
 GENESIS_BLOCK = bytes.fromhex(
     '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c')
 TESTNET_GENESIS_BLOCK = bytes.fromhex(
     '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae18')
 LOWEST_BITS = bytes.fromhex('ffff001d')
+HEADER_SIZE = 80
+
+# bits -> target. Every header in a difficulty period has the same bits, so there are few of them.
+_TARGETS = {}
+
+
+# returns the target of bits, remembering it.
+def bits_target(bits):
+    target = _TARGETS.get(bits)
+    if target is None:
+        target = _TARGETS[bits] = bits_to_target(bits)
+    return target
+
+
+# Checks the proof of work and the links of serialized headers laid out every stride bytes in buffer, like
+# the 81-byte entries of a headers message payload (after the count) or 80-byte headers one after the other.
+# Each header has to point to the one before it, and the first one to prev_block if given (in the same byte
+# order as Block.prev_block). Headers are hashed straight from the buffer without creating Block objects.
+# Returns the index of the first header that fails or None if all of them are good. With return_hashes it returns
+# that and the hashes (in the byte order of Block.hash()) of the headers before the one that fails, so they don't
+# have to be computed again.
+def check_headers(buffer, stride=HEADER_SIZE, prev_block=None, return_hashes=False):
+    view = memoryview(buffer)
+    if len(view) % stride != 0 or stride < HEADER_SIZE:
+        raise ValueError('buffer is not a list of headers of {} bytes'.format(stride))
+    sha256 = hashlib.sha256
+    from_bytes = int.from_bytes
+    targets = _TARGETS
+    hashes = []
+    # hash of the previous header as serialized in prev_block.
+    previous = None if prev_block is None else prev_block[::-1]
+    bad = None
+    for i, start in enumerate(range(0, len(view), stride)):
+        header = view[start:start + HEADER_SIZE]
+        if previous is not None and header[4:36] != previous:
+            bad = i
+            break
+        previous = sha256(sha256(header).digest()).digest()
+        bits = header[72:76].tobytes()
+        target = targets.get(bits)
+        if target is None:
+            target = bits_target(bits)
+        if from_bytes(previous, 'little') >= target:
+            bad = i
+            break
+        hashes.append(previous[::-1])
+    if return_hashes:
+        return bad, hashes
+    return bad
 
 
 class Block:
@@ -80,7 +135,7 @@ class Block:
         return self.version >> 1 & 1 == 1
 
     def target(self):
-        return bits_to_target(self.bits)
+        return bits_target(self.bits)
 
     # returns the difficulty for this block - page 173.
     def difficulty(self):
@@ -104,10 +159,55 @@ class Block:
     # Returns whether the merkle root is valid for this block comparing the header merkle root
     # with the merkle root calculated using the transaction hashes.
     def validate_merkle_root(self):
-        # We have to reverse each tx hash to be able to validate it first.
-        hashes = [h[::-1] for h in self.tx_hashes]
-        # We calculate the merkle root using the transaction hashes.
-        # We need to reverse the result.
-        calculated_merkle = merkle_root(hashes)[::-1]
-        # Return the result of the comparison.
-        return self.merkle_root == calculated_merkle
+        # The tx hashes are txids, reversed from the order they are hashed in, and so is the result.
+        calculated_merkle, mutated = txids_merkle_root(self.tx_hashes)
+        # A tree with repeated transactions (CVE-2012-2459) is not valid even if the root matches.
+        return not mutated and self.merkle_root == calculated_merkle
+
+
+class BlockTest(TestCase):
+
+    def setUp(self):
+        genesis = Block.parse(BytesIO(GENESIS_BLOCK))
+        # mainnet blocks 1 and 2.
+        self.headers = [genesis] + [Block.parse(BytesIO(bytes.fromhex(h))) for h in (
+            '010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba744bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e36299',
+            '010000004860eb18bf1b1620e37e9490fc8a427514416fd75159ab86688e9a8300000000d5fdcc541e25de1c7a5addedf24858b8bb665c9f36ef744ee42c316022c90f9bb0bc6649ffff001d08d2bd61',
+        )]
+
+    def test_check_headers(self):
+        raw = b''.join(header.serialize() for header in self.headers)
+        self.assertIsNone(check_headers(raw))
+        self.assertIsNone(check_headers(raw[80:], prev_block=self.headers[0].hash()))
+        self.assertEqual(check_headers(raw[80:], prev_block=self.headers[1].hash()), 0)
+        # headers message entries, with the number of transactions after each header.
+        entries = b''.join(header.serialize() + b'\x00' for header in self.headers)
+        self.assertIsNone(check_headers(entries, stride=81))
+        # block 2 no longer links to block 1.
+        self.assertEqual(check_headers(raw[:80] + raw[160:]), 1)
+        # bad nonce.
+        self.assertEqual(check_headers(raw[:-1] + b'\x00'), 2)
+        self.assertEqual(check_headers(raw[:-1] + b'\x00', return_hashes=True),
+                         (2, [header.hash() for header in self.headers[:2]]))
+        self.assertEqual(check_headers(entries, stride=81, return_hashes=True),
+                         (None, [header.hash() for header in self.headers]))
+        with self.assertRaises(ValueError):
+            check_headers(raw[:-1])
+        for header in self.headers:
+            self.assertTrue(header.check_pow())
+            self.assertIsNone(check_headers(header.serialize()))
+
+    def test_validate_merkle_root(self):
+        # txids of a block with 2 transactions.
+        tx_hashes = [hash256(b'a')[::-1], hash256(b'b')[::-1]]
+        block = Block(1, b'\x00' * 32, merkle_root([h[::-1] for h in tx_hashes])[::-1], 0, LOWEST_BITS,
+                      b'\x00' * 4, tx_hashes)
+        self.assertTrue(block.validate_merkle_root())
+        block.tx_hashes = tx_hashes[::-1]
+        self.assertFalse(block.validate_merkle_root())
+        # 3 transactions with the last one repeated have the root of the first 3.
+        block.tx_hashes = tx_hashes + [hash256(b'c')[::-1]]
+        block.merkle_root = merkle_root([h[::-1] for h in block.tx_hashes])[::-1]
+        self.assertTrue(block.validate_merkle_root())
+        block.tx_hashes.append(block.tx_hashes[-1])
+        self.assertFalse(block.validate_merkle_root())
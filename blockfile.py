@@ -0,0 +1,280 @@
+import mmap
+import os
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from unittest import TestCase
+
+from block import Block
+from helper import int_to_little_endian, little_endian_to_int
+from network import NETWORK_MAGIC, TESTNET_NETWORK_MAGIC, BlockMessage
+from script import Script, p2pkh_script
+from tx import Tx, TxIn, TxOut
+
+# every block in a blk*.dat file is preceded by the network magic and its size as 4 bytes LE.
+RECORD_HEADER_SIZE = 8
+
+
+# Reads the obfuscation key Bitcoin Core (since 28.0) stores in xor.dat in the blocks directory.
+# Returns None if there is no key or it's all zeros, which means the files are not obfuscated.
+def read_xor_key(blocks_dir):
+    path = os.path.join(blocks_dir, 'xor.dat')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        key = f.read()
+    if not any(key):
+        return None
+    return key
+
+
+# XORs data, found at offset in its file, with the key repeated from the start of the file.
+def deobfuscate(data, offset, key):
+    start = offset % len(key)
+    # key repeated to cover data, aligned with the file offset.
+    stream = (key[start:] + key * (len(data) // len(key) + 1))[:len(data)]
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(len(data), 'little')
+
+
+# A block found in a block file: where it is and its serialization. The block is only parsed when asked.
+class BlockRecord:
+
+    def __init__(self, path, offset, data):
+        self.path = path
+        # offset of the block serialization in the file, right after the magic and the size.
+        self.offset = offset
+        # the serialized block, a memoryview over the mapped file when the file isn't obfuscated.
+        self.data = data
+
+    def __repr__(self):
+        return 'BlockRecord({}:{}, {} bytes)'.format(self.path, self.offset, len(self.data))
+
+    # returns the block hash without parsing the transactions.
+    def hash(self):
+        return Block.parse(BytesIO(self.data[:80])).hash()
+
+    # returns the BlockMessage.
+    def parse(self):
+        return BlockMessage.parse(BytesIO(self.data))
+
+
+# Reads Bitcoin Core's blk*.dat block files by memory mapping them. Used as a context manager:
+#
+#     with BlockFileReader('blocks/blk00000.dat') as reader:
+#         for record in reader:
+#             block = record.parse()
+#
+# Records are yielded lazily and their data points into the mapped file, so only what's parsed is read.
+class BlockFileReader:
+
+    def __init__(self, path, testnet=False, magic=None, xor_key=None):
+        self.path = path
+        if magic is None:
+            magic = TESTNET_NETWORK_MAGIC if testnet else NETWORK_MAGIC
+        self.magic = magic
+        self.xor_key = xor_key
+        self.file = None
+        self.map = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def open(self):
+        self.file = open(self.path, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # empty files can't be mapped.
+            self.map = b''
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            try:
+                self.map.close()
+            except BufferError:
+                # records still in use point into the map, it's unmapped when they are gone.
+                pass
+        if self.file is not None:
+            self.file.close()
+        self.map = self.file = None
+
+    # returns the 8 bytes with the magic and the size of the record at offset.
+    def _record_header(self, offset):
+        header = self.map[offset:offset + RECORD_HEADER_SIZE]
+        if self.xor_key is not None:
+            header = deobfuscate(header, offset, self.xor_key)
+        return header
+
+    # Returns the offsets where records start (the magic), from start up to end. Only the 8 bytes in front
+    # of every block are read, so this is cheap and is used to split a file into ranges.
+    def offsets(self, start=0, end=None):
+        if end is None:
+            end = len(self.map)
+        offset = start
+        while offset + RECORD_HEADER_SIZE <= end:
+            header = self._record_header(offset)
+            # Bitcoin Core allocates the files in chunks, the unused end of the file is all zeros.
+            if header[:4] != self.magic:
+                if any(header):
+                    raise RuntimeError('bad magic at {}:{}'.format(self.path, offset))
+                break
+            size = little_endian_to_int(header[4:])
+            yield offset
+            offset += RECORD_HEADER_SIZE + size
+
+    # Yields a BlockRecord for every block whose record starts between start and end.
+    def records(self, start=0, end=None):
+        view = memoryview(self.map) if isinstance(self.map, mmap.mmap) else self.map
+        for offset in self.offsets(start, end):
+            size = little_endian_to_int(self._record_header(offset)[4:])
+            data_offset = offset + RECORD_HEADER_SIZE
+            if data_offset + size > len(self.map):
+                raise RuntimeError('truncated block at {}:{}'.format(self.path, offset))
+            data = view[data_offset:data_offset + size]
+            if self.xor_key is not None:
+                data = deobfuscate(data, data_offset, self.xor_key)
+            yield BlockRecord(self.path, data_offset, data)
+
+    # Splits the file in about parts ranges of (start, end) that begin at a record, to parse them separately.
+    def ranges(self, parts):
+        offsets = list(self.offsets())
+        if len(offsets) == 0:
+            return []
+        step = max(1, -(-len(offsets) // parts))
+        starts = offsets[::step]
+        return list(zip(starts, starts[1:] + [len(self.map)]))
+
+
+# Returns the blk*.dat files of a blocks directory in order.
+def block_files(blocks_dir):
+    names = sorted(name for name in os.listdir(blocks_dir)
+                   if name.startswith('blk') and name.endswith('.dat'))
+    return [os.path.join(blocks_dir, name) for name in names]
+
+
+# Parses the blocks of a range of a file and returns (offset, function(block)) for each one.
+# Runs in the worker pool, so it has to be a module function.
+def process_range(path, start, end, function, testnet=False, magic=None, xor_key=None):
+    result = []
+    with BlockFileReader(path, testnet, magic, xor_key) as reader:
+        for record in reader.records(start, end):
+            result.append((record.offset, function(record.parse())))
+    return result
+
+
+# Parses all the blocks in the files in parallel and yields (path, offset, function(block)) in file order.
+# function has to be a module function (it's sent to other processes) and should return something small,
+# as the results come back to this process. Each file is split into parts_per_file ranges.
+# Blocks are parsed in executor, by default a process pool created for the call.
+def process_block_files(paths, function, parts_per_file=1, testnet=False, magic=None, xor_key=None,
+                        executor=None, max_workers=None):
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        futures = []
+        for path in paths:
+            with BlockFileReader(path, testnet, magic, xor_key) as reader:
+                ranges = reader.ranges(parts_per_file)
+            for start, end in ranges:
+                futures.append((path, executor.submit(
+                    process_range, path, start, end, function, testnet, magic, xor_key)))
+        for path, future in futures:
+            for offset, value in future.result():
+                yield path, offset, value
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# used by the tests, it has to be a module function to be sent to the worker processes.
+def _block_hash(block):
+    return block.hash()
+
+
+class BlockFileTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        h160 = bytes(20)
+        prev_block = b'\x00' * 32
+        self.blocks = []
+        for height in range(5):
+            coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([int_to_little_endian(height + 1, 4)]))],
+                          [TxOut(5000000000, p2pkh_script(h160))], 0)
+            block = BlockMessage(1, prev_block, coinbase.hash(), 1231006505 + height, b'\xff\xff\x7f\x20',
+                                 b'\x00' * 4, 1, [coinbase])
+            self.blocks.append(block)
+            prev_block = block.hash()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # writes the blocks as Bitcoin Core does, with zero padding at the end.
+    def write(self, name, blocks, xor_key=None):
+        raw = b''
+        for block in blocks:
+            serialized = block.serialize()
+            raw += NETWORK_MAGIC + int_to_little_endian(len(serialized), 4) + serialized
+        raw += b'\x00' * 100
+        if xor_key is not None:
+            raw = deobfuscate(raw, 0, xor_key)
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(raw)
+        return path
+
+    def test_serialize(self):
+        block = self.blocks[0]
+        parsed = BlockMessage.parse(BytesIO(block.serialize()))
+        self.assertEqual(parsed.hash(), block.hash())
+        self.assertEqual(parsed.txns[0].hash(), block.txns[0].hash())
+
+    def test_read(self):
+        path = self.write('blk00000.dat', self.blocks)
+        with BlockFileReader(path) as reader:
+            records = list(reader)
+            self.assertEqual([record.hash() for record in records], [block.hash() for block in self.blocks])
+            self.assertEqual(records[0].offset, 8)
+            self.assertEqual(records[1].offset, 8 + len(self.blocks[0].serialize()) + 8)
+            self.assertEqual(records[2].parse().txns[0].hash(), self.blocks[2].txns[0].hash())
+            # ranges start at records and cover them all.
+            ranges = reader.ranges(2)
+            self.assertEqual(len(ranges), 2)
+            hashes = [record.hash() for start, end in ranges for record in reader.records(start, end)]
+            self.assertEqual(hashes, [block.hash() for block in self.blocks])
+
+    def test_xor(self):
+        key = bytes.fromhex('0102030405060708')
+        os.makedirs(os.path.join(self.dir.name, 'blocks'))
+        with open(os.path.join(self.dir.name, 'blocks', 'xor.dat'), 'wb') as f:
+            f.write(key)
+        self.assertEqual(read_xor_key(os.path.join(self.dir.name, 'blocks')), key)
+        self.assertIsNone(read_xor_key(self.dir.name))
+        path = self.write('blk00000.dat', self.blocks, key)
+        with BlockFileReader(path, xor_key=key) as reader:
+            self.assertEqual([record.hash() for record in reader], [block.hash() for block in self.blocks])
+        with BlockFileReader(path) as reader:
+            with self.assertRaises(RuntimeError):
+                list(reader)
+
+    def test_process_block_files(self):
+        self.write('blk00000.dat', self.blocks[:3])
+        self.write('blk00001.dat', self.blocks[3:])
+        paths = block_files(self.dir.name)
+        self.assertEqual([os.path.basename(path) for path in paths], ['blk00000.dat', 'blk00001.dat'])
+        with ThreadPoolExecutor(2) as executor:
+            results = list(process_block_files(paths, _block_hash, parts_per_file=2, executor=executor))
+        self.assertEqual([value for path, offset, value in results], [block.hash() for block in self.blocks])
+        self.assertEqual(results[3][:2], (paths[1], 8))
+        # the default worker pool parses in other processes.
+        results = list(process_block_files(paths, _block_hash))
+        self.assertEqual([value for path, offset, value in results], [block.hash() for block in self.blocks])
@@ -1,7 +1,6 @@
 from unittest import TestCase
 
 from helper import (
-    bit_field_to_bytes,
     encode_varint,
     int_to_little_endian,
     murmur3,
@@ -16,33 +15,103 @@ BIP37_CONSTANT = 0xfba4c795
 class BloomFilter:
 
     def __init__(self, size, function_count, tweak):
-        # The size of the bit field, or how many buckets there are.
+        # The size of the bit field in bytes, or how many buckets there are divided by 8.
         self.size = size
-        self.bit_field = [0] * (size * 8)
+        # The bit field, bit i is bit i % 8 of byte i // 8, which is how it's sent in filterload.
+        self.filter = bytearray(size)
         # The number of hash functions to use to calculate the bloom filter.
         self.function_count = function_count
         # A tweak to be able to change the bloom filter slightly if it hits too many items.
         self.tweak = tweak
+        # This is the seed formula - page 215. The seeds are the same for every item.
+        self.seeds = [(i * BIP37_CONSTANT + tweak) & 0xffffffff for i in range(function_count)]
+
+    # the bit field as a list with one int per bit.
+    @property
+    def bit_field(self):
+        return [byte >> i & 1 for byte in self.filter for i in range(8)]
+
+    # Returns the positions of the bits for an item, one per hash function.
+    def bits(self, item):
+        num_bits = self.size * 8
+        # murmur3 returns a number, so we don't have to convert to an integer.
+        return [murmur3(item, seed) % num_bits for seed in self.seeds]
 
     # Given an item to be added to the bloom filter, sets the corresponding bits of the bit field to 1.
     def add(self, item):
-        # We hash function_count number of times.
-        for i in range(self.function_count):
-            # This is the seed formula - page 215.
-            seed = i * BIP37_CONSTANT + self.tweak
-            # murmur3 returns a number, so we don't have to convert to an integer.
-            h = murmur3(item, seed=seed)
-            bit = h % len(self.bit_field)
-            self.bit_field[bit] = 1
+        self.add_many([item])
+
+    # Adds a list of items, like all the scripts or public keys of a wallet.
+    def add_many(self, items):
+        bit_filter = self.filter
+        seeds = self.seeds
+        num_bits = self.size * 8
+        for item in items:
+            for seed in seeds:
+                bit = murmur3(item, seed) % num_bits
+                bit_filter[bit >> 3] |= 1 << (bit & 7)
+
+    # Returns whether the item may be in the filter. False means it was certainly not added.
+    def contains(self, item):
+        return self.contains_many([item])[0]
+
+    def __contains__(self, item):
+        return self.contains(item)
+
+    # Returns a list with contains for every item.
+    def contains_many(self, items):
+        bit_filter = self.filter
+        seeds = self.seeds
+        num_bits = self.size * 8
+        result = []
+        for item in items:
+            for seed in seeds:
+                bit = murmur3(item, seed) % num_bits
+                if not bit_filter[bit >> 3] >> (bit & 7) & 1:
+                    result.append(False)
+                    break
+            else:
+                result.append(True)
+        return result
 
     # Generates the payload to communicate the bloom filter to a full node
     # and returns a GenericMessage that includes it - page 217.
     def filterload(self, flag=1):
         payload = encode_varint(self.size)
-        payload += bit_field_to_bytes(self.bit_field)
+        payload += bytes(self.filter)
         payload += int_to_little_endian(self.function_count, 4)
         payload += int_to_little_endian(self.tweak, 4)
         # The matched item flag is used to tell the full node to add any matched transactions to the bloom filter.
         payload += int_to_little_endian(flag, 1)
         # filterload is the command used to set the bloom filter.
         return GenericMessage(b'filterload', payload)
+
+
+class BloomFilterTest(TestCase):
+
+    def test_add(self):
+        # page 217.
+        bf = BloomFilter(10, 5, 99)
+        bf.add(b'Hello World')
+        self.assertEqual(bf.filter.hex(), '0000000a080000000140')
+        bf.add(b'Goodbye!')
+        self.assertEqual(bf.filter.hex(), '4000600a080000010940')
+        self.assertEqual(len(bf.bit_field), 80)
+        self.assertEqual(bf.bit_field[6], 1)
+        self.assertEqual(bf.filterload().serialize().hex(), '0a4000600a080000010940050000006300000001')
+        self.assertIn(b'Hello World', bf)
+        self.assertEqual(bf.contains_many([b'Goodbye!', b'Hello World']), [True, True])
+        other = BloomFilter(10, 5, 99)
+        other.add_many([b'Hello World', b'Goodbye!'])
+        self.assertEqual(other.filter, bf.filter)
+        self.assertEqual(set(bf.bits(b'Hello World') + bf.bits(b'Goodbye!')),
+                         {i for i, bit in enumerate(bf.bit_field) if bit})
+
+    def test_contains_many(self):
+        bf = BloomFilter(1000, 10, 1234)
+        items = [i.to_bytes(20, 'big') for i in range(500)]
+        bf.add_many(items)
+        self.assertEqual(bf.contains_many(items), [True] * 500)
+        others = [i.to_bytes(20, 'big') for i in range(500, 1500)]
+        # a filter of 8000 bits with 500 items and 10 functions has a false positive rate under 1%.
+        self.assertLess(sum(bf.contains_many(others)), 20)
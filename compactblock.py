@@ -0,0 +1,307 @@
+import hashlib
+
+from io import BytesIO
+from random import randint
+from unittest import TestCase
+
+from block import Block
+from helper import encode_varint, int_to_little_endian, little_endian_to_int, read_varint, siphash
+from merkle import txids_merkle_root
+from network import BlockMessage, GetDataMessage, COMPACT_BLOCK_DATA_TYPE
+from script import Script, p2pkh_script
+from tx import Tx, TxIn, TxOut
+
+# short ids are the low 6 bytes of the SipHash of the transaction id.
+SHORT_ID_SIZE = 6
+SHORT_ID_MASK = (1 << 8 * SHORT_ID_SIZE) - 1
+
+
+# Tells a peer to send new blocks as cmpctblock messages (announce=True) or to announce them with inv or headers,
+# and which version of compact blocks we use: 1 identifies transactions by txid, 2 by wtxid (BIP152).
+class SendCmpctMessage:
+
+    command = b'sendcmpct'
+
+    def __init__(self, announce=False, version=2):
+        self.announce = announce
+        self.version = version
+
+    @classmethod
+    def parse(cls, stream):
+        announce = stream.read(1)[0] == 1
+        version = little_endian_to_int(stream.read(8))
+        return cls(announce, version)
+
+    def serialize(self):
+        return bytes([int(self.announce)]) + int_to_little_endian(self.version, 8)
+
+
+# Writes a list of increasing indexes as a count and, for each one, the difference with the previous one
+# minus 1, which is how BIP152 sends them.
+def encode_indexes(indexes):
+    result = encode_varint(len(indexes))
+    previous = -1
+    for index in indexes:
+        result += encode_varint(index - previous - 1)
+        previous = index
+    return result
+
+
+# Returns the indexes written by encode_indexes. Raises RuntimeError if they don't fit in a block.
+def read_indexes(stream):
+    indexes = []
+    previous = -1
+    for _ in range(read_varint(stream)):
+        previous += read_varint(stream) + 1
+        if previous > 0xffff:
+            raise RuntimeError('index {} too large'.format(previous))
+        indexes.append(previous)
+    return indexes
+
+
+# A block announced with its header, the short ids of its transactions and the transactions the peer expects
+# us not to have (at least the coinbase), so we can rebuild it from the transactions we already have.
+# prefilled_txns is a list of (index in the block, Tx).
+class CmpctBlockMessage:
+
+    command = b'cmpctblock'
+
+    def __init__(self, header, nonce, short_ids, prefilled_txns, version=2):
+        # the Block header.
+        self.header = header
+        # 8-byte random number that makes the short ids different for every peer.
+        self.nonce = nonce
+        self.short_ids = short_ids
+        self.prefilled_txns = prefilled_txns
+        # the compact blocks version, sent in sendcmpct and not in the message.
+        self.version = version
+        self._key = None
+
+    # Returns the compact block of a BlockMessage, with the transactions at the prefilled indexes included.
+    @classmethod
+    def from_block(cls, block_message, nonce=None, prefilled=(0,), version=2):
+        if nonce is None:
+            nonce = randint(0, 2**64 - 1)
+        message = cls(block_message.header(), nonce, [], [], version)
+        prefilled = set(prefilled)
+        for i, tx in enumerate(block_message.txns):
+            if i in prefilled:
+                message.prefilled_txns.append((i, tx))
+            else:
+                message.short_ids.append(message.short_id(tx))
+        return message
+
+    @classmethod
+    def parse(cls, stream, version=2):
+        header = Block.parse(stream)
+        nonce = little_endian_to_int(stream.read(8))
+        short_ids = [little_endian_to_int(stream.read(SHORT_ID_SIZE)) for _ in range(read_varint(stream))]
+        prefilled_txns = []
+        previous = -1
+        for _ in range(read_varint(stream)):
+            previous += read_varint(stream) + 1
+            prefilled_txns.append((previous, Tx.parse(stream)))
+        return cls(header, nonce, short_ids, prefilled_txns, version)
+
+    def serialize(self):
+        result = self.header.serialize()
+        result += int_to_little_endian(self.nonce, 8)
+        result += encode_varint(len(self.short_ids))
+        for short_id in self.short_ids:
+            result += int_to_little_endian(short_id, SHORT_ID_SIZE)
+        result += encode_varint(len(self.prefilled_txns))
+        previous = -1
+        for index, tx in self.prefilled_txns:
+            result += encode_varint(index - previous - 1)
+            result += tx.serialize()
+            previous = index
+        return result
+
+    # number of transactions in the block.
+    def __len__(self):
+        return len(self.short_ids) + len(self.prefilled_txns)
+
+    # Returns the short id of a transaction: SipHash-2-4 of its wtxid (txid in version 1), keyed with the
+    # SHA256 of the header and the nonce.
+    def short_id(self, tx):
+        if self._key is None:
+            self._key = hashlib.sha256(self.header.serialize() + int_to_little_endian(self.nonce, 8)).digest()
+        tx_hash = tx.wtxid() if self.version == 2 else tx.hash()
+        return siphash(self._key, tx_hash[::-1]) & SHORT_ID_MASK
+
+    # Rebuilds as much of the block as possible with the prefilled transactions and the transactions in pool,
+    # any iterable of Tx, like the transactions in our mempool.
+    # Returns the list of transactions of the block, with None for the ones we don't have, which can then be
+    # asked for with getblocktxn. A short id matched by more than one transaction of the pool is left as missing.
+    # Raises RuntimeError if the compact block is invalid or two of its short ids are equal, in which case
+    # the whole block has to be downloaded.
+    def reconstruct(self, pool):
+        total = len(self)
+        txns = [None] * total
+        for index, tx in self.prefilled_txns:
+            if index >= total:
+                raise RuntimeError('prefilled transaction {} out of range'.format(index))
+            txns[index] = tx
+        # short id -> index in the block.
+        positions = {}
+        short_ids = iter(self.short_ids)
+        for i in range(total):
+            if txns[i] is None:
+                positions[next(short_ids)] = i
+        if len(positions) != len(self.short_ids):
+            raise RuntimeError('short id collision in block {}'.format(self.header.hash().hex()))
+        # the indexes already matched with a transaction of the pool.
+        matched = set()
+        for tx in pool:
+            i = positions.get(self.short_id(tx))
+            if i is None:
+                continue
+            if i in matched:
+                # two transactions of the pool have this short id, the right one has to be asked for.
+                txns[i] = None
+                continue
+            txns[i] = tx
+            matched.add(i)
+        return txns
+
+    # returns the getblocktxn message that asks for the transactions missing in txns, as returned by reconstruct.
+    def get_block_txn(self, txns):
+        return GetBlockTxnMessage(self.header.hash(), [i for i, tx in enumerate(txns) if tx is None])
+
+    # Completes the block with the transactions of a blocktxn message (or a list of Tx), in place of the
+    # missing ones in txns, and returns the BlockMessage. Raises RuntimeError if they don't fit or the merkle
+    # root doesn't match, which can happen if a transaction of the pool had the short id of another one; the
+    # whole block has to be downloaded then.
+    def complete(self, txns, block_txn=()):
+        if isinstance(block_txn, BlockTxnMessage):
+            block_txn = block_txn.txns
+        missing = [i for i, tx in enumerate(txns) if tx is None]
+        if len(missing) != len(block_txn):
+            raise RuntimeError('expected {} transactions, got {}'.format(len(missing), len(block_txn)))
+        txns = list(txns)
+        for i, tx in zip(missing, block_txn):
+            txns[i] = tx
+        root, mutated = txids_merkle_root([tx.hash() for tx in txns])
+        if mutated or root != self.header.merkle_root:
+            raise RuntimeError('merkle root mismatch in block {}'.format(self.header.hash().hex()))
+        header = self.header
+        return BlockMessage(header.version, header.prev_block, header.merkle_root, header.timestamp, header.bits,
+                            header.nonce, len(txns), txns)
+
+
+# Asks for transactions of a block, by index, after reconstructing it from a compact block.
+class GetBlockTxnMessage:
+
+    command = b'getblocktxn'
+
+    def __init__(self, block_hash, indexes):
+        self.block_hash = block_hash
+        self.indexes = indexes
+
+    @classmethod
+    def parse(cls, stream):
+        block_hash = stream.read(32)[::-1]
+        return cls(block_hash, read_indexes(stream))
+
+    def serialize(self):
+        return self.block_hash[::-1] + encode_indexes(self.indexes)
+
+
+# The transactions asked for with getblocktxn, in the same order.
+class BlockTxnMessage:
+
+    command = b'blocktxn'
+
+    def __init__(self, block_hash, txns):
+        self.block_hash = block_hash
+        self.txns = txns
+
+    @classmethod
+    def parse(cls, stream):
+        block_hash = stream.read(32)[::-1]
+        txns = [Tx.parse(stream) for _ in range(read_varint(stream))]
+        return cls(block_hash, txns)
+
+    def serialize(self):
+        result = self.block_hash[::-1] + encode_varint(len(self.txns))
+        for tx in self.txns:
+            result += tx.serialize()
+        return result
+
+
+# returns the getdata message that asks for a block as a compact block.
+def get_compact_block(block_hash):
+    getdata = GetDataMessage()
+    getdata.add_data(COMPACT_BLOCK_DATA_TYPE, block_hash)
+    return getdata
+
+
+class CompactBlockTest(TestCase):
+
+    def setUp(self):
+        h160 = bytes(20)
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x01\x00\x00\x00']))],
+                      [TxOut(5000000000, p2pkh_script(h160))], 0)
+        self.txns = [coinbase]
+        for i in range(8):
+            tx_in = TxIn(self.txns[-1].hash(), 0)
+            segwit = i % 2 == 0
+            if segwit:
+                tx_in.witness = [bytes([i]) * 72, b'\x02' * 33]
+            else:
+                tx_in.script_sig = Script([bytes([i]) * 71])
+            self.txns.append(Tx(2, [tx_in], [TxOut(4000000000 - i, p2pkh_script(h160))], 0, segwit=segwit))
+        root = txids_merkle_root([tx.hash() for tx in self.txns])[0]
+        self.block = BlockMessage(1, b'\x00' * 32, root, 1231006505, b'\xff\xff\x00\x1d', b'\x00' * 4,
+                                  len(self.txns), self.txns)
+
+    def test_siphash(self):
+        # from the test vectors of the reference implementation.
+        key = bytes(range(16))
+        self.assertEqual(siphash(key, b''), 0x726fdb47dd0e0e31)
+        self.assertEqual(siphash(key, bytes(range(8))), 0x93f5f5799a932462)
+        self.assertEqual(siphash(key, bytes(range(15))), 0xa129ca6149be45e5)
+
+    def test_messages(self):
+        message = SendCmpctMessage(True, 2)
+        self.assertEqual(message.serialize().hex(), '010200000000000000')
+        parsed = SendCmpctMessage.parse(BytesIO(message.serialize()))
+        self.assertEqual((parsed.announce, parsed.version), (True, 2))
+        compact = CmpctBlockMessage.from_block(self.block, nonce=7, prefilled=(0, 3))
+        parsed = CmpctBlockMessage.parse(BytesIO(compact.serialize()))
+        self.assertEqual(parsed.header.hash(), self.block.hash())
+        self.assertEqual(parsed.nonce, 7)
+        self.assertEqual(parsed.short_ids, compact.short_ids)
+        self.assertEqual([(i, tx.wtxid()) for i, tx in parsed.prefilled_txns],
+                         [(0, self.txns[0].wtxid()), (3, self.txns[3].wtxid())])
+        self.assertEqual(len(parsed), 9)
+        message = GetBlockTxnMessage(self.block.hash(), [1, 2, 5, 300])
+        parsed = GetBlockTxnMessage.parse(BytesIO(message.serialize()))
+        self.assertEqual((parsed.block_hash, parsed.indexes), (self.block.hash(), [1, 2, 5, 300]))
+        self.assertEqual(encode_indexes([1, 2, 5]).hex(), '03010002')
+        message = BlockTxnMessage(self.block.hash(), self.txns[1:3])
+        parsed = BlockTxnMessage.parse(BytesIO(message.serialize()))
+        self.assertEqual([tx.wtxid() for tx in parsed.txns], [tx.wtxid() for tx in self.txns[1:3]])
+
+    def test_reconstruct(self):
+        compact = CmpctBlockMessage.parse(BytesIO(CmpctBlockMessage.from_block(self.block).serialize()))
+        # we have some of the transactions of the block, and others.
+        other = Tx(1, [TxIn(b'\x05' * 32, 0)], [TxOut(1, p2pkh_script(bytes(20)))], 0)
+        pool = [self.txns[1], self.txns[2], other, self.txns[6], self.txns[7]]
+        txns = compact.reconstruct(pool)
+        self.assertEqual([i for i, tx in enumerate(txns) if tx is None], [3, 4, 5, 8])
+        request = GetBlockTxnMessage.parse(BytesIO(compact.get_block_txn(txns).serialize()))
+        self.assertEqual(request.indexes, [3, 4, 5, 8])
+        # the peer answers with the transactions asked for.
+        answer = BlockTxnMessage(request.block_hash, [self.txns[i] for i in request.indexes])
+        answer = BlockTxnMessage.parse(BytesIO(answer.serialize()))
+        block = compact.complete(txns, answer)
+        self.assertEqual(block.serialize(), self.block.serialize())
+        with self.assertRaisesRegex(RuntimeError, 'expected 4'):
+            compact.complete(txns, answer.txns[:3])
+        with self.assertRaisesRegex(RuntimeError, 'merkle root'):
+            compact.complete(txns, answer.txns[::-1])
+        # version 1 short ids use txids.
+        compact = CmpctBlockMessage.from_block(self.block, version=1)
+        self.assertEqual(compact.reconstruct(self.txns)[1:], self.txns[1:])
+        self.assertEqual(get_compact_block(self.block.hash()).serialize()[:5], b'\x01\x04\x00\x00\x00')
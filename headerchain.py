@@ -0,0 +1,374 @@
+import mmap
+import os
+import tempfile
+
+from io import BytesIO
+from unittest import TestCase
+
+from block import GENESIS_BLOCK, TESTNET_GENESIS_BLOCK, Block, bits_target
+from helper import target_to_bits
+from retarget import MAINNET, REGTEST, TESTNET, Retarget, RetargetParams
+
+# size of a serialized block header.
+HEADER_SIZE = 80
+# every index entry is the 32-byte block hash followed by the chain work up to that block as 32 bytes BE.
+INDEX_ENTRY_SIZE = 64
+# the difficulty is adjusted every 2016 blocks.
+RETARGET_INTERVAL = 2016
+
+
+# bits -> work, there are few distinct bits in a chain.
+_WORK = {}
+
+
+# Work represented by a header: the expected number of hashes needed to find it.
+def header_work(bits):
+    work = _WORK.get(bits)
+    if work is None:
+        work = _WORK[bits] = 2**256 // (bits_target(bits) + 1)
+    return work
+
+
+# Fixed size records stored back to back in a file, record i at i * stride. Reads go through a memory map
+# of the file. Records appended after mapping it are also kept in memory (the tail) until there are enough
+# of them to map the file again. If path is None all the records are kept in memory.
+class FlatFile:
+
+    # bytes of appended records kept in memory before the file is mapped again.
+    MAX_TAIL = 1 << 20
+
+    def __init__(self, path, stride):
+        self.path = path
+        self.stride = stride
+        self.file = None
+        self.map = None
+        # number of records covered by the map, the rest are in tail.
+        self.mapped = 0
+        self.tail = bytearray()
+        self.count = 0
+        if path is not None:
+            mode = 'r+b' if os.path.exists(path) else 'w+b'
+            self.file = open(path, mode)
+            size = os.fstat(self.file.fileno()).st_size
+            self.count = size // stride
+            # a partial record left by an interrupted write is dropped.
+            if size % stride:
+                self.file.truncate(self.count * stride)
+            self.remap()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError('record {} out of range'.format(i))
+        if i < self.mapped:
+            return self.map[i * self.stride:(i + 1) * self.stride]
+        i -= self.mapped
+        return bytes(self.tail[i * self.stride:(i + 1) * self.stride])
+
+    def append(self, record):
+        if self.file is not None:
+            self.file.seek(self.count * self.stride)
+            self.file.write(record)
+        self.tail += record
+        self.count += 1
+        if self.file is not None and len(self.tail) >= self.MAX_TAIL:
+            self.remap()
+
+    # keeps the first count records.
+    def truncate(self, count):
+        if self.file is None:
+            del self.tail[count * self.stride:]
+        else:
+            # the map can't cover the part of the file that's removed.
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.truncate(count * self.stride)
+            self.remap()
+        self.count = count
+
+    # maps the whole file, so the tail isn't needed anymore.
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.flush()
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        self.mapped = size // self.stride
+        self.tail = bytearray()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            if self.map is not None:
+                self.map.close()
+            self.file.close()
+            self.map = self.file = None
+
+
+# The chain of block headers from the genesis block, by height.
+# Headers are stored in a flat file (path), 80 bytes each, so the header at any height is a slice of the
+# memory mapped file. A sidecar index (path + '.idx') has the hash of every header and the chain work up to it,
+# so opening an existing chain doesn't need to hash or validate anything. The hash to height dict is built
+# the first time a hash is looked up. If path is None the chain is kept in memory.
+#
+# Headers are checked when appended: they have to extend the tip, have valid proof of work and the bits
+# required by the difficulty rules of params (a retarget.RetargetParams, mainnet or testnet by default).
+# The chain work of every header is stored, so comparing the tip with another branch is a single lookup.
+class HeaderChain:
+
+    def __init__(self, path=None, testnet=False, genesis=None, params=None):
+        self.path = path
+        self.testnet = testnet
+        if params is None:
+            params = TESTNET if testnet else MAINNET
+        self.retarget = Retarget(params)
+        self.headers = FlatFile(path, HEADER_SIZE)
+        self.index = FlatFile(None if path is None else path + '.idx', INDEX_ENTRY_SIZE)
+        # block hash -> height, built on first use.
+        self._heights = None
+        if len(self.headers) == 0:
+            if genesis is None:
+                genesis = TESTNET_GENESIS_BLOCK if testnet else GENESIS_BLOCK
+            self.append(Block.parse(BytesIO(genesis)), validate=False)
+        else:
+            self._repair_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # number of headers, the height of the tip plus 1.
+    def __len__(self):
+        return len(self.headers)
+
+    def __contains__(self, block_hash):
+        return self.height_of(block_hash) is not None
+
+    # the index is written after the header, so an interrupted append can leave it behind. Missing entries are
+    # computed again from the headers and extra ones are dropped.
+    def _repair_index(self):
+        if len(self.index) > len(self.headers):
+            self.index.truncate(len(self.headers))
+        for height in range(len(self.index), len(self.headers)):
+            header = self.header(height)
+            work = header_work(header.bits)
+            if height > 0:
+                work += self.chainwork(height - 1)
+            self.index.append(header.hash() + work.to_bytes(32, 'big'))
+
+    # height of the tip.
+    @property
+    def height(self):
+        return len(self.headers) - 1
+
+    def tip(self):
+        return self.header(self.height)
+
+    def tip_hash(self):
+        return self.hash_at(self.height)
+
+    # returns the serialized header at height.
+    def header_bytes(self, height):
+        return self.headers[height]
+
+    # returns the header at height as a Block.
+    def header(self, height):
+        return Block.parse(BytesIO(self.headers[height]))
+
+    # returns the hash of the header at height.
+    def hash_at(self, height):
+        return self.index[height][:32]
+
+    # returns the total work of the chain up to height, by default the tip.
+    def chainwork(self, height=None):
+        if height is None:
+            height = self.height
+        return int.from_bytes(self.index[height][32:], 'big')
+
+    # returns the height of the block with the given hash, or None if it's not in the chain.
+    def height_of(self, block_hash):
+        if self._heights is None:
+            self._heights = {self.hash_at(height): height for height in range(len(self))}
+        return self._heights.get(block_hash)
+
+    # returns the bits the header at height must have.
+    def expected_bits(self, height, header):
+        return self.retarget.expected_bits(self, height, header)
+
+    # Adds a header on top of the tip and returns its height. Raises RuntimeError if it doesn't extend the
+    # tip, or, with validate, if its proof of work or its bits are wrong. validate=False is for headers that
+    # are already trusted, like the ones imported from a node's own block files. pow_checked=True skips the
+    # proof of work check only, for headers that had it checked in bulk. block_hash is the header's hash when the
+    # caller already has it.
+    def append(self, header, validate=True, pow_checked=False, block_hash=None):
+        height = len(self)
+        if height > 0:
+            if header.prev_block != self.tip_hash():
+                raise RuntimeError('header {} does not extend the tip'.format(header.hash().hex()))
+            if validate:
+                if not pow_checked and not header.check_pow():
+                    raise RuntimeError('bad proof of work at {}'.format(height))
+                if header.bits != self.expected_bits(height, header):
+                    raise RuntimeError('bad bits at {}'.format(height))
+        if block_hash is None:
+            block_hash = header.hash()
+        work = header_work(header.bits)
+        if height > 0:
+            work += self.chainwork()
+        self.headers.append(header.serialize())
+        self.index.append(block_hash + work.to_bytes(32, 'big'))
+        if self._heights is not None:
+            self._heights[block_hash] = height
+        return height
+
+    # Appends headers in order and returns the height of the new tip.
+    def extend(self, headers, validate=True):
+        for header in headers:
+            self.append(header, validate)
+        return self.height
+
+    # Removes the headers above height, to switch to another branch.
+    def rewind(self, height):
+        if height < 0:
+            raise ValueError('the genesis block can not be removed')
+        if self._heights is not None:
+            for h in range(height + 1, len(self)):
+                self._heights.pop(self.hash_at(h), None)
+        self.headers.truncate(height + 1)
+        self.index.truncate(height + 1)
+
+    def flush(self):
+        self.headers.flush()
+        self.index.flush()
+
+    def close(self):
+        self.headers.close()
+        self.index.close()
+
+
+class HeaderChainTest(TestCase):
+
+    # mainnet blocks 1 and 2.
+    BLOCKS = [
+        '010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba744bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e36299',
+        '010000004860eb18bf1b1620e37e9490fc8a427514416fd75159ab86688e9a8300000000d5fdcc541e25de1c7a5addedf24858b8bb665c9f36ef744ee42c316022c90f9bb0bc6649ffff001d08d2bd61',
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.headers = [Block.parse(BytesIO(bytes.fromhex(h))) for h in self.BLOCKS]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_append(self):
+        chain = HeaderChain()
+        self.assertEqual(chain.tip_hash().hex(), '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f')
+        self.assertEqual(chain.extend(self.headers), 2)
+        self.assertEqual(chain.tip_hash().hex(), '000000006a625f06636b8bb6ac7b960a8d03705d1ace08b1a19da3fdcc99ddbd')
+        self.assertEqual(chain.height_of(self.headers[0].hash()), 1)
+        self.assertNotIn(b'\x00' * 32, chain)
+        # each block at the initial difficulty is 2^32 + 2^32 / 0xffff hashes.
+        self.assertEqual(chain.chainwork(), 3 * 0x100010001)
+        self.assertEqual(chain.header(1).serialize().hex(), self.BLOCKS[0])
+        # headers that don't extend the tip, or have a bad proof of work, are rejected.
+        with self.assertRaisesRegex(RuntimeError, 'does not extend'):
+            chain.append(self.headers[0])
+        chain.rewind(1)
+        self.assertIsNone(chain.height_of(self.headers[1].hash()))
+        bad = Block.parse(BytesIO(bytes.fromhex(self.BLOCKS[1])))
+        bad.nonce = b'\x00' * 4
+        with self.assertRaisesRegex(RuntimeError, 'proof of work'):
+            chain.append(bad)
+        self.assertEqual(chain.append(bad, validate=False), 2)
+
+    def test_resume(self):
+        path = os.path.join(self.dir.name, 'headers.dat')
+        with HeaderChain(path) as chain:
+            chain.extend(self.headers)
+            chainwork = chain.chainwork()
+        self.assertEqual(os.path.getsize(path), 3 * HEADER_SIZE)
+        with HeaderChain(path) as chain:
+            self.assertEqual(chain.height, 2)
+            self.assertEqual(chain.tip().hash(), self.headers[1].hash())
+            self.assertEqual(chain.chainwork(), chainwork)
+            self.assertEqual(chain.height_of(self.headers[0].hash()), 1)
+        # an append interrupted before the index was written.
+        with open(path + '.idx', 'r+b') as f:
+            f.truncate(2 * INDEX_ENTRY_SIZE + 10)
+        with HeaderChain(path) as chain:
+            self.assertEqual(chain.tip_hash(), self.headers[1].hash())
+            self.assertEqual(chain.chainwork(), chainwork)
+            chain.rewind(1)
+            self.assertEqual(chain.append(self.headers[1]), 2)
+            self.assertEqual(chain.header(2).hash(), self.headers[1].hash())
+
+    def test_retarget(self):
+        # a chain with the lowest possible difficulty, so headers can be mined here.
+        bits = bytes.fromhex('ffff7f20')
+        genesis = Block(1, b'\x00' * 32, b'\x00' * 32, 1296688602, bits, b'\x00' * 4)
+        chain = HeaderChain(genesis=genesis.serialize())
+        for height in range(1, RETARGET_INTERVAL):
+            chain.append(self.mine(chain, bits, 1296688602 + height * 600))
+        # the first block of the second period must have its bits adjusted, which are capped at the
+        # mainnet's maximum target.
+        header = self.mine(chain, bits, 1296688602 + RETARGET_INTERVAL * 600)
+        with self.assertRaisesRegex(RuntimeError, 'bad bits'):
+            chain.append(header)
+        self.assertEqual(chain.expected_bits(RETARGET_INTERVAL, header), bytes.fromhex('ffff001d'))
+
+    def test_testnet_rules(self):
+        # testnet rules with short epochs.
+        params = RetargetParams('test', 2**224 - 1, interval=4, allow_min_difficulty=True)
+        bits = target_to_bits(2**200)
+        genesis = Block(1, b'\x00' * 32, b'\x00' * 32, 0, bits, b'\x00' * 4)
+        chain = HeaderChain(genesis=genesis.serialize(), params=params)
+
+        def header(timestamp, header_bits=bits):
+            return Block(1, chain.tip_hash(), b'\x00' * 32, timestamp, header_bits, b'\x00' * 4)
+
+        chain.append(header(600), validate=False)
+        # more than 20 minutes after the previous block the lowest difficulty is allowed.
+        late = header(1801)
+        self.assertEqual(chain.expected_bits(2, late), params.pow_limit_bits)
+        self.assertEqual(chain.expected_bits(2, header(1800)), bits)
+        chain.append(header(1801, params.pow_limit_bits), validate=False)
+        # the next block goes back to the bits of the epoch.
+        self.assertEqual(chain.expected_bits(3, header(1900)), bits)
+        chain.append(header(1900), validate=False)
+        # the epoch took 1900 seconds instead of 2400.
+        self.assertEqual(chain.expected_bits(4, header(5000)), target_to_bits(2**200 * 1900 // 2400))
+        # the cached epoch bits are recomputed after a rewind.
+        chain.rewind(2)
+        chain.append(header(2400), validate=False)
+        self.assertEqual(chain.expected_bits(4, header(5000)), bits)
+        # mainnet rules don't allow it.
+        mainnet = HeaderChain(genesis=genesis.serialize(), params=RetargetParams('test', 2**224 - 1, interval=4))
+        self.assertEqual(mainnet.expected_bits(1, header(5000)), bits)
+
+    def test_regtest(self):
+        genesis = Block(1, b'\x00' * 32, b'\x00' * 32, 1296688602, bytes.fromhex('ffff7f20'), b'\x00' * 4)
+        chain = HeaderChain(genesis=genesis.serialize(), params=REGTEST)
+        for height in range(1, RETARGET_INTERVAL):
+            chain.append(Block(1, chain.tip_hash(), b'\x00' * 32, 1296688602 + height, genesis.bits,
+                               b'\x00' * 4), validate=False)
+        header = Block(1, chain.tip_hash(), b'\x00' * 32, 1296688602 + RETARGET_INTERVAL, genesis.bits,
+                       b'\x00' * 4)
+        self.assertEqual(chain.expected_bits(RETARGET_INTERVAL, header), genesis.bits)
+        self.assertEqual(chain.chainwork(), RETARGET_INTERVAL * header_work(genesis.bits))
+
+    def mine(self, chain, bits, timestamp):
+        nonce = 0
+        while True:
+            header = Block(1, chain.tip_hash(), b'\x00' * 32, timestamp, bits, nonce.to_bytes(4, 'little'))
+            if header.check_pow():
+                return header
+            nonce += 1
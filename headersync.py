@@ -0,0 +1,295 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from queue import Queue
+from unittest import TestCase
+from unittest.mock import patch
+
+from block import Block, check_headers
+from headerchain import HeaderChain, header_work
+from network import GetHeadersMessage, HeadersMessage, NetworkEnvelope
+
+# most headers a node sends in a headers message.
+MAX_HEADERS = 2000
+
+
+# Returns the block locator of the chain: the hashes of the last 10 blocks and then, going back, blocks at
+# distances that double each time, ending at the genesis block. A peer finds the last block we have in common
+# with it in about log2(height) hashes even if we are on a different branch.
+def block_locator(chain):
+    locator = []
+    height = chain.height
+    step = 1
+    while height > 0:
+        locator.append(chain.hash_at(height))
+        if len(locator) >= 10:
+            step *= 2
+        height -= step
+    locator.append(chain.hash_at(0))
+    return locator
+
+
+# Downloads headers into a HeaderChain from one or more peers (SimpleNode objects, or anything with send and
+# wait_for), which are asked in turn.
+# Requests are pipelined: the next getheaders is sent as soon as a batch arrives, using its last hash, and the
+# batch is validated while the next one is on its way. Proof of work and links are checked in bulk in executor
+# (by default a process pool created for the sync) on the payload as received, the hashes computed there are
+# reused, and difficulty is checked when the batch is appended.
+# If the peer's headers fork from the chain below the tip, they are kept aside until their branch has more work
+# than the chain, and then the chain is rewound to the fork and the branch appended.
+class HeaderSync:
+
+    def __init__(self, chain, peers, executor=None, max_workers=None):
+        self.chain = chain
+        self.peers = list(peers)
+        if len(self.peers) == 0:
+            raise ValueError('at least one peer is needed')
+        self.executor = executor
+        self.max_workers = max_workers
+        # number of getheaders sent and headers appended.
+        self.requests = 0
+        self.headers_received = 0
+        # headers of a branch that forks below the tip and doesn't have more work yet:
+        # (height of the fork, [(header, hash)], work of the branch up to its last header).
+        self.branch = None
+
+    def request(self, peer, locator):
+        peer.send(GetHeadersMessage(locator=locator))
+        self.requests += 1
+
+    # Syncs until a peer has no more headers to send and returns the height of the tip.
+    # Raises RuntimeError, leaving the valid headers in the chain, if a batch is invalid.
+    def sync(self):
+        own_executor = self.executor is None
+        executor = ProcessPoolExecutor(self.max_workers) if own_executor else self.executor
+        try:
+            self._sync(executor)
+        finally:
+            if own_executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+        return self.chain.height
+
+    def _sync(self, executor):
+        turn = 0
+        peer = self.peers[0]
+        self.request(peer, block_locator(self.chain))
+        # batch being validated: (headers, future with the result of check_headers).
+        pending = None
+        while True:
+            message = peer.wait_for(HeadersMessage)
+            headers = message.blocks
+            # a full batch means there are more, so the next one is requested before validating this one.
+            if len(headers) == MAX_HEADERS:
+                turn += 1
+                peer = self.peers[turn % len(self.peers)]
+                self.request(peer, [headers[-1].hash()])
+            if pending is not None:
+                self._append(*pending)
+            if len(headers) == 0:
+                return
+            raw = message.raw
+            if raw is None:
+                raw = b''.join(header.serialize() + b'\x00' for header in headers)
+            pending = headers, executor.submit(check_headers, raw, stride=81, prev_block=headers[0].prev_block,
+                                               return_hashes=True)
+            if len(headers) < MAX_HEADERS:
+                self._append(*pending)
+                return
+
+    def _append(self, headers, future):
+        bad, hashes = future.result()
+        if self.branch is not None:
+            self._extend_branch(headers, bad, hashes)
+        elif headers[0].prev_block != self.chain.tip_hash():
+            self._fork(headers, bad, hashes)
+        else:
+            self._extend(headers, bad, hashes)
+
+    # Appends headers that extend the tip, with the result of check_headers.
+    def _extend(self, headers, bad, hashes):
+        # the headers before a bad one are still added, the bad one is appended with every check to raise
+        # the error.
+        for i, header in enumerate(headers):
+            if i == bad:
+                self.chain.append(header)
+            else:
+                self.chain.append(header, pow_checked=True, block_hash=hashes[i])
+            self.headers_received += 1
+
+    # Starts a branch with headers that don't extend the tip. The peer may send again some headers we have,
+    # since the block locator only has some of the hashes, so those are skipped.
+    def _fork(self, headers, bad, hashes):
+        chain = self.chain
+        height = chain.height_of(headers[0].prev_block)
+        if height is None:
+            raise RuntimeError('header {} does not connect to the chain'.format(headers[0].hash().hex()))
+        skip = 0
+        while skip < len(hashes) and height < chain.height and hashes[skip] == chain.hash_at(height + 1):
+            skip += 1
+            height += 1
+        if bad is not None:
+            bad -= skip
+        if height == chain.height:
+            # the rest extends the tip.
+            self._extend(headers[skip:], bad, hashes[skip:])
+            return
+        if skip == len(headers):
+            return
+        self.branch = (height, [], chain.chainwork(height))
+        self._extend_branch(headers[skip:], bad, hashes[skip:])
+
+    # Adds headers to the branch, and switches the chain to it once it has more work than the tip.
+    # A bad header makes the whole branch invalid, so it's dropped and the chain stays as it is.
+    def _extend_branch(self, headers, bad, hashes):
+        height, branch, work = self.branch
+        last_hash = branch[-1][1] if branch else self.chain.hash_at(height)
+        if headers[0].prev_block != last_hash:
+            self.branch = None
+            raise RuntimeError('header {} does not extend the branch'.format(headers[0].hash().hex()))
+        if bad is not None:
+            self.branch = None
+            raise RuntimeError('bad proof of work or link at {}'.format(height + len(branch) + bad + 1))
+        branch += zip(headers, hashes)
+        work += sum(header_work(header.bits) for header in headers)
+        self.branch = (height, branch, work)
+        if work <= self.chain.chainwork():
+            return
+        self.branch = None
+        chain = self.chain
+        # the headers that are replaced are kept to go back to them if the branch turns out to be invalid.
+        replaced = [chain.header(h) for h in range(height + 1, chain.height + 1)]
+        chain.rewind(height)
+        try:
+            for header, block_hash in branch:
+                chain.append(header, pow_checked=True, block_hash=block_hash)
+        except RuntimeError:
+            chain.rewind(height)
+            chain.extend(replaced, validate=False)
+            raise
+        self.headers_received += len(branch)
+
+
+# In memory peer for the tests. Answers getheaders with the headers after the first block in the locator it has.
+class FakePeer:
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.heights = {header.hash(): i for i, header in enumerate(headers)}
+        self.replies = Queue()
+        self.requests = []
+
+    def send(self, message):
+        # messages go through their serialization, like they would over the network.
+        envelope = NetworkEnvelope(message.command, message.serialize())
+        request = GetHeadersMessage.parse(envelope.stream())
+        self.requests.append(request.locator)
+        start = next(self.heights[h] for h in request.locator if h in self.heights) + 1
+        reply = HeadersMessage(self.headers[start:start + MAX_HEADERS])
+        self.replies.put(HeadersMessage.parse(BytesIO(reply.serialize())))
+
+    def wait_for(self, *message_classes):
+        return self.replies.get(timeout=10)
+
+
+class HeaderSyncTest(TestCase):
+
+    BITS = bytes.fromhex('ffff7f20')
+
+    @classmethod
+    def setUpClass(cls):
+        # a chain with the lowest difficulty, short enough not to reach a difficulty adjustment.
+        cls.genesis = Block(1, b'\x00' * 32, b'\x00' * 32, 1296688602, cls.BITS, b'\x00' * 4)
+        cls.headers = [cls.genesis]
+        for height in range(1, 2016):
+            cls.headers.append(cls.mine(cls.headers[-1], 1296688602 + height * 600))
+
+    # returns a header after previous with a valid proof of work.
+    @classmethod
+    def mine(cls, previous, timestamp):
+        nonce = 0
+        while True:
+            header = Block(1, previous.hash(), b'\x00' * 32, timestamp, cls.BITS, nonce.to_bytes(4, 'little'))
+            if header.check_pow():
+                return header
+            nonce += 1
+
+    def chain(self, height=0):
+        chain = HeaderChain(genesis=self.genesis.serialize())
+        chain.extend(self.headers[1:height + 1])
+        return chain
+
+    # returns a chain that has the first fork_height headers and then goes on to height on another branch.
+    def forked_chain(self, fork_height, height):
+        chain = self.chain(fork_height)
+        header = self.headers[fork_height]
+        for h in range(fork_height + 1, height + 1):
+            header = self.mine(header, header.timestamp + 601)
+            chain.append(header)
+        return chain
+
+    def test_block_locator(self):
+        chain = self.chain(100)
+        locator = block_locator(chain)
+        heights = [chain.height_of(h) for h in locator]
+        self.assertEqual(heights, [100, 99, 98, 97, 96, 95, 94, 93, 92, 91, 89, 85, 77, 61, 29, 0])
+        self.assertEqual(block_locator(self.chain()), [self.genesis.hash()])
+        message = GetHeadersMessage(locator=locator)
+        parsed = GetHeadersMessage.parse(BytesIO(message.serialize()))
+        self.assertEqual(parsed.locator, locator)
+        self.assertEqual(parsed.start_block, locator[0])
+
+    def test_sync(self):
+        chain = self.chain(10)
+        peers = [FakePeer(self.headers), FakePeer(self.headers)]
+        with ThreadPoolExecutor(2) as executor:
+            sync = HeaderSync(chain, peers, executor)
+            with patch.object(Block, 'hash', autospec=True, side_effect=Block.hash) as block_hash:
+                self.assertEqual(sync.sync(), 2015)
+        self.assertEqual(chain.tip_hash(), self.headers[-1].hash())
+        self.assertEqual(sync.headers_received, 2005)
+        # the hashes computed by check_headers are reused, only the one of the next request is computed here.
+        self.assertEqual(block_hash.call_count, 1)
+        # the first request sends the locator, the second one is sent to the other peer with the last
+        # hash of the first batch.
+        self.assertEqual(len(peers[0].requests[0]), 11)
+        self.assertEqual(peers[1].requests, [[self.headers[2010].hash()]])
+        self.assertEqual(sync.requests, 2)
+
+    def test_bad_pow(self):
+        headers = list(self.headers)
+        bad = Block(1, headers[1499].hash(), b'\x00' * 32, 0, self.BITS, b'\x00' * 4)
+        while bad.check_pow():
+            bad.timestamp += 1
+        headers[1500] = bad
+        chain = self.chain()
+        with ThreadPoolExecutor(2) as executor:
+            with self.assertRaisesRegex(RuntimeError, 'bad proof of work at 1500'):
+                HeaderSync(chain, [FakePeer(headers)], executor).sync()
+        self.assertEqual(chain.height, 1499)
+
+    def test_fork(self):
+        # the chain forks from the peer's at 50. The locator makes the peer start at 30, so 30 to 50 are skipped.
+        chain = self.forked_chain(50, 100)
+        with ThreadPoolExecutor(2) as executor:
+            sync = HeaderSync(chain, [FakePeer(self.headers)], executor)
+            self.assertEqual(sync.sync(), 2015)
+        self.assertEqual(chain.tip_hash(), self.headers[-1].hash())
+        self.assertEqual(chain.hash_at(51), self.headers[51].hash())
+        self.assertEqual(sync.headers_received, 1965)
+        self.assertEqual(chain.chainwork(), self.chain(2015).chainwork())
+        # a branch with less work is ignored.
+        chain = self.forked_chain(50, 100)
+        tip = chain.tip_hash()
+        with ThreadPoolExecutor(2) as executor:
+            sync = HeaderSync(chain, [FakePeer(self.headers[:81])], executor)
+            self.assertEqual(sync.sync(), 100)
+        self.assertEqual(chain.tip_hash(), tip)
+        self.assertEqual(sync.headers_received, 0)
+        # and so is an invalid one.
+        headers = list(self.headers)
+        headers[60] = Block(1, headers[59].hash(), b'\x00' * 32, 0, self.BITS, b'\x00' * 4)
+        while headers[60].check_pow():
+            headers[60].timestamp += 1
+        with ThreadPoolExecutor(2) as executor:
+            with self.assertRaisesRegex(RuntimeError, 'at 60'):
+                HeaderSync(chain, [FakePeer(headers)], executor).sync()
+        self.assertEqual(chain.tip_hash(), tip)
@@ -1,6 +1,8 @@
 from unittest import TestSuite, TextTestRunner
 
 import hashlib
+import struct
+
 import bech32
 
 BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
@@ -56,6 +58,12 @@ def encode_base58_checksum(b):
 
 # Takes an address and returns its 20-byte hash version. Opposite of encode_base58 - Page 139.
 def decode_base58(s):
+    return decode_base58_with_prefix(s)[1]
+
+
+# Takes an address and returns its 1-byte network prefix and its 20-byte hash, so the type of address
+# (p2pkh or p2sh) and its network can be told apart.
+def decode_base58_with_prefix(s):
     num = 0
     # we get to the encoded version doing modulo 58 and then dividing the number by 58 until
     # we get to a number igual to or less than 58. We reverse that in this loop.
@@ -72,7 +80,7 @@ def decode_base58(s):
         raise ValueError(f"bad address")
     # the first byte is the network prefix (mainnet or testnet) and the last 4 are the checksum.
     # The middle 20 are the 20_byte hash (the hash160).
-    return num_bytes[1:-4]
+    return num_bytes[0], num_bytes[1:-4]
 
 
 def little_endian_to_int(num_bytes):
@@ -205,9 +213,10 @@ def merkle_parent(hash_a, hash_b):
 
 # Given an ordered list of hashes, returns a list with the parents of each pair.
 def merkle_parent_level(hashes):
-    # If list has an odd number of hashes, we duplicate the last one.
+    # If list has an odd number of hashes, we duplicate the last one. A new list is made so the caller's
+    # list isn't changed.
     if (len(hashes) % 2 == 1):
-        hashes.append(hashes[-1])
+        hashes = hashes + [hashes[-1]]
     parent_level = []
     # We loop skipping by two each time.
     for i in range(0, len(hashes), 2):
@@ -221,7 +230,7 @@ def merkle_root(hashes):
     # We loop until there's only 1 hash left, the merkle root.
     while len(hashes) > 1:
         hashes = merkle_parent_level(hashes)
-    return hashes
+    return hashes[0]
 
 
 # Used to parse the flags of a merkleblock - page 205.
@@ -247,44 +256,74 @@ def bit_field_to_bytes(bit_field):
 
 
 # Hash function used in bloom filters - page 215.
-# From http://stackoverflow.com/questions/13305290/is-there-a-pure-python-implementation-of-murmurhash
+# MurmurHash3 (x86, 32 bits). The data is read as 4-byte LE blocks with struct and every step is kept to 32 bits.
+# Only the low 32 bits of seed are used, like in Bitcoin Core.
 def murmur3(data, seed=0):
     c1 = 0xcc9e2d51
     c2 = 0x1b873593
+    mask = 0xffffffff
     length = len(data)
-    h1 = seed
-    roundedEnd = (length & 0xfffffffc)  # round down to 4 byte block
-    for i in range(0, roundedEnd, 4):
-        # little endian load order
-        k1 = (data[i] & 0xff) | ((data[i + 1] & 0xff) << 8) | \
-            ((data[i + 2] & 0xff) << 16) | (data[i + 3] << 24)
-        k1 *= c1
-        k1 = (k1 << 15) | ((k1 & 0xffffffff) >> 17)  # ROTL32(k1,15)
-        k1 *= c2
-        h1 ^= k1
-        h1 = (h1 << 13) | ((h1 & 0xffffffff) >> 19)  # ROTL32(h1,13)
-        h1 = h1 * 5 + 0xe6546b64
+    h1 = seed & mask
+    rounded_end = length & 0xfffffffc  # round down to 4 byte block
+    for (k1,) in struct.iter_unpack('<I', memoryview(data)[:rounded_end]):
+        k1 = (k1 * c1) & mask
+        k1 = ((k1 << 15) | (k1 >> 17)) & mask  # ROTL32(k1,15)
+        h1 ^= (k1 * c2) & mask
+        h1 = ((h1 << 13) | (h1 >> 19)) & mask  # ROTL32(h1,13)
+        h1 = (h1 * 5 + 0xe6546b64) & mask
     # tail
-    k1 = 0
-    val = length & 0x03
-    if val == 3:
-        k1 = (data[roundedEnd + 2] & 0xff) << 16
-    # fallthrough
-    if val in [2, 3]:
-        k1 |= (data[roundedEnd + 1] & 0xff) << 8
-    # fallthrough
-    if val in [1, 2, 3]:
-        k1 |= data[roundedEnd] & 0xff
-        k1 *= c1
-        k1 = (k1 << 15) | ((k1 & 0xffffffff) >> 17)  # ROTL32(k1,15)
-        k1 *= c2
-        h1 ^= k1
+    tail = length & 3
+    if tail:
+        k1 = int.from_bytes(data[rounded_end:], 'little')
+        k1 = (k1 * c1) & mask
+        k1 = ((k1 << 15) | (k1 >> 17)) & mask  # ROTL32(k1,15)
+        h1 ^= (k1 * c2) & mask
     # finalization
     h1 ^= length
     # fmix(h1)
-    h1 ^= ((h1 & 0xffffffff) >> 16)
-    h1 *= 0x85ebca6b
-    h1 ^= ((h1 & 0xffffffff) >> 13)
-    h1 *= 0xc2b2ae35
-    h1 ^= ((h1 & 0xffffffff) >> 16)
-    return h1 & 0xffffffff
+    h1 ^= h1 >> 16
+    h1 = (h1 * 0x85ebca6b) & mask
+    h1 ^= h1 >> 13
+    h1 = (h1 * 0xc2b2ae35) & mask
+    h1 ^= h1 >> 16
+    return h1
+
+
+# SipHash-2-4 of data with a 16-byte key, as an int. Used for the short ids of compact blocks (BIP152).
+# From the reference implementation at https://github.com/veorq/SipHash
+def siphash(key, data):
+    mask = 0xffffffffffffffff
+    k0 = int.from_bytes(key[:8], 'little')
+    k1 = int.from_bytes(key[8:16], 'little')
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    length = len(data)
+    end = length - length % 8
+    # the message is read as 8-byte LE words, the last one padded with zeros and the length in its top byte.
+    words = [int.from_bytes(data[i:i + 8], 'little') for i in range(0, end, 8)]
+    words.append(int.from_bytes(data[end:], 'little') | (length & 0xff) << 56)
+
+    def sipround(v0, v1, v2, v3):
+        v0 = (v0 + v1) & mask
+        v1 = ((v1 << 13) | (v1 >> 51)) & mask ^ v0
+        v0 = ((v0 << 32) | (v0 >> 32)) & mask
+        v2 = (v2 + v3) & mask
+        v3 = ((v3 << 16) | (v3 >> 48)) & mask ^ v2
+        v0 = (v0 + v3) & mask
+        v3 = ((v3 << 21) | (v3 >> 43)) & mask ^ v0
+        v2 = (v2 + v1) & mask
+        v1 = ((v1 << 17) | (v1 >> 47)) & mask ^ v2
+        v2 = ((v2 << 32) | (v2 >> 32)) & mask
+        return v0, v1, v2, v3
+
+    for m in words:
+        v3 ^= m
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0 ^= m
+    v2 ^= 0xff
+    for _ in range(4):
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
@@ -0,0 +1,420 @@
+import heapq
+import time
+
+from itertools import count
+from unittest import TestCase
+
+from script import Script, p2pkh_script
+from tx import Tx, TxIn, TxOut
+from utxo import UtxoSet
+
+# default memory budget, in bytes of serialized transactions.
+DEFAULT_MAX_SIZE = 300 * 1000 * 1000
+# default package limits, same as Bitcoin Core: a transaction with its ancestors, or with its descendants,
+# can't be more than 25 transactions or 101 kvB.
+DEFAULT_MAX_ANCESTORS = 25
+DEFAULT_MAX_ANCESTOR_SIZE = 101 * 1000
+DEFAULT_MAX_DESCENDANTS = 25
+DEFAULT_MAX_DESCENDANT_SIZE = 101 * 1000
+
+
+# A transaction in the mempool, with its fee and the totals of its package: the transaction with all its
+# unconfirmed ancestors, and with all its descendants.
+class MempoolEntry:
+
+    __slots__ = ('tx', 'txid', 'fee', 'vsize', 'size', 'time', 'parents', 'children',
+                 'ancestor_fee', 'ancestor_vsize', 'ancestor_count',
+                 'descendant_fee', 'descendant_vsize', 'descendant_count', 'heap_key')
+
+    def __init__(self, tx, txid, fee, time):
+        self.tx = tx
+        self.txid = txid
+        self.fee = fee
+        self.vsize = tx.vsize()
+        self.size = tx.size()
+        self.time = time
+        # txids of the transactions in the mempool it spends from and that spend from it.
+        self.parents = set()
+        self.children = set()
+        # the totals include the transaction itself.
+        self.ancestor_fee = fee
+        self.ancestor_vsize = self.vsize
+        self.ancestor_count = 1
+        self.descendant_fee = fee
+        self.descendant_vsize = self.vsize
+        self.descendant_count = 1
+        # the key of its current item in the eviction heap.
+        self.heap_key = None
+
+    def __repr__(self):
+        return 'MempoolEntry({}, {} sat, {} vB)'.format(self.txid.hex(), self.fee, self.vsize)
+
+    # fee rate in satoshis per virtual byte.
+    def fee_rate(self):
+        return self.fee / self.vsize
+
+    # fee rate of the transaction with its ancestors, what a miner gets for including it.
+    def ancestor_fee_rate(self):
+        return self.ancestor_fee / self.ancestor_vsize
+
+    # Score used for eviction, like Bitcoin Core: the best of the fee rate of the transaction alone and with
+    # its descendants, so a transaction isn't evicted if a child pays for it.
+    def descendant_score(self):
+        return max(self.fee / self.vsize, self.descendant_fee / self.descendant_vsize)
+
+
+# Unconfirmed transactions by txid, with the outpoints they spend to find conflicts.
+# The entries are kept in a heap by descendant score, so adding a transaction and evicting the one with the
+# lowest score are O(log n). Scores change when descendants are added or removed: a new heap item is pushed
+# and the old one is skipped when it comes up (lazy deletion).
+# prevout_provider is anything with a get(txid, index) method returning the output (or None), like UtxoSet,
+# used to find the outputs spent that aren't in the mempool. max_size is the budget in bytes of serialized
+# transactions, over it the transactions with the lowest descendant score are evicted with their descendants.
+# The package limits are counted in transactions and virtual bytes and include the transaction itself.
+class Mempool:
+
+    def __init__(self, prevout_provider=None, max_size=DEFAULT_MAX_SIZE,
+                 max_ancestors=DEFAULT_MAX_ANCESTORS, max_ancestor_size=DEFAULT_MAX_ANCESTOR_SIZE,
+                 max_descendants=DEFAULT_MAX_DESCENDANTS, max_descendant_size=DEFAULT_MAX_DESCENDANT_SIZE):
+        self.prevout_provider = prevout_provider
+        self.max_size = max_size
+        self.max_ancestors = max_ancestors
+        self.max_ancestor_size = max_ancestor_size
+        self.max_descendants = max_descendants
+        self.max_descendant_size = max_descendant_size
+        # txid -> MempoolEntry.
+        self.entries = {}
+        # (txid, index) -> txid of the transaction in the mempool spending it.
+        self.spent = {}
+        # total size of the transactions.
+        self.usage = 0
+        # (descendant score, sequence, txid), the sequence makes keys unique.
+        self.heap = []
+        self.sequence = count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    # yields the transactions, so the mempool can be the pool of CmpctBlockMessage.reconstruct.
+    def __iter__(self):
+        for entry in list(self.entries.values()):
+            yield entry.tx
+
+    # returns the MempoolEntry of txid or None.
+    def get(self, txid):
+        return self.entries.get(txid)
+
+    # returns the txids of the transactions in the mempool spending any of the outpoints tx spends.
+    def conflicts(self, tx):
+        result = set()
+        for tx_in in tx.tx_inputs:
+            txid = self.spent.get((tx_in.prev_tx, tx_in.prev_index))
+            if txid is not None:
+                result.add(txid)
+        return result
+
+    # returns the txids of the ancestors of the entry in the mempool, not including itself.
+    def ancestors(self, entry):
+        return self._walk(entry, 'parents')
+
+    # returns the txids of the descendants of the entry in the mempool, not including itself.
+    def descendants(self, entry):
+        return self._walk(entry, 'children')
+
+    def _walk(self, entry, links):
+        result = set()
+        stack = list(getattr(entry, links))
+        while stack:
+            txid = stack.pop()
+            if txid not in result:
+                result.add(txid)
+                stack.extend(getattr(self.entries[txid], links))
+        return result
+
+    # returns the output an input spends, from a transaction in the mempool or from the prevout provider.
+    def _prevout(self, tx_in):
+        parent = self.entries.get(tx_in.prev_tx)
+        if parent is not None:
+            if tx_in.prev_index >= len(parent.tx.tx_outputs):
+                raise RuntimeError('output {}:{} does not exist'.format(tx_in.prev_tx.hex(), tx_in.prev_index))
+            return parent.tx.tx_outputs[tx_in.prev_index]
+        if self.prevout_provider is not None:
+            prevout = self.prevout_provider.get(tx_in.prev_tx, tx_in.prev_index)
+        else:
+            prevout = tx_in.prevout
+        if prevout is None:
+            raise RuntimeError('missing or spent output {}:{}'.format(tx_in.prev_tx.hex(), tx_in.prev_index))
+        return prevout
+
+    def _push(self, entry):
+        entry.heap_key = (entry.descendant_score(), next(self.sequence), entry.txid)
+        heapq.heappush(self.heap, entry.heap_key)
+        # stale items are dropped when they are too many.
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [entry.heap_key for entry in self.entries.values()]
+            heapq.heapify(self.heap)
+
+    # Adds a transaction. Its inputs must spend outputs of transactions in the mempool or of the prevout provider.
+    # Scripts are not checked here. Raises RuntimeError if it's already in the mempool, spends the same output
+    # twice, conflicts with a transaction in it, spends missing outputs, pays more than it spends or exceeds the package limits, its
+    # own or those of an ancestor. Returns False if it was evicted right away because the mempool is full and
+    # its score is the lowest, True otherwise.
+    def add(self, tx, now=None):
+        txid = tx.hash()
+        if txid in self.entries:
+            raise RuntimeError('{} is already in the mempool'.format(txid.hex()))
+        if tx.is_coinbase():
+            raise RuntimeError('coinbase transactions can not be in the mempool')
+        # an input repeated would count its amount twice in the fee.
+        outpoints = {(tx_in.prev_tx, tx_in.prev_index) for tx_in in tx.tx_inputs}
+        if len(outpoints) < len(tx.tx_inputs):
+            raise RuntimeError('{} has duplicate inputs'.format(txid.hex()))
+        conflicts = self.conflicts(tx)
+        if conflicts:
+            raise RuntimeError('{} conflicts with {}'.format(txid.hex(), ', '.join(c.hex() for c in conflicts)))
+        total_input = sum(self._prevout(tx_in).amount for tx_in in tx.tx_inputs)
+        fee = total_input - sum(tx_out.amount for tx_out in tx.tx_outputs)
+        if fee < 0:
+            raise RuntimeError('{} spends more than its inputs'.format(txid.hex()))
+        entry = MempoolEntry(tx, txid, fee, time.time() if now is None else now)
+        for tx_in in tx.tx_inputs:
+            if tx_in.prev_tx in self.entries:
+                entry.parents.add(tx_in.prev_tx)
+        ancestors = [self.entries[ancestor_txid] for ancestor_txid in self.ancestors(entry)]
+        self._check_limits(entry, ancestors)
+        self.entries[txid] = entry
+        for tx_in in tx.tx_inputs:
+            self.spent[(tx_in.prev_tx, tx_in.prev_index)] = txid
+        for parent in entry.parents:
+            self.entries[parent].children.add(txid)
+        for ancestor in ancestors:
+            entry.ancestor_fee += ancestor.fee
+            entry.ancestor_vsize += ancestor.vsize
+            entry.ancestor_count += 1
+            ancestor.descendant_fee += fee
+            ancestor.descendant_vsize += entry.vsize
+            ancestor.descendant_count += 1
+            self._push(ancestor)
+        self._push(entry)
+        self.usage += entry.size
+        self.trim()
+        return txid in self.entries
+
+    # Raises RuntimeError if adding entry, with the given ancestors, exceeds a package limit.
+    def _check_limits(self, entry, ancestors):
+        txid = entry.txid.hex()
+        if len(ancestors) + 1 > self.max_ancestors:
+            raise RuntimeError('{} has too many unconfirmed ancestors: {}'.format(txid, len(ancestors)))
+        ancestor_vsize = entry.vsize + sum(ancestor.vsize for ancestor in ancestors)
+        if ancestor_vsize > self.max_ancestor_size:
+            raise RuntimeError('{} with its ancestors is too large: {} vB'.format(txid, ancestor_vsize))
+        for ancestor in ancestors:
+            if ancestor.descendant_count + 1 > self.max_descendants:
+                raise RuntimeError('{} would have too many descendants'.format(ancestor.txid.hex()))
+            if ancestor.descendant_vsize + entry.vsize > self.max_descendant_size:
+                raise RuntimeError('{} with its descendants would be too large'.format(ancestor.txid.hex()))
+
+    # Removes a transaction, and its descendants with descendants=True, and returns the removed txids.
+    # Does nothing if it's not in the mempool.
+    def remove(self, txid, descendants=True):
+        entry = self.entries.get(txid)
+        if entry is None:
+            return []
+        removed = [txid]
+        if descendants:
+            removed += self.descendants(entry)
+            # children go before their parents, so the ancestors of every entry are still linked to it.
+            removed.sort(key=lambda removed_txid: self.entries[removed_txid].ancestor_count, reverse=True)
+        for removed_txid in removed:
+            self._remove_entry(self.entries[removed_txid])
+        return removed
+
+    # Removes one entry, updating the package totals of its ancestors and descendants.
+    def _remove_entry(self, entry):
+        txid = entry.txid
+        for ancestor_txid in self.ancestors(entry):
+            ancestor = self.entries[ancestor_txid]
+            ancestor.descendant_fee -= entry.fee
+            ancestor.descendant_vsize -= entry.vsize
+            ancestor.descendant_count -= 1
+            self._push(ancestor)
+        for descendant_txid in self.descendants(entry):
+            descendant = self.entries[descendant_txid]
+            descendant.ancestor_fee -= entry.fee
+            descendant.ancestor_vsize -= entry.vsize
+            descendant.ancestor_count -= 1
+        for parent in entry.parents:
+            self.entries[parent].children.discard(txid)
+        for child in entry.children:
+            self.entries[child].parents.discard(txid)
+        for tx_in in entry.tx.tx_inputs:
+            outpoint = (tx_in.prev_tx, tx_in.prev_index)
+            if self.spent.get(outpoint) == txid:
+                del self.spent[outpoint]
+        del self.entries[txid]
+        self.usage -= entry.size
+
+    # Returns the entry with the lowest descendant score, or None if the mempool is empty.
+    def lowest(self):
+        heap = self.heap
+        while heap:
+            key = heap[0]
+            entry = self.entries.get(key[2])
+            if entry is not None and entry.heap_key == key:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    # Evicts the entries with the lowest descendant score, with their descendants, until the mempool fits in
+    # max_size. Returns the evicted txids.
+    def trim(self):
+        evicted = []
+        while self.usage > self.max_size:
+            lowest = self.lowest()
+            if lowest is None:
+                break
+            evicted += self.remove(lowest.txid)
+        return evicted
+
+    # Removes the transactions of a block that was connected, keeping their descendants, and the
+    # transactions that conflict with them, with their descendants. Returns the txids removed because of
+    # conflicts.
+    def remove_for_block(self, block_message):
+        conflicted = []
+        for tx in block_message.txns:
+            txid = tx.hash()
+            if txid in self.entries:
+                self.remove(txid, descendants=False)
+            if not tx.is_coinbase():
+                for conflict in self.conflicts(tx):
+                    conflicted += self.remove(conflict)
+        return conflicted
+
+    # Returns the entries by ancestor fee rate, best first, the order a miner would pick them in.
+    def by_ancestor_fee_rate(self):
+        return sorted(self.entries.values(), key=lambda entry: (-entry.ancestor_fee_rate(), entry.time))
+
+
+class MempoolTest(TestCase):
+
+    def setUp(self):
+        self.script_pubkey = p2pkh_script(bytes(20))
+        self.utxo_set = UtxoSet()
+        self.funding = [bytes([i]) * 32 for i in range(1, 6)]
+        for prev_tx in self.funding:
+            self.utxo_set.add(prev_tx, 0, TxOut(100000, self.script_pubkey), 1)
+        self.mempool = Mempool(self.utxo_set)
+
+    # a transaction spending (txid, index) outpoints, with one output of amount per entry in amounts.
+    def tx(self, outpoints, amounts, tag=0):
+        tx_ins = [TxIn(prev_tx, index, Script([bytes([tag]) * 10])) for prev_tx, index in outpoints]
+        return Tx(1, tx_ins, [TxOut(amount, self.script_pubkey) for amount in amounts], 0)
+
+    def test_packages(self):
+        parent = self.tx([(self.funding[0], 0)], [50000, 40000])
+        self.assertTrue(self.mempool.add(parent))
+        child = self.tx([(parent.hash(), 0)], [30000])
+        grandchild = self.tx([(child.hash(), 0)], [10000])
+        self.mempool.add(child)
+        self.mempool.add(grandchild)
+        entry = self.mempool.get(parent.hash())
+        self.assertEqual(entry.fee, 10000)
+        self.assertEqual((entry.descendant_count, entry.descendant_fee), (3, 50000))
+        self.assertEqual(entry.descendant_vsize, parent.vsize() + child.vsize() + grandchild.vsize())
+        last = self.mempool.get(grandchild.hash())
+        self.assertEqual((last.ancestor_count, last.ancestor_fee), (3, 50000))
+        self.assertEqual(self.mempool.descendants(entry), {child.hash(), grandchild.hash()})
+        # a missing output, a conflict and an output that doesn't exist.
+        with self.assertRaisesRegex(RuntimeError, 'missing'):
+            self.mempool.add(self.tx([(b'\xff' * 32, 0)], [1]))
+        with self.assertRaisesRegex(RuntimeError, 'conflicts'):
+            self.mempool.add(self.tx([(parent.hash(), 0)], [1]))
+        with self.assertRaisesRegex(RuntimeError, 'does not exist'):
+            self.mempool.add(self.tx([(parent.hash(), 2)], [1]))
+        with self.assertRaisesRegex(RuntimeError, 'already'):
+            self.mempool.add(child)
+        with self.assertRaisesRegex(RuntimeError, 'duplicate inputs'):
+            self.mempool.add(self.tx([(parent.hash(), 1), (parent.hash(), 1)], [70000]))
+        self.assertNotIn((parent.hash(), 1), self.mempool.spent)
+        # removing the child removes the grandchild too and updates the parent.
+        self.assertEqual(set(self.mempool.remove(child.hash())), {child.hash(), grandchild.hash()})
+        self.assertEqual((entry.descendant_count, entry.descendant_fee, entry.children), (1, 10000, set()))
+        self.assertEqual(self.mempool.conflicts(child), set())
+        self.assertEqual(len(self.mempool), 1)
+        self.assertEqual(self.mempool.usage, parent.size())
+
+    def test_eviction(self):
+        txs = [self.tx([(prev_tx, 0)], [100000 - (i + 1) * 1000]) for i, prev_tx in enumerate(self.funding[:4])]
+        for tx in txs:
+            self.mempool.add(tx)
+        # the lowest fee rate is the first one, unless a child pays for it.
+        self.assertEqual(self.mempool.lowest().txid, txs[0].hash())
+        child = self.tx([(txs[0].hash(), 0)], [99000 - 20000])
+        self.mempool.add(child)
+        self.assertEqual(self.mempool.lowest().txid, txs[1].hash())
+        self.assertEqual([entry.txid for entry in self.mempool.by_ancestor_fee_rate()][:2],
+                         [child.hash(), txs[3].hash()])
+        # a budget for 4 of the 5 transactions evicts the lowest.
+        self.mempool.max_size = self.mempool.usage - 1
+        self.assertEqual(self.mempool.trim(), [txs[1].hash()])
+        # a transaction that would be evicted right away isn't kept.
+        self.mempool.max_size = self.mempool.usage
+        self.assertFalse(self.mempool.add(self.tx([(self.funding[4], 0)], [99999])))
+        self.assertEqual(len(self.mempool), 4)
+        self.assertEqual({tx.hash() for tx in self.mempool}, {txs[0].hash(), txs[2].hash(), txs[3].hash(),
+                                                              child.hash()})
+
+    def test_remove_for_block(self):
+        from network import BlockMessage
+        parent = self.tx([(self.funding[0], 0)], [90000])
+        child = self.tx([(parent.hash(), 0)], [80000])
+        other = self.tx([(self.funding[1], 0)], [90000])
+        other_child = self.tx([(other.hash(), 0)], [80000])
+        for tx in (parent, child, other, other_child):
+            self.mempool.add(tx)
+        # the block confirms parent and a transaction spending the same output as other.
+        double_spend = self.tx([(self.funding[1], 0)], [95000], tag=1)
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x01']))], [TxOut(1, self.script_pubkey)], 0)
+        block = BlockMessage(1, b'\x00' * 32, b'\x00' * 32, 0, b'\xff\xff\x00\x1d', b'\x00' * 4, 3,
+                             [coinbase, parent, double_spend])
+        self.assertEqual(set(self.mempool.remove_for_block(block)), {other.hash(), other_child.hash()})
+        self.assertEqual(list(self.mempool.entries), [child.hash()])
+        entry = self.mempool.get(child.hash())
+        self.assertEqual((entry.ancestor_count, entry.ancestor_fee, entry.parents), (1, 10000, set()))
+
+    def test_package_limits(self):
+        self.mempool.max_ancestors = 3
+        self.mempool.max_descendants = 4
+        chain = [self.tx([(self.funding[0], 0)], [90000, 1000])]
+        for i in range(2):
+            chain.append(self.tx([(chain[-1].hash(), 0)], [80000 - i * 10000, 1000]))
+        for tx in chain:
+            self.mempool.add(tx)
+        # a fourth transaction in the chain has 3 ancestors.
+        with self.assertRaisesRegex(RuntimeError, 'too many unconfirmed ancestors'):
+            self.mempool.add(self.tx([(chain[-1].hash(), 0)], [50000]))
+        self.assertEqual(len(self.mempool), 3)
+        # the first transaction can have one more descendant, but not two.
+        self.mempool.add(self.tx([(chain[0].hash(), 1)], [500]))
+        with self.assertRaisesRegex(RuntimeError, 'too many descendants'):
+            self.mempool.add(self.tx([(chain[1].hash(), 1)], [500]))
+        # sizes are limited too.
+        mempool = Mempool(self.utxo_set, max_ancestor_size=chain[0].vsize() + chain[1].vsize() - 1)
+        mempool.add(chain[0])
+        with self.assertRaisesRegex(RuntimeError, 'too large'):
+            mempool.add(chain[1])
+        mempool = Mempool(self.utxo_set, max_descendant_size=chain[0].vsize() + chain[1].vsize())
+        mempool.add(chain[0])
+        mempool.add(chain[1])
+        with self.assertRaisesRegex(RuntimeError, 'would be too large'):
+            mempool.add(chain[2])
+        self.assertEqual(len(mempool), 2)
+
+    def test_trim_empty(self):
+        # a usage that isn't covered by any entry doesn't make trim fail.
+        self.mempool.usage = 1
+        self.mempool.max_size = 0
+        self.assertEqual(self.mempool.trim(), [])
@@ -0,0 +1,349 @@
+from bisect import bisect_left
+from io import BytesIO
+from unittest import TestCase
+
+from helper import bit_field_to_bytes, hash256, merkle_root
+from merkleblock import MerkleBlock
+
+
+# Computes a merkle root from leaves added one at a time, so the leaves don't have to be in a list and the
+# root of a block can be computed while its transactions are parsed.
+# Only one pending node per level is kept: pending[level] is the root of a complete subtree of 2**level
+# leaves waiting for its right sibling, so memory is O(log n).
+# Hashes are in the order they are serialized (the reverse of txids), like in helper.merkle_root.
+#
+# mutated tells whether two equal nodes were paired at some level (CVE-2012-2459): when a level has an odd
+# number of nodes the last one is paired with itself, so a list of transactions with the last ones repeated
+# has the same merkle root as the original one. Bitcoin Core treats a block like that as invalid.
+class MerkleAccumulator:
+
+    def __init__(self):
+        self.pending = []
+        self.count = 0
+        self.mutated = False
+
+    def __len__(self):
+        return self.count
+
+    # adds a leaf hash.
+    def add(self, h):
+        level = 0
+        count = self.count
+        pending = self.pending
+        # every trailing 1 bit of count is a complete subtree to the left to combine with.
+        while count & 1:
+            left = pending[level]
+            if left == h:
+                self.mutated = True
+            h = hash256(left + h)
+            pending[level] = None
+            level += 1
+            count >>= 1
+        if level == len(pending):
+            pending.append(h)
+        else:
+            pending[level] = h
+        self.count += 1
+
+    # adds a leaf given as a txid.
+    def add_txid(self, txid):
+        self.add(txid[::-1])
+
+    # Returns the merkle root of the leaves added so far, or None if there are none. The accumulator can keep
+    # receiving leaves after this.
+    def root(self):
+        pending = self.pending
+        top = len(pending) - 1
+        while top >= 0 and pending[top] is None:
+            top -= 1
+        h = None
+        for level in range(top + 1):
+            node = pending[level]
+            if h is None:
+                if node is None:
+                    continue
+                if level == top:
+                    return node
+                # the lowest subtree has no sibling, it's paired with itself.
+                h = hash256(node + node)
+            elif node is None:
+                h = hash256(h + h)
+            else:
+                if node == h:
+                    self.mutated = True
+                h = hash256(node + h)
+        return h
+
+
+# Returns the merkle root of a list of txids as it's in a block header (reversed, like the txids) and whether
+# the tree is mutated.
+def txids_merkle_root(txids):
+    accumulator = MerkleAccumulator()
+    for txid in txids:
+        accumulator.add_txid(txid)
+    root = accumulator.root()
+    return None if root is None else root[::-1], accumulator.mutated
+
+
+# Wraps BlockMessage.parse_iter and passes through what it yields, computing the merkle root as the
+# transactions come. After the last one, raises RuntimeError if the root doesn't match the header or the tree
+# is mutated:
+#
+#     items = check_merkle_root(BlockMessage.parse_iter(stream))
+#     header = next(items)
+#     for offset, txid, tx in items:
+#         ...
+def check_merkle_root(items):
+    items = iter(items)
+    header = next(items)
+    yield header
+    accumulator = MerkleAccumulator()
+    for item in items:
+        accumulator.add_txid(item[1])
+        yield item
+    root = accumulator.root()
+    if accumulator.mutated:
+        raise RuntimeError('mutated merkle tree in block {}'.format(header.hash().hex()))
+    if root is None or root[::-1] != header.merkle_root:
+        raise RuntimeError('merkle root mismatch in block {}'.format(header.hash().hex()))
+
+
+# The full merkle tree of a block, built once from its txids, to serve inclusion proofs for any of its
+# transactions: as branches (the sibling of every node on the way to the root) or as the hashes and flags
+# of a BIP37 partial merkle tree, the proof in a merkleblock message.
+# txids, roots and proof hashes are in the same order as txids, like in MerkleBlock.
+class MerkleProofTree:
+
+    def __init__(self, txids):
+        if len(txids) == 0:
+            raise ValueError('a merkle tree needs at least one transaction')
+        # levels[0] has the leaves and levels[-1] the root, all in serialized order. A level with an odd
+        # number of nodes doesn't have its last one repeated, it's paired with itself when hashing.
+        level = [txid[::-1] for txid in txids]
+        self.levels = [level]
+        while len(level) > 1:
+            last = len(level) - 1
+            level = [hash256(level[i] + level[min(i + 1, last)]) for i in range(0, len(level), 2)]
+            self.levels.append(level)
+        # txid -> position in the block.
+        self.positions = {}
+        for i, txid in enumerate(txids):
+            self.positions.setdefault(txid, i)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        return self.levels[-1][0][::-1]
+
+    # returns the position of a transaction in the block. Raises ValueError if it's not in it.
+    def index(self, txid):
+        index = self.positions.get(txid)
+        if index is None:
+            raise ValueError('{} is not in the tree'.format(txid.hex()))
+        return index
+
+    # Returns the branch of the leaf at index: the hashes to combine with it, from the leaves up to the root.
+    def branch(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('leaf {} out of range'.format(index))
+        result = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling >= len(level):
+                sibling = index
+            result.append(level[sibling][::-1])
+            index >>= 1
+        return result
+
+    # Returns (hashes, flags) of the partial merkle tree that proves the transactions at indices, like Bitcoin
+    # Core builds it: the tree is traversed depth first, a flag bit tells for every node whether it's the
+    # parent of a matched leaf and the hashes of the nodes that aren't, and of the leaves, are included.
+    def partial_tree(self, indices):
+        matches = sorted(set(indices))
+        if len(matches) > 0 and not 0 <= matches[0] <= matches[-1] < len(self):
+            raise IndexError('leaf out of range')
+        total = len(self)
+        levels = self.levels
+        flag_bits = []
+        hashes = []
+
+        def traverse(height, position):
+            start = position << height
+            end = min(start + (1 << height), total)
+            i = bisect_left(matches, start)
+            parent_of_match = i < len(matches) and matches[i] < end
+            flag_bits.append(int(parent_of_match))
+            if height == 0 or not parent_of_match:
+                hashes.append(levels[height][position][::-1])
+            else:
+                traverse(height - 1, position * 2)
+                if position * 2 + 1 < len(levels[height - 1]):
+                    traverse(height - 1, position * 2 + 1)
+
+        traverse(len(levels) - 1, 0)
+        flag_bits += [0] * (-len(flag_bits) % 8)
+        return hashes, bit_field_to_bytes(flag_bits)
+
+    # returns the MerkleBlock proving the transactions with the given txids. header is the Block.
+    def merkle_block(self, header, txids):
+        hashes, flags = self.partial_tree([self.index(txid) for txid in txids])
+        return MerkleBlock(header.version, header.prev_block, header.merkle_root, header.timestamp, header.bits,
+                           header.nonce, len(self), hashes, flags)
+
+
+# returns whether branch, as returned by MerkleProofTree.branch, proves that txid is at index in the tree of root.
+def verify_branch(txid, index, branch, root):
+    return verify_branches(root, [(txid, index, branch)])[0]
+
+
+# Verifies many branches of the same tree, a list of (txid, index, branch), and returns a list with whether
+# each one is valid. The nodes close to the root are in most of the branches, so the hash of every pair
+# of nodes is remembered and computed once for the whole batch.
+def verify_branches(root, proofs):
+    root = root[::-1]
+    # left + right -> parent.
+    parents = {}
+    results = []
+    for txid, index, branch in proofs:
+        h = txid[::-1]
+        for sibling in branch:
+            if index & 1:
+                pair = sibling[::-1] + h
+            else:
+                pair = h + sibling[::-1]
+            parent = parents.get(pair)
+            if parent is None:
+                parent = parents[pair] = hash256(pair)
+            h = parent
+            index >>= 1
+        results.append(index == 0 and h == root)
+    return results
+
+
+class MerkleAccumulatorTest(TestCase):
+
+    def test_root(self):
+        hashes = [hash256(bytes([i])) for i in range(40)]
+        for n in range(1, len(hashes) + 1):
+            leaves = hashes[:n]
+            accumulator = MerkleAccumulator()
+            for h in leaves:
+                accumulator.add(h)
+            self.assertEqual(accumulator.root(), merkle_root(leaves), n)
+            self.assertFalse(accumulator.mutated, n)
+            # the caller's list is left as it was.
+            self.assertEqual(len(leaves), n)
+        self.assertIsNone(MerkleAccumulator().root())
+
+    def test_txids(self):
+        # the hashes and the root from page 195 are in serialized order, txids are reversed.
+        txids = [bytes.fromhex(h)[::-1] for h in (
+            'c117ea8ec828342f4dfb0ad6bd140e03a50720ece40169ee38bdc15d9eb64cf5',
+            'c131474164b412e3406696da1ee20ab0fc9bf41c8f05fa8ceea7a08d672d7cc5',
+            'f391da6ecfeed1814efae39e7fcb3838ae0b02c02ae7d0a5848a66947c0727b0',
+            '3d238a92a94532b946c90e19c49351c763696cff3db400485b813aecb8a13181',
+            '10092f2633be5f3ce349bf9ddbde36caa3dd10dfa0ec8106bce23acbff637dae',
+            '7d37b3d54fa6a64869084bfd2e831309118b9e833610e6228adacdbd1b4ba161',
+            '8118a77e542892fe15ae3fc771a4abfd2f5d5d5997544c3487ac36b5c85170fc',
+            'dff6879848c2c9b62fe652720b8df5272093acfaa45a43cdb3696fe2466a3877',
+            'b825c0745f46ac58f7d3759e6dc535a1fec7820377f24d4c2c6ad2cc55c0cb59',
+            '95513952a04bd8992721e9b7e2937f1c04ba31e0469fbe615a78197f68f52b7c',
+            '2e6d722e5e4dbdf2447ddecc9f7dabb8e299bae921c99ad5b0184cd9eb8e5908',
+            'b13a750047bc0bdceb2473e5fe488c2596d7a7124b4e716fdd29b046ef99bbf0',
+        )]
+        root, mutated = txids_merkle_root(txids)
+        self.assertEqual(root[::-1].hex(), 'acbcab8bcc1af95d8d563b77d24c3d19b18f1486383d75a5085c4e86c86beed6')
+        self.assertFalse(mutated)
+        self.assertEqual(txids_merkle_root([]), (None, False))
+
+    def test_mutated(self):
+        hashes = [hash256(bytes([i])) for i in range(6)]
+        accumulator = MerkleAccumulator()
+        for h in hashes[:5]:
+            accumulator.add(h)
+        root = accumulator.root()
+        # repeating the odd last leaf gives the same root, but it's detected.
+        accumulator.add(hashes[4])
+        self.assertEqual(accumulator.root(), root)
+        self.assertTrue(accumulator.mutated)
+        # a repeated subtree at a higher level too: [0, 1, 2, 3, 4, 5, 4, 5] has the root of [0, 1, 2, 3, 4, 5].
+        accumulator = MerkleAccumulator()
+        for h in hashes + hashes[4:]:
+            accumulator.add(h)
+        self.assertEqual(accumulator.root(), merkle_root(hashes))
+        self.assertTrue(accumulator.mutated)
+
+    def test_check_merkle_root(self):
+        # network and tx import this module.
+        from network import BlockMessage
+        from script import Script, p2pkh_script
+        from tx import Tx, TxIn, TxOut
+        h160 = bytes(20)
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x01\x00\x00\x00']))],
+                      [TxOut(5000000000, p2pkh_script(h160))], 0)
+        tx_1 = Tx(1, [TxIn(coinbase.hash(), 0, Script([b'\x03' * 71]))], [TxOut(4000000000, p2pkh_script(h160))], 0)
+        tx_2 = Tx(1, [TxIn(tx_1.hash(), 0, Script([b'\x03' * 71]))], [TxOut(3000000000, p2pkh_script(h160))], 0)
+        txns = [coinbase, tx_1, tx_2]
+        root = txids_merkle_root([tx.hash() for tx in txns])[0]
+        block = BlockMessage(1, b'\x00' * 32, root, 1231006505, b'\xff\xff\x00\x1d', b'\x00' * 4, 3, txns)
+        items = check_merkle_root(BlockMessage.parse_iter(BytesIO(block.serialize())))
+        self.assertEqual(next(items).hash(), block.hash())
+        self.assertEqual([txid for offset, txid, tx in items], [tx.hash() for tx in txns])
+        # the error comes after the last transaction.
+        block.merkle_root = b'\x00' * 32
+        items = check_merkle_root(BlockMessage.parse_iter(BytesIO(block.serialize())))
+        with self.assertRaisesRegex(RuntimeError, 'merkle root mismatch'):
+            for item in items:
+                pass
+        self.assertEqual(item[1], txns[-1].hash())
+        # the last transaction repeated gives the same root.
+        block.merkle_root = root
+        block.txns.append(txns[-1])
+        with self.assertRaisesRegex(RuntimeError, 'mutated'):
+            list(check_merkle_root(BlockMessage.parse_iter(BytesIO(block.serialize()))))
+
+
+class MerkleProofTreeTest(TestCase):
+
+    def setUp(self):
+        self.txids = [hash256(bytes([i])) for i in range(13)]
+        self.tree = MerkleProofTree(self.txids)
+
+    def test_root(self):
+        for n in range(1, 14):
+            self.assertEqual(MerkleProofTree(self.txids[:n]).root(), txids_merkle_root(self.txids[:n])[0])
+
+    def test_branches(self):
+        root = self.tree.root()
+        proofs = [(txid, i, self.tree.branch(i)) for i, txid in enumerate(self.txids)]
+        for txid, i, branch in proofs:
+            self.assertEqual(len(branch), 4)
+            self.assertTrue(verify_branch(txid, i, branch, root))
+        self.assertEqual(self.tree.index(self.txids[7]), 7)
+        with self.assertRaises(ValueError):
+            self.tree.index(b'\x00' * 32)
+        # a wrong index, a wrong txid and a wrong hash in the branch.
+        bad = [
+            (self.txids[3], 2, proofs[3][2]),
+            (self.txids[4], 3, proofs[3][2]),
+            (self.txids[5], 5, proofs[5][2][:-1] + [b'\x00' * 32]),
+        ]
+        self.assertEqual(verify_branches(root, proofs + bad), [True] * 13 + [False] * 3)
+        self.assertEqual(verify_branches(root, bad + proofs), [False] * 3 + [True] * 13)
+
+    def test_partial_tree(self):
+        # block imports this module.
+        from block import Block
+        header = Block(1, b'\x00' * 32, self.tree.root(), 0, b'\xff\xff\x00\x1d', b'\x00' * 4)
+        for matched in ([], [0], [12], [3, 4, 10], list(range(13))):
+            merkle_block = self.tree.merkle_block(header, [self.txids[i] for i in matched])
+            parsed = MerkleBlock.parse(BytesIO(merkle_block.serialize()))
+            self.assertEqual(parsed.total, 13)
+            self.assertEqual(parsed.hashes, merkle_block.hashes)
+            self.assertTrue(parsed.is_valid(), matched)
+        # a single matched transaction needs its hash and the hashes of the subtrees next to its path.
+        hashes, flags = self.tree.partial_tree([12])
+        branch = self.tree.branch(12)
+        self.assertEqual(hashes, [branch[3], branch[2], self.txids[12]])
+        self.assertEqual(flags, bytes([0b1110101]))
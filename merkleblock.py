@@ -1,9 +1,10 @@
-import math
-
 from io import BytesIO
 from unittest import TestCase
 
 from helper import (
+    encode_varint,
+    hash256,
+    int_to_little_endian,
     little_endian_to_int,
     merkle_parent,
     read_varint,
@@ -17,14 +18,15 @@ class MerkleTree:
     def __init__(self, total):
         self.total = total
         # Since we halve at every level, log2 of the number of levels is how many levels there are in the merkle tree - page 199.
-        self.max_depth = math.ceil(math.log(self.total, 2))
+        # It's computed with integers, ceil(log2(total)) is the number of bits of total - 1.
+        self.max_depth = (self.total - 1).bit_length()
         # The merkle tree will hold the root at index 0, the level below at index 1 and so on.
         self.nodes = []
         # There are 0 to max_depth levels in this merkle tree.
         for depth in range(self.max_depth + 1):
             # At any particular level, the number of nodes is the number of total leaves divided by 2
             # for every level above the leaf level.
-            num_items = math.ceil(self.total / 2**(self.max_depth - depth))
+            num_items = -(-self.total // 2**(self.max_depth - depth))
             # We don't know yet what any of the hashes are, so we set them to None.
             level_hashes = [None] * num_items
             # self.nodes will be a list of lists, or a 2-dimensional array.
@@ -101,15 +103,24 @@ class MerkleTree:
 
     # Find the merkle root given a flag bits list and a hashes list - page 209.
     # For a detailed explanation on how flag bits work see page 207.
+    # flag_bits and hashes are read with a cursor instead of being consumed, so the lists are left as they are.
+    # Returns the hashes of the leaves whose flag bit is 1, the matched transactions.
     def populate_tree(self, flag_bits, hashes):
+        # Index of the next flag bit and the next hash to use.
+        flag_index = 0
+        hash_index = 0
+        matches = []
         # Loop until the root is calculated.
         while self.root() is None:
             # For leaf nodes, we are always given the hash.
             if self.is_leaf():
-                # We remove the flag bit corresponding to this node.
-                flag_bits.pop(0)
-                # The hash at index 0 is the hash for this node.
-                self.set_current_node(hashes.pop(0))
+                # If the leaf's flag bit is a 1, it's one of the transactions we are interested in.
+                if flag_bits[flag_index] == 1:
+                    matches.append(hashes[hash_index])
+                flag_index += 1
+                # The next hash is the hash for this node.
+                self.set_current_node(hashes[hash_index])
+                hash_index += 1
                 self.up()
             else:
                 left_hash = self.get_left_node()
@@ -118,8 +129,10 @@ class MerkleTree:
                 if left_hash is None:
                     # The next flag bit tells us whether we need to calculate this node or it is given to us.
                     # If the bit is a 0, it's hash is given to us. If it's a 1, we need to calculate it.
-                    if flag_bits.pop(0) == 0:
-                        self.set_current_node(hashes.pop(0))
+                    flag_index += 1
+                    if flag_bits[flag_index - 1] == 0:
+                        self.set_current_node(hashes[hash_index])
+                        hash_index += 1
                         # Now that we have set the value, we can go up and start working on the other side
                         # of the tree.
                         self.up()
@@ -144,12 +157,73 @@ class MerkleTree:
                     self.set_current_node(merkle_parent(left_hash, left_hash))
                     self.up()
         # All hashes must be consumed.
-        if len(hashes) != 0:
+        if hash_index != len(hashes):
             raise RuntimeError("Not all hashes were consumed.")
         # All flag bits must be consumed.
-        for flag_bit in flag_bits:
+        for flag_bit in flag_bits[flag_index:]:
             if flag_bit != 0:
                 raise RuntimeError("All flag bits must be consumed.")
+        return matches
+
+
+# Computes the root of a partial merkle tree without building the tree: it's traversed depth first, like
+# Bitcoin Core does, so only the nodes on the current path are kept. Flag bits are read straight from the
+# flags bytes of the message and hashes by index. hashes, the root and the matched txids are in the order of
+# txids, like in MerkleBlock.
+# Returns (root, txids of the matched transactions). Raises RuntimeError if the proof is malformed.
+def partial_merkle_root(total, hashes, flags):
+    if total == 0:
+        raise RuntimeError('merkle tree with no transactions')
+    if len(hashes) > total:
+        raise RuntimeError('more hashes than transactions')
+    num_flags = len(flags) * 8
+    # index of the next flag bit and the next hash.
+    flag_index = 0
+    hash_index = 0
+    matches = []
+
+    def traverse(height):
+        nonlocal flag_index, hash_index
+        if flag_index >= num_flags:
+            raise RuntimeError('not enough flag bits')
+        flag = flags[flag_index >> 3] >> (flag_index & 7) & 1
+        flag_index += 1
+        if height == 0 or not flag:
+            if hash_index >= len(hashes):
+                raise RuntimeError('not enough hashes')
+            h = hashes[hash_index]
+            hash_index += 1
+            if height == 0 and flag:
+                matches.append(h)
+            return h[::-1]
+        return None
+
+    # Nodes are identified by their height and position at that level, the number of nodes at a level is
+    # total / 2**height rounded up.
+    def node(height, position):
+        h = traverse(height)
+        if h is not None:
+            return h
+        left = node(height - 1, position * 2)
+        if position * 2 + 1 < -(-total // 2**(height - 1)):
+            right = node(height - 1, position * 2 + 1)
+            # the same hash on both sides would make the tree mutable (CVE-2012-2459).
+            if right == left:
+                raise RuntimeError('mutated merkle tree')
+        else:
+            right = left
+        return merkle_parent(left, right)
+
+    root = node((total - 1).bit_length(), 0)
+    if hash_index != len(hashes):
+        raise RuntimeError('Not all hashes were consumed.')
+    # the flag bits left are the padding of the last byte.
+    if (flag_index + 7) // 8 != len(flags):
+        raise RuntimeError('All flag bits must be consumed.')
+    for i in range(flag_index, num_flags):
+        if flags[i >> 3] >> (i & 7) & 1:
+            raise RuntimeError('All flag bits must be consumed.')
+    return root[::-1], matches
 
 
 # The full node sends all the info. needed to verify an interesting transaction using a merkle block.
@@ -191,10 +265,76 @@ class MerkleBlock:
         flags = stream.read(flags_length)
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce, total, hashes, flags)
 
+    # Returns the payload of the message. Opposite from parse.
+    def serialize(self):
+        result = int_to_little_endian(self.version, 4)
+        result += self.prev_block[::-1]
+        result += self.merkle_root[::-1]
+        result += int_to_little_endian(self.timestamp, 4)
+        result += self.bits
+        result += self.nonce
+        result += int_to_little_endian(self.total, 4)
+        result += encode_varint(len(self.hashes))
+        for h in self.hashes:
+            result += h[::-1]
+        result += encode_varint(len(self.flags))
+        result += self.flags
+        return result
+
     # Returns whether merkle root is valid for proof of inclusion given.
     def is_valid(self):
-        flag_bits = bytes_to_bit_field(self.flags)
-        hashes = [h[::-1] for h in self.hashes]
-        merkle_tree = MerkleTree(self.total)
-        merkle_tree.populate_tree(flag_bits, hashes)
-        return merkle_tree.root()[::-1] == self.merkle_root
+        return self.extract()[0]
+
+    # Returns (whether the merkle root is valid, txids of the transactions the proof is for).
+    # Raises RuntimeError if the proof is malformed.
+    def extract(self):
+        root, matches = partial_merkle_root(self.total, self.hashes, self.flags)
+        if root != self.merkle_root:
+            return False, []
+        return True, matches
+
+
+class MerkleBlockTest(TestCase):
+
+    def test_extract(self):
+        # merkle imports this module.
+        from merkle import MerkleProofTree
+        txids = [hash256(bytes([i])) for i in range(13)]
+        tree = MerkleProofTree(txids)
+        root = tree.root()
+        for matched in ([], [0], [12], [3, 4, 10], list(range(13))):
+            hashes, flags = tree.partial_tree(matched)
+            merkle_block = MerkleBlock(1, b'\x00' * 32, root, 0, b'\xff\xff\x00\x1d', b'\x00' * 4, 13, hashes, flags)
+            merkle_block = MerkleBlock.parse(BytesIO(merkle_block.serialize()))
+            self.assertEqual(merkle_block.extract(), (True, [txids[i] for i in matched]))
+            # the book's traversal gives the same root and matches, and leaves the lists as they were.
+            flag_bits = bytes_to_bit_field(flags)
+            internal = [h[::-1] for h in hashes]
+            merkle_tree = MerkleTree(13)
+            self.assertEqual(merkle_tree.populate_tree(flag_bits, internal), [txids[i][::-1] for i in matched])
+            self.assertEqual(merkle_tree.root()[::-1], root)
+            self.assertEqual(len(internal), len(hashes))
+        hashes, flags = tree.partial_tree([3, 4])
+        merkle_block = MerkleBlock(1, b'\x00' * 32, b'\x00' * 32, 0, b'\xff\xff\x00\x1d', b'\x00' * 4, 13,
+                                   hashes, flags)
+        self.assertEqual(merkle_block.extract(), (False, []))
+        with self.assertRaisesRegex(RuntimeError, 'hashes'):
+            partial_merkle_root(13, hashes[:-1], flags)
+        with self.assertRaisesRegex(RuntimeError, 'consumed'):
+            partial_merkle_root(13, hashes + hashes[:1], flags)
+        with self.assertRaisesRegex(RuntimeError, 'consumed'):
+            partial_merkle_root(13, hashes, flags + b'\x00')
+        # a tree with the last transaction repeated.
+        hashes, flags = MerkleProofTree(txids + txids[-1:]).partial_tree([13])
+        with self.assertRaisesRegex(RuntimeError, 'mutated'):
+            partial_merkle_root(14, hashes, flags)
+
+    def test_large(self):
+        from merkle import MerkleProofTree
+        txids = [hash256(i.to_bytes(4, 'little')) for i in range(5000)]
+        tree = MerkleProofTree(txids)
+        matched = list(range(0, 5000, 7))
+        hashes, flags = tree.partial_tree(matched)
+        root, matches = partial_merkle_root(5000, hashes, flags)
+        self.assertEqual(root, tree.root())
+        self.assertEqual(matches, [txids[i] for i in matched])
@@ -253,16 +253,18 @@ class GetHeadersMessage:
 
     command = b'getheaders'
 
-    def __init__(self, version=70015, num_hashes=1, start_block=None, end_block=None):
+    def __init__(self, version=70015, start_block=None, end_block=None, locator=None):
         # Identifies protocol version being used by the node.
         self.version = version
-        # We're going to assume that the number of block header groups is 1.
-        # A more robust implementation would be able to handle more than 1.
-        self.num_hashes = num_hashes
-        # Hash of the start block header.
-        if start_block is None:
-            raise RuntimeError("A start block is required.")
-        self.start_block = start_block
+        # The block locator: hashes of blocks we have, from the tip backwards. The other node replies with the
+        # headers after the first one it knows. A single start_block can be given instead.
+        if locator is None:
+            if start_block is None:
+                raise RuntimeError("A start block is required.")
+            locator = [start_block]
+        self.locator = locator
+        # Hash of the first block in the locator.
+        self.start_block = locator[0]
         # Hash of the last desired block header; set to zero to get as many blocks as possible
         if end_block is None:
             self.end_block = b'\x00' * 32
@@ -272,9 +274,10 @@ class GetHeadersMessage:
     # Returns bytes serialization of the GetHeadersMessage object.
     def serialize(self):
         result = int_to_little_endian(self.version, 4)
-        result += encode_varint(self.num_hashes)
-        # start and end block are already in bytes, so we just convert them to LE.
-        result += self.start_block[::-1]
+        result += encode_varint(len(self.locator))
+        # locator and end block are already in bytes, so we just convert them to LE.
+        for block_hash in self.locator:
+            result += block_hash[::-1]
         result += self.end_block[::-1]
         return result
 
@@ -283,9 +286,9 @@ class GetHeadersMessage:
     def parse(cls, stream):
         version = little_endian_to_int(stream.read(4))
         num_hashes = read_varint(stream)
-        start_block = stream.read(32)[::-1]
+        locator = [stream.read(32)[::-1] for _ in range(num_hashes)]
         end_block = stream.read(32)[::-1]
-        return cls(version, num_hashes, start_block, end_block)
+        return cls(version, end_block=end_block, locator=locator)
 
 
 # When we ask for some headers with a getheaders command (GetHeadersMessage), the other node will
@@ -294,24 +297,37 @@ class HeadersMessage:
 
     command = b'headers'
 
-    def __init__(self, blocks):
+    def __init__(self, blocks, raw=None):
         # List with Block objects.
         self.blocks = blocks
+        # The payload after the count, as received: every 80-byte header followed by its number of transactions,
+        # so the headers can be checked in bulk (check_headers with a stride of 81) without serializing them again.
+        self.raw = raw
 
     @classmethod
     def parse(cls, stream):
         # The headers message starts with the number of headers as a varint.
         num_headers = read_varint(stream)
+        # Every header takes 80 bytes and its number of transactions, which has to be 0, one more.
+        raw = stream.read(num_headers * 81)
+        if len(raw) != num_headers * 81:
+            raise RuntimeError('headers message is too short.')
         # We need to append each block to this list.
         blocks = []
-        for _ in range(num_headers):
-            # Each block is parsed with the Block's class parse method using the same stream.
-            blocks.append(Block.parse(stream))
+        for start in range(0, len(raw), 81):
+            # Each block is parsed with the Block's class parse method.
+            blocks.append(Block.parse(BytesIO(raw[start:start + 80])))
             # The number of txs is always 0 and is remnant of block parsing.
-            num_txs = read_varint(stream)
-            if num_txs != 0:
+            if raw[start + 80] != 0:
                 raise RuntimeError('number of transactions not 0.')
-        return cls(blocks)
+        return cls(blocks, raw)
+
+    # Returns the payload: the number of headers and every header followed by a 0 number of transactions.
+    def serialize(self):
+        result = encode_varint(len(self.blocks))
+        for block in self.blocks:
+            result += block.serialize() + b'\x00'
+        return result
 
 
 # Class to create a GenericMessage object. The command and payload can be passed as arguments to create the
@@ -373,12 +389,130 @@ class BlockMessage:
         nonce = stream.read(4)
         txn_count = read_varint(stream)
         txns = []
-        print('count', txn_count)
         for _ in range(txn_count):
             txns.append(Tx.parse(stream))
-            print('Parsed')
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce, txn_count, txns)
 
+    # Parses a block from a stream one transaction at a time. Yields the header (a Block object) first, and then
+    # (offset, txid, tx) for each transaction as soon as it's parsed, offset being its position in the block.
+    # Nothing is kept between transactions, so memory use doesn't depend on the size of the block.
+    @classmethod
+    def parse_iter(cls, stream):
+        # offsets come from the stream if it can tell its position, otherwise the bytes read are counted.
+        try:
+            start = stream.tell()
+        except (AttributeError, OSError):
+            stream = CountingStream(stream)
+            start = 0
+        header = Block.parse(stream)
+        yield header
+        txn_count = read_varint(stream)
+        for _ in range(txn_count):
+            offset = stream.tell() - start
+            tx = Tx.parse(stream)
+            yield offset, tx.hash(), tx
+
+    # returns the serialization of the whole block: the 80-byte header, the number of transactions and
+    # the transactions.
+    def serialize(self):
+        result = self.header().serialize()
+        result += encode_varint(len(self.txns))
+        for tx in self.txns:
+            result += tx.serialize()
+        return result
+
+    # returns the block header as a Block object.
+    def header(self):
+        return Block(self.version, self.prev_block, self.merkle_root, self.timestamp, self.bits, self.nonce)
+
+    # returns the hash of the block header, which identifies the block.
+    def hash(self):
+        return self.header().hash()
+
+
+# Wraps a stream that can't tell its position, like a socket, and counts the bytes read from it.
+# Tx.parse steps back over the bytes it reads to look for the segwit marker, so the last few bytes read
+# are kept and can be read again after seeking back.
+class CountingStream:
+
+    LOOKBEHIND = 8
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        # last bytes read, and bytes to return again after seeking back.
+        self.history = b''
+        self.pending = b''
+
+    def read(self, n):
+        data = b''
+        if self.pending:
+            data, self.pending = self.pending[:n], self.pending[n:]
+            n -= len(data)
+        if n > 0:
+            data += self.stream.read(n)
+        self.position += len(data)
+        self.history = (self.history + data)[-self.LOOKBEHIND:]
+        return data
+
+    # only seeking back over the last LOOKBEHIND bytes read is supported.
+    def seek(self, offset, whence=0):
+        if whence != 1 or offset > 0 or -offset > len(self.history):
+            raise OSError('can only seek back over the last {} bytes read'.format(self.LOOKBEHIND))
+        if offset < 0:
+            self.pending = self.history[offset:] + self.pending
+            self.history = self.history[:offset]
+            self.position += offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class BlockMessageTest(TestCase):
+
+    def block(self):
+        from script import Script, p2pkh_script
+        from tx import TxIn, TxOut
+        h160 = bytes(20)
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x01\x00\x00\x00']))],
+                      [TxOut(5000000000, p2pkh_script(h160))], 0)
+        tx_in = TxIn(coinbase.hash(), 0)
+        tx_in.witness = [b'\x01' * 72, b'\x02' * 33]
+        segwit = Tx(2, [tx_in], [TxOut(4000000000, Script([0x00, h160]))], 0, segwit=True)
+        legacy = Tx(1, [TxIn(segwit.hash(), 0, Script([b'\x03' * 71]))],
+                    [TxOut(3000000000, p2pkh_script(h160)), TxOut(1, p2pkh_script(h160))], 0)
+        txns = [coinbase, segwit, legacy]
+        return BlockMessage(1, b'\x00' * 32, b'\x00' * 32, 1231006505, b'\xff\xff\x00\x1d', b'\x00' * 4, 3, txns)
+
+    def test_parse_iter(self):
+        block = self.block()
+        raw = block.serialize()
+        parsed = BlockMessage.parse(BytesIO(raw))
+        self.assertEqual([tx.hash() for tx in parsed.txns], [tx.hash() for tx in block.txns])
+        offset = 81
+        expected = []
+        for tx in block.txns:
+            expected.append((offset, tx.hash(), tx.serialize()))
+            offset += len(tx.serialize())
+
+        class Unseekable:
+            def __init__(self, raw):
+                self.stream = BytesIO(raw)
+
+            def read(self, n):
+                return self.stream.read(n)
+
+        # the offsets are relative to the beginning of the block, wherever it is in the stream.
+        stream = BytesIO(b'\xff' * 10 + raw)
+        stream.read(10)
+        for stream in (stream, Unseekable(raw)):
+            items = BlockMessage.parse_iter(stream)
+            self.assertEqual(next(items).hash(), block.hash())
+            self.assertEqual([(offset, txid, tx.serialize()) for offset, txid, tx in items], expected)
+            for offset, txid, serialized in expected:
+                self.assertEqual(raw[offset:offset + len(serialized)], serialized)
+
 
 class SimpleNode:
 
@@ -431,10 +565,8 @@ class SimpleNode:
         while command not in command_to_class.keys():
             # get the next network message.
             envelope = self.read()
-            print('envelope', envelope)
             # set the command to be evaluated.
             command = envelope.command
-            print('command', command)
             # we know how to respond to version and ping, handle that here.
             if command == VersionMessage.command:
                 self.send(VerAckMessage())
@@ -4,6 +4,7 @@ from ecc import S256Point, Signature
 from logging import getLogger
 
 from unittest import TestCase
+from unittest.mock import patch
 
 from helper import (
     hash160,
@@ -12,60 +13,165 @@ from helper import (
 
 LOGGER = getLogger(__name__)
 
+# locktimes below this are block heights, above it they are timestamps - BIP65.
+LOCKTIME_THRESHOLD = 500000000
+# sequence fields used for relative lock times - BIP68.
+SEQUENCE_LOCKTIME_DISABLE_FLAG = 1 << 31
+SEQUENCE_LOCKTIME_TYPE_FLAG = 1 << 22
+SEQUENCE_LOCKTIME_MASK = 0x0000ffff
+# consensus limits of script execution.
+MAX_OPS_PER_SCRIPT = 201
+MAX_STACK_SIZE = 1000
+MAX_SCRIPT_ELEMENT_SIZE = 520
+MAX_PUBKEYS_PER_MULTISIG = 20
+
+
+# Everything an opcode may need while a script is being evaluated. All the functions in OP_CODE_TABLE
+# receive it as their only argument, the ones in STACK_OP_TABLE only get the stack.
+class ExecutionContext:
+
+    __slots__ = ('stack', 'altstack', 'z', 'locktime', 'sequence', 'version', 'cmds', 'ip', 'jumps', 'budget')
+
+    def __init__(self, z=None, locktime=None, sequence=None, version=None, budget=None):
+        self.stack = []
+        self.altstack = []
+        # signature hash, used by the signature checking opcodes.
+        self.z = z
+        self.locktime = locktime
+        self.sequence = sequence
+        self.version = version
+        # commands being executed, index of the next one and conditional jump table (see Script.evaluate).
+        self.cmds = ()
+        self.ip = 0
+        self.jumps = {}
+        # resources used so far and their limits.
+        self.budget = budget if budget is not None else ExecutionBudget()
+
+
+# Counts the resources used by a script evaluation and enforces the consensus limits on them.
+# Every check returns False once a limit is exceeded, and error says which one and where.
+# The counters are left as they were at the end of the evaluation, so they can be used as metrics.
+class ExecutionBudget:
+
+    def __init__(self, max_ops=MAX_OPS_PER_SCRIPT, max_stack_size=MAX_STACK_SIZE,
+                 max_element_size=MAX_SCRIPT_ELEMENT_SIZE, max_sigops=None):
+        self.max_ops = max_ops
+        self.max_stack_size = max_stack_size
+        self.max_element_size = max_element_size
+        # there's no per script sigop limit in consensus, callers can set one for the whole evaluation.
+        self.max_sigops = max_sigops
+        # opcodes executed by the current script. The limit applies to each script (ScriptSig and ScriptPubKey,
+        # RedeemScript, WitnessScript) separately, total_ops counts them all.
+        self.op_count = 0
+        self.total_ops = 0
+        self.sigop_count = 0
+        self.bytes_pushed = 0
+        # largest size of stack plus altstack seen.
+        self.max_stack_depth = 0
+        self.error = None
+
+    def __repr__(self):
+        return 'ExecutionBudget({})'.format(self.metrics())
+
+    def fail(self, error):
+        self.error = error
+        return False
+
+    # Called when the evaluation moves on to the next script: ScriptPubKey, RedeemScript or WitnessScript.
+    def new_script(self):
+        self.op_count = 0
+
+    # Accounts for the commands cmds[start:end], which are passed over without being executed, like the ones in
+    # a branch that isn't taken. Their opcodes count towards the opcode limit anyway, but they aren't sigops.
+    def skip_ops(self, cmds, start, end):
+        ops = 0
+        for i in range(start, end):
+            cmd = cmds[i]
+            if type(cmd) == int and cmd > 96:
+                ops += 1
+        self.op_count += ops
+        self.total_ops += ops
+        if self.op_count > self.max_ops:
+            return self.fail('more than {} opcodes'.format(self.max_ops))
+        return True
+
+    # Accounts for an element pushed to the stack.
+    def push(self, element):
+        self.bytes_pushed += len(element)
+        if len(element) > self.max_element_size:
+            return self.fail('push of {} bytes exceeds the {} bytes element limit'.format(
+                len(element), self.max_element_size))
+        return True
+
+    # Accounts for an opcode about to be executed. Pushes of small numbers (OP_0, OP_1NEGATE and OP_1 to OP_16)
+    # are not counted towards the opcode limit. Signature checks count as sigops, multisig ones as many as keys.
+    def count_op(self, cmd, stack):
+        if cmd > 96:
+            self.op_count += 1
+            self.total_ops += 1
+            if self.op_count > self.max_ops:
+                return self.fail('more than {} opcodes'.format(self.max_ops))
+        if cmd in (172, 173):
+            self.sigop_count += 1
+        elif cmd in (174, 175):
+            keys = MAX_PUBKEYS_PER_MULTISIG
+            if len(stack) > 0 and len(stack[-1]) <= 4:
+                n = decode_num(stack[-1])
+                if 0 <= n <= MAX_PUBKEYS_PER_MULTISIG:
+                    keys = n
+            self.sigop_count += keys
+        if self.max_sigops is not None and self.sigop_count > self.max_sigops:
+            return self.fail('more than {} sigops'.format(self.max_sigops))
+        return True
+
+    # Checks the combined size of the stack and the altstack after executing a command.
+    def check_stack(self, stack, altstack):
+        depth = len(stack) + len(altstack)
+        if depth > self.max_stack_depth:
+            self.max_stack_depth = depth
+        if depth > self.max_stack_size:
+            return self.fail('stack size {} exceeds the {} elements limit'.format(
+                depth, self.max_stack_size))
+        return True
+
+    # Returns the counters as a dict.
+    def metrics(self):
+        return {
+            'ops': self.total_ops,
+            'sigops': self.sigop_count,
+            'bytes_pushed': self.bytes_pushed,
+            'max_stack_depth': self.max_stack_depth,
+        }
+
 # encodes num = converts num to byte format, LE.
+# Script numbers are minimally encoded little endian with the sign in the top bit of the last byte,
+# so a byte is added when the top bit of the absolute value is already used.
 def encode_num(num):
-    if num == 0:
-        return b''
-    # absolute value of num.
+    # -1 to 16 are by far the most common, they are pushed by OP_1NEGATE to OP_16 and every boolean result.
+    if -1 <= num <= 16:
+        return SMALL_NUMS[num + 1]
     abs_num = abs(num)
-    # negative boolean.
-    negative = num < 0
-    # The bytearray() method returns a bytearray object which is a mutable (can be modified) 
-    # sequence of integers in the range 0 <= x < 256.
-    result = bytearray()
-    # loops abs_num byte by byte and appends each byte to the result.
-    while abs_num:
-        # appends abs_num in byte format to result.
-        result.append(abs_num & 0xff)
-        # shifts to the next byte.
-        abs_num >>= 8
-    # if the top bit is set,
-    # for negative numbers we ensure that the top bit is set.
-    # for positive numbers we ensure that the top bit is not set.
-    # this is because when the top bit is zero, the number is positive. 
-    # when it's 1, the number is negative.
-    if result[-1] & 0x80: # True only if top bit is a 1
-        # if top bit is already a 1, I need to add a byte to indicate it's negative or positive.
-        if negative:
-            result.append(0x80)
-        else:
-            result.append(0)
-    # if top bit isn't a 1, but number is negative, then I change top bit for a 1.
-    elif negative:
-        # ensures that top bit is 1
-        result[-1] |= 0x80
-    return bytes(result)
+    # bit_length + 1 bits leave room for the sign bit.
+    length = (abs_num.bit_length() + 8) // 8
+    if num < 0:
+        abs_num |= 0x80 << (8 * (length - 1))
+    return abs_num.to_bytes(length, 'little')
 
 # decodes num from byte format to int.
 def decode_num(element):
-    if element == b'':
+    if not element:
         return 0
-    # reverse for big endian
-    big_endian = element[::-1]
+    result = int.from_bytes(element, 'little')
     # top bit being 1 means it's negative
-    if big_endian[0] & 0x80:
-        negative = True
-        result = big_endian[0] & 0x7f
-    else:
-        negative = False
-        result = big_endian[0]
-    for c in big_endian[1:]:
-        result <<= 8
-        result += c
-    if negative:
-        return -result
-    else:
-        return result
+    if element[-1] & 0x80:
+        return -(result ^ (0x80 << (8 * (len(element) - 1))))
+    return result
+
+# encoded -1 to 16, indexed by num + 1.
+SMALL_NUMS = (b'\x81', b'') + tuple(bytes([n]) for n in range(1, 17))
+# results pushed by the comparison and signature checking opcodes.
+ONE = SMALL_NUMS[2]
+ZERO = SMALL_NUMS[1]
 
 """
 The following methods (until op_16) just add encoded numbers to the stack.
@@ -164,61 +270,6 @@ def op_16(stack):
 def op_nop(stack):
     return True
 
-# if the top stack value is not 0, the statements are executed. The top stack value is removed.
-# items is a list (array) of commands that come from the script being evaluated (see evaluate method in Script class).
-def op_if(stack, cmds):
-    # if there's nothing in the stack, return False.
-    if len(stack) < 1:
-        return False
-    # go through and re-make the items array based on the top stack element.
-    if_cmds = [] # will hold the commands for the IF statement.
-    else_cmds = [] # will hold the commands for the ELSE statement.
-    current_array = if_cmds
-    # boolean that indicates the if statement exited correctly.
-    found = False
-    # number of endifs needed to exit the if (we don't know where the if ends a priori).
-    num_endifs_needed = 1
-    while len(cmds) > 0:
-        cmd = cmds.pop(0)
-        # 99 and 100 are OP_IF and OP_NOTIF, so it would mean we have a nested loop.
-        if cmd in (99, 100):
-            # we increase the # of endifs needed to exit the if.
-            num_endifs_needed += 1
-            # add the OP_IF or OP_NOTIF to the if statement array.
-            current_array.append(cmd)
-        # 103 is OP_ELSE and if we only needed 1 endif, then we exit the if and get into the else statement. 
-        elif num_endifs_needed == 1 and cmd == 103:
-            # else statement items.
-            current_array = else_cmds
-        # 104 is and OP_ENDIF
-        elif cmd == 104:
-            # if we only needed 1 endif, exit the if statement.
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                # else, subtract 1 to the endifs needed to exit the if statement.
-                num_endifs_needed -= 1
-                # add the OP_ENDIF to the if statement array.
-                current_array.append(cmd)
-        # for any other operation or element, add it to the if statement array.
-        else:
-            current_array.append(cmd)
-    # if items array is empty and we didn't exit the if statement, fail.
-    if not found:
-        return False
-    # get the top element from the stack
-    element = stack.pop()
-    # if top stack element is 0, if there's an OP_ELSE, OP_ELSE statements are executed, else, 
-    # nothing from the if statements gets appended back to items array to be executed.
-    if decode_num(element) == 0:
-        cmds[:0] = else_cmds
-    # else, they are executed. All statements between the IF and the END_IF are executed, 
-    # excluding statements from the OP_ELSE if there's an OP_ELSE.
-    else:
-        cmds[:0] = if_cmds
-    return True
-
 # duplicates the top element of the stack and pushes it to the stack.
 def op_dup(stack):
     # if stack is empty, return False
@@ -267,69 +318,15 @@ def op_equal(stack):
     element_1 = stack.pop()
     element_2 = stack.pop()
     if element_1 == element_2:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
-# op_endif logic is incorporated in the op_if function.
+# OP_ENDIF does nothing, the branches not taken are skipped by op_if_jump, op_notif_jump and op_else_jump.
 def op_endif(stack):
     return True
 
-# same as op_if, but statements are executed it top value is 0.
-def op_notif(stack, cmds):
-    # if there's nothing in the stack, return False.
-    if len(stack) < 1:
-        return False
-    # go through and re-make the items array based on the top stack element.
-    if_cmds = [] # will hold the commands for the IF statement.
-    else_cmds = [] # will hold the commands for the ELSE statement.
-    current_array = if_cmds
-    # boolean that indicates the if statement exited correctly.
-    found = False
-    # number of endifs needed to exit the if (we don't know where the if ends a priori).
-    num_endifs_needed = 1
-    while len(cmds) > 0:
-        cmd = cmds.pop(0)
-        # 99 and 100 are OP_IF and OP_NOTIF, so it would mean we have a nested loop.
-        if cmd in (99, 100):
-            # we increase the # of endifs needed to exit the if.
-            num_endifs_needed += 1
-            # add the OP_IF or OP_NOTIF to the if statement array.
-            current_array.append(cmd)
-        # 103 is OP_ELSE and if we only needed 1 endif, then we exit the if and get into the else statement. 
-        elif num_endifs_needed == 1 and cmd == 103:
-            # else statement items.
-            current_array = else_cmds
-        # 104 is and OP_ENDIF
-        elif cmd == 104:
-            # if we only needed 1 endif, exit the if statement.
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                # else, subtract 1 to the endifs needed to exit the if statement.
-                num_endifs_needed -= 1
-                # add the OP_ENDIF to the if statement array.
-                current_array.append(cmd)
-        # for any other operation or element, add it to the if statement array.
-        else:
-            current_array.append(cmd)
-    # if items array is empty and we didn't exit the if statement, fail.
-    if not found:
-        return False
-    # get the top element from the stack
-    element = stack.pop()
-    # if top stack element is 0, if there's an OP_ELSE, OP_ELSE statements are executed, else, 
-    # nothing from the if statements gets appended back to items array to be executed.
-    if decode_num(element) == 0:
-        cmds[:0] = if_cmds
-    # else, they are executed. All statements between the IF and the END_IF are executed, 
-    # excluding statements from the OP_ELSE if there's an OP_ELSE.
-    else:
-        cmds[:0] = else_cmds
-    return True
-
 # Marks transaction as invalid if top stack value is not true. The top stack value is removed.
 def op_verify(stack):
     if len(stack) < 1:
@@ -352,7 +349,7 @@ def op_toaltstack(stack, altstack):
 
 # Puts the input onto the top of the main stack. Removes it from the alt stack.
 def op_fromaltstack(stack, altstack):
-    if len(stack) < 1:
+    if len(altstack) < 1:
         return False
     stack.append(altstack.pop())
     return True
@@ -456,7 +453,8 @@ def op_roll(stack):
     n = decode_num(stack.pop())
     if len(stack) < n + 1:
         return False
-    stack.append(stack.pop(-n-1)) 
+    stack.append(stack.pop(-n-1))
+    return True
 
 # The top three items on the stack are rotated to the left.
 def op_rot(stack):
@@ -529,9 +527,10 @@ def op_not(stack):
         return False
     item = decode_num(stack.pop())
     if item == 0:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
+    return True
 
 # Removes top element. If it is 0, a 0 is added onto the stack, otherwise a 1 is pushed onto the stack.
 def op_0notequal(stack):
@@ -539,9 +538,10 @@ def op_0notequal(stack):
         return False
     item = decode_num(stack.pop())
     if item == 0:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     else:
-        stack.append(encode_num(1))
+        stack.append(ONE)
+    return True
 
 # top element is subtracted from second-to-top stack element. Both elements are consumed. 
 # result is pushed onto the stack.
@@ -561,9 +561,9 @@ def op_booland(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem1 != 0 and elem2 != 0:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # consumes top 2 elements, if one of them is not 0, push 1 onto the stack. Otherwise push 0.
@@ -573,9 +573,9 @@ def op_boolor(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem1 != 0 or elem2 != 0:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # consumes top 2 elements, if they are equal, pushes a 1 onto the stack. Otherwise pushes a 0.
@@ -585,9 +585,9 @@ def op_numequal(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem1 == elem2:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 def op_numequalverify(stack):
@@ -600,9 +600,9 @@ def op_numnotequal(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem1 != elem2:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # Consumes top 2 elements. Pushes a 1 onto the stack if second-to-top element
@@ -613,9 +613,9 @@ def op_lessthan(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem2 < elem1:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # Consumes top 2 elements. Pushes a 1 onto the stack if second-to-top element
@@ -626,9 +626,9 @@ def op_greaterthan(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem2 > elem1:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # Consumes top 2 elements. Pushes a 1 onto the stack if second-to-top element
@@ -639,9 +639,9 @@ def op_lessthanorequal(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem2 <= elem1:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # Consumes top 2 elements. Pushes a 1 onto the stack if second-to-top element
@@ -652,9 +652,9 @@ def op_greaterthanorequal(stack):
     elem1 = decode_num(stack.pop())
     elem2 = decode_num(stack.pop())
     if elem2 >= elem1:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # Consumes top 2 elements. Pushes the smaller element between the two onto the stack.
@@ -690,9 +690,9 @@ def op_within(stack):
     min_elem = decode_num(stack.pop())
     elem = decode_num(stack.pop())
     if elem >= min_elem and elem < max_elem:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
 # Consumes top element of the stack, performs a ripemd160 operation on it and pushes the hashed element
@@ -724,6 +724,55 @@ def op_sha256(stack):
     stack.append(hashlib.sha256(elem).digest())
     return True
 
+# Marks the transaction as invalid if the top stack item is greater than the transaction's locktime
+# or if both are of a different kind (block height vs. timestamp) - BIP65. The top stack item is not removed.
+# Takes the ExecutionContext. A script evaluated without a transaction (no locktime or sequence) fails.
+def op_checklocktimeverify(ctx):
+    stack, locktime, sequence = ctx.stack, ctx.locktime, ctx.sequence
+    if locktime is None or sequence is None:
+        return False
+    # a finalized input (sequence 0xffffffff) disables the locktime.
+    if sequence == 0xffffffff:
+        return False
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack[-1])
+    if element < 0:
+        return False
+    # values below LOCKTIME_THRESHOLD are block heights, the rest are timestamps.
+    if (element < LOCKTIME_THRESHOLD) != (locktime < LOCKTIME_THRESHOLD):
+        return False
+    if locktime < element:
+        return False
+    return True
+
+# Marks the transaction as invalid if the relative lock time of the input (its sequence) is not at least
+# the top stack item's - BIP112. The top stack item is not removed.
+# Takes the ExecutionContext. A script evaluated without a transaction (no version or sequence) fails.
+def op_checksequenceverify(ctx):
+    stack, version, sequence = ctx.stack, ctx.version, ctx.sequence
+    if len(stack) < 1:
+        return False
+    element = decode_num(stack[-1])
+    if element < 0:
+        return False
+    # if the disable flag is set in the stack item, the opcode behaves as a NOP.
+    if element & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+        return True
+    if version is None or sequence is None:
+        return False
+    # relative lock times only apply to version 2 transactions that don't disable them in the sequence.
+    if version < 2:
+        return False
+    if sequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+        return False
+    # both have to be of the same kind (blocks or 512 seconds units) and the input's has to be large enough.
+    if element & SEQUENCE_LOCKTIME_TYPE_FLAG != sequence & SEQUENCE_LOCKTIME_TYPE_FLAG:
+        return False
+    if element & SEQUENCE_LOCKTIME_MASK > sequence & SEQUENCE_LOCKTIME_MASK:
+        return False
+    return True
+
 # Same as OP_CHECKSIG, but OP_VERIFY is executed afterward.
 def op_checksigverify(stack, z):
     return op_checksig(stack, z) and op_verify(stack)
@@ -748,66 +797,64 @@ def op_checksig(stack, z):
     valid = point.verify(z, sig)
     # push a 1 if it's valid, 0 otherwise.
     if valid:
-        stack.append(encode_num(1))
+        stack.append(ONE)
     else:
-        stack.append(encode_num(0))
+        stack.append(ZERO)
     return True
 
-# If all signatures are valid, 1 is returned, 0 otherwise. 
+# If all signatures are valid, 1 is returned, 0 otherwise.
 # Due to a bug, one extra unused value is removed from the stack - page 148.
-# REWRITE: one sig can only sign one pubkey. Then that pubkey should be removed from consideration.
-def op_checkmultisig(stack, z): 
+# Signatures have to be in the same order as their pubkeys, as in consensus: a cursor moves through the pubkeys
+# and each signature is only checked against the pubkeys after the one that matched the previous signature,
+# so at most n signature verifications are done. It stops as soon as the remaining pubkeys are fewer than
+# the remaining signatures.
+def op_checkmultisig(stack, z):
     if len(stack) < 1:
         return False
     # n is the number of public keys
     n = decode_num(stack.pop())
-    if len(stack) < n + 1:
-        return False
-    # get all the public keys into a list.
-    pubkeys = []
-    for _ in range(n):
-        pubkeys.append(stack.pop())
-    if len(stack) < 1:
+    if n < 0 or n > MAX_PUBKEYS_PER_MULTISIG or len(stack) < n + 1:
         return False
+    # get all the public keys, in the order they were pushed.
+    pubkeys = stack[-n:] if n > 0 else []
+    del stack[len(stack) - n:]
     # m is the number of signatures
     m = decode_num(stack.pop())
-    # m + 2 because of the additional element at the bottom of the stack that is added.
-    if len(stack) < m + 1:
-        return False
-    # get all the signatures.
-    signatures = []
-    for _ in range(m):
-        # take off last byte, which is the hashtype
-        signatures.append(stack.pop()[:-1])
-    if len(stack) < 1:
+    # m + 1 because of the additional element at the bottom of the stack that is added.
+    if m < 0 or m > n or len(stack) < m + 1:
         return False
+    # get all the signatures, in the order they were pushed.
+    signatures = stack[-m:] if m > 0 else []
+    del stack[len(stack) - m:]
     # we remove the last element from the stack (the one included because the off by one error)
     stack.pop()
-    # verify all the signatures against all pubkeys. If a signature isn't valid for any pubkeys, fail.
+    i_sig = 0
+    i_key = 0
+    while i_sig < m:
+        # not enough pubkeys left for the signatures left.
+        if m - i_sig > n - i_key:
+            break
+        if _check_signature(signatures[i_sig], pubkeys[i_key], z):
+            i_sig += 1
+        i_key += 1
+    if i_sig == m:
+        stack.append(ONE)
+    else:
+        stack.append(ZERO)
+    return True
+
+# Returns whether sig (DER signature followed by the hash type) is a valid signature of z by the sec pubkey.
+# Badly encoded signatures or pubkeys are just not valid, they don't make the script fail.
+def _check_signature(sig, sec, z):
+    if len(sig) == 0:
+        return False
     try:
-        sigs = [Signature.parse(signature) for signature in signatures]
-        points = [S256Point.parse(pubkey) for pubkey in pubkeys]
-    except (ValueError, SyntaxError) as e:
+        point = S256Point.parse(sec)
+        signature = Signature.parse(sig[:-1])
+    except (ValueError, SyntaxError, IndexError) as e:
         LOGGER.info(e)
         return False
-    # variable to count the number of valid signatures.
-    count = 0
-    # in the next loop, we check that each signature is valid for a pubkey.
-    while len(points) > 0:
-        # point is popped so each signature can only be valid for 1 point.
-        point = points.pop()
-        for sig in sigs:
-            # if the signature is valid for this pubkey, increase the count and break from the while
-            # to check next signature.
-            if point.verify(z, sig):
-                count += 1
-    # if the number of valid signatures is m = each signature is valid for some pubkey, then script is valid.
-    if count == m:
-        stack.append(encode_num(1))
-    # else, script should fail.
-    else:
-        stack.append(encode_num(0))
-    return True
+    return point.verify(z, signature)
 
 # Same as OP_CHECKMULTISIG, but OP_VERIFY is executed afterward.
 def op_checkmultisigverify(stack, z):
@@ -1086,6 +1133,140 @@ class TestOp(TestCase):
         stack = [b'', sig1, sig2, b'\x02', sec1, sec2, b'\x02']
         self.assertTrue(op_checkmultisig(stack, z))
         self.assertEqual(decode_num(stack[0]), 1)
+        # signatures in a different order than their pubkeys are not valid.
+        stack = [b'', sig2, sig1, b'\x02', sec1, sec2, b'\x02']
+        self.assertTrue(op_checkmultisig(stack, z))
+        self.assertEqual(stack, [ZERO])
+        # a 1-of-2 with the signature of the second key, and a badly encoded first key.
+        stack = [b'', sig2, b'\x01', b'\x02' + b'\x00' * 32, sec2, b'\x02']
+        self.assertTrue(op_checkmultisig(stack, z))
+        self.assertEqual(stack, [ONE])
+        self.assertFalse(op_checkmultisig([b'', sig1, sig2, b'\x02', sec1, b'\x01'], z))
+
+    def test_op_checkmultisig_verifications(self):
+        z = 0xe71bfa115715d6fd33796948126f40a8cdd39f187e4afb03896795189fe1423c
+        sig1 = bytes.fromhex('3045022100dc92655fe37036f47756db8102e0d7d5e28b3beb83a8fef4f5dc0559bddfb94e02205a36d4e4e6c7fcd16658c50783e00c341609977aed3ad00937bf4ee942a8993701')
+        sig2 = bytes.fromhex('3045022100da6bee3c93766232079a01639d07fa869598749729ae323eab8eef53577d611b02207bef15429dcadce2121ea07f233115c6f09034c0be68db99980b9a6c5e75402201')
+        sec1 = bytes.fromhex('022626e955ea6ea6d98850c994f9107b036b1334f18ca8830bfff1295d21cfdb70')
+        sec2 = bytes.fromhex('03b287eaf122eea69030a0e9feed096bed8045c8b98bec453e1ffac7fbdbd4bb71')
+        with patch.object(S256Point, 'verify', autospec=True, side_effect=S256Point.verify) as verify:
+            # 2-of-4 signed by the first two keys: no more than 2 verifications.
+            stack = [b'', sig1, sig2, b'\x02', sec1, sec2, sec1, sec2, b'\x04']
+            self.assertTrue(op_checkmultisig(stack, z))
+            self.assertEqual(stack, [ONE])
+            self.assertEqual(verify.call_count, 2)
+            # the second signature doesn't match the last key, so after 1 verification there's a single key
+            # left for 2 signatures and it stops.
+            verify.reset_mock()
+            stack = [b'', sig2, sig1, b'\x02', sec1, sec2, b'\x02']
+            self.assertTrue(op_checkmultisig(stack, z))
+            self.assertEqual(stack, [ZERO])
+            self.assertEqual(verify.call_count, 1)
+
+    def test_num_encoding(self):
+        # the byte by byte implementations encode_num and decode_num replaced.
+        def reference_encode_num(num):
+            if num == 0:
+                return b''
+            abs_num = abs(num)
+            negative = num < 0
+            result = bytearray()
+            while abs_num:
+                result.append(abs_num & 0xff)
+                abs_num >>= 8
+            if result[-1] & 0x80:
+                if negative:
+                    result.append(0x80)
+                else:
+                    result.append(0)
+            elif negative:
+                result[-1] |= 0x80
+            return bytes(result)
+
+        def reference_decode_num(element):
+            if element == b'':
+                return 0
+            big_endian = element[::-1]
+            if big_endian[0] & 0x80:
+                negative = True
+                result = big_endian[0] & 0x7f
+            else:
+                negative = False
+                result = big_endian[0]
+            for c in big_endian[1:]:
+                result <<= 8
+                result += c
+            if negative:
+                return -result
+            else:
+                return result
+
+        # every number up to 2^17 in absolute value, and numbers around the powers of 2 up to 2^64.
+        nums = list(range(-(1 << 17), 1 << 17))
+        for bits in range(17, 65):
+            for n in (1 << bits, (1 << bits) - 1, (1 << bits) + 1):
+                nums += [n, -n]
+        for n in nums:
+            self.assertEqual(encode_num(n), reference_encode_num(n), n)
+        # every 1 and 2 byte element, including the non minimal ones.
+        elements = [b''] + [bytes([a]) for a in range(256)] + [bytes([a, b]) for a in range(256) for b in range(256)]
+        elements += [reference_encode_num(n) + b'\x80' for n in (1, 255, 1 << 20)]
+        for element in elements:
+            self.assertEqual(decode_num(element), reference_decode_num(element), element)
+        self.assertEqual(SMALL_NUMS, tuple(reference_encode_num(n) for n in range(-1, 17)))
+
+    # returns an ExecutionContext with element on the stack.
+    def context(self, element, locktime=None, sequence=None, version=None):
+        ctx = ExecutionContext(locktime=locktime, sequence=sequence, version=version)
+        ctx.stack.append(encode_num(element))
+        return ctx
+
+    def test_op_checklocktimeverify(self):
+        locktime = 600000
+        self.assertTrue(op_checklocktimeverify(self.context(599999, locktime, 0xfffffffe)))
+        self.assertTrue(op_checklocktimeverify(self.context(600000, locktime, 0xfffffffe)))
+        self.assertFalse(op_checklocktimeverify(self.context(600001, locktime, 0xfffffffe)))
+        # timestamps can't be compared to heights.
+        self.assertFalse(op_checklocktimeverify(self.context(LOCKTIME_THRESHOLD, locktime, 0xfffffffe)))
+        self.assertFalse(op_checklocktimeverify(self.context(-1, locktime, 0xfffffffe)))
+        self.assertFalse(op_checklocktimeverify(self.context(1, locktime, 0xffffffff)))
+        self.assertFalse(op_checklocktimeverify(ExecutionContext(locktime=locktime, sequence=0xfffffffe)))
+        # without a transaction there's no locktime to compare to.
+        self.assertFalse(op_checklocktimeverify(self.context(1)))
+        self.assertFalse(op_checklocktimeverify(self.context(1, locktime=locktime)))
+
+    def test_op_checksequenceverify(self):
+        self.assertTrue(op_checksequenceverify(self.context(10, sequence=10, version=2)))
+        self.assertFalse(op_checksequenceverify(self.context(11, sequence=10, version=2)))
+        self.assertFalse(op_checksequenceverify(self.context(10, sequence=10, version=1)))
+        # blocks vs. time based relative lock times.
+        self.assertFalse(op_checksequenceverify(self.context(10, sequence=SEQUENCE_LOCKTIME_TYPE_FLAG | 10, version=2)))
+        self.assertTrue(op_checksequenceverify(
+            self.context(SEQUENCE_LOCKTIME_TYPE_FLAG | 5, sequence=SEQUENCE_LOCKTIME_TYPE_FLAG | 10, version=2)))
+        self.assertFalse(op_checksequenceverify(
+            self.context(10, sequence=SEQUENCE_LOCKTIME_DISABLE_FLAG | 10, version=2)))
+        # the disable flag in the stack item makes it a NOP.
+        self.assertTrue(op_checksequenceverify(self.context(SEQUENCE_LOCKTIME_DISABLE_FLAG, sequence=0, version=1)))
+        # without a transaction there's no version or sequence to compare to.
+        self.assertFalse(op_checksequenceverify(self.context(10)))
+        self.assertFalse(op_checksequenceverify(self.context(10, version=2)))
+
+    def test_op_code_table(self):
+        self.assertEqual(len(OP_CODE_TABLE), 256)
+        self.assertIs(OP_CODE_TABLE[0xba], op_invalid)
+        ctx = ExecutionContext(locktime=100, sequence=0)
+        ctx.stack.append(encode_num(99))
+        self.assertTrue(OP_CODE_TABLE[177](ctx))
+        self.assertTrue(OP_CODE_TABLE[107](ctx))
+        self.assertEqual(ctx.stack, [])
+        self.assertTrue(OP_CODE_TABLE[108](ctx))
+        self.assertEqual(ctx.stack, [encode_num(99)])
+        self.assertFalse(OP_CODE_TABLE[108](ctx))
+        # stack only opcodes are called without the context.
+        self.assertIs(STACK_OP_TABLE[118], op_dup)
+        self.assertIsNone(STACK_OP_TABLE[108])
+        self.assertIsNone(STACK_OP_TABLE[0xba])
+        self.assertTrue(all(STACK_OP_TABLE[code] is None or OP_CODE_TABLE[code] is op_invalid for code in range(256)))
 
 
 OP_CODE_FUNCTIONS = {
@@ -1108,8 +1289,6 @@ OP_CODE_FUNCTIONS = {
     95: op_15,
     96: op_16,
     97: op_nop,
-    99: op_if,
-    100: op_notif,
     105: op_verify,
     106: op_return,
     107: op_toaltstack,
@@ -1164,8 +1343,8 @@ OP_CODE_FUNCTIONS = {
     174: op_checkmultisig,
     175: op_checkmultisigverify,
     176: op_nop,
-    # 177: op_checklocktimeverify,
-    # 178: op_checksequenceverify,
+    177: op_checklocktimeverify,
+    178: op_checksequenceverify,
     179: op_nop,
     180: op_nop,
     181: op_nop,
@@ -1175,6 +1354,89 @@ OP_CODE_FUNCTIONS = {
     185: op_nop,
 }
 
+# Opcodes that are not defined, or are disabled, fail the script.
+def op_invalid(ctx):
+    return False
+
+# OP_IF: consumes the top stack element and, if it is 0, jumps right after the matching OP_ELSE, or the
+# OP_ENDIF if there's no OP_ELSE. ctx.ip is already past the OP_IF.
+def op_if_jump(ctx):
+    if len(ctx.stack) < 1:
+        return False
+    if decode_num(ctx.stack.pop()) == 0:
+        return _skip_branch(ctx)
+    return True
+
+# OP_NOTIF: same as OP_IF, but the branch is skipped if the top stack element is not 0.
+def op_notif_jump(ctx):
+    if len(ctx.stack) < 1:
+        return False
+    if decode_num(ctx.stack.pop()) != 0:
+        return _skip_branch(ctx)
+    return True
+
+# The opcodes of the skipped branch count towards the opcode limit, so this fails if it's exceeded.
+def _skip_branch(ctx):
+    else_index, endif_index = ctx.jumps[ctx.ip - 1]
+    start = ctx.ip
+    if else_index is None:
+        ctx.ip = endif_index + 1
+    else:
+        ctx.ip = else_index + 1
+    return ctx.budget.skip_ops(ctx.cmds, start, ctx.ip)
+
+# OP_ELSE is only reached from the executed IF branch, so it jumps to the OP_ENDIF.
+# Later OP_ELSEs of the same conditional are not in the jump table and do nothing.
+def op_else_jump(ctx):
+    endif_index = ctx.jumps.get(ctx.ip - 1)
+    if endif_index is not None:
+        start = ctx.ip
+        ctx.ip = endif_index + 1
+        return ctx.budget.skip_ops(ctx.cmds, start, ctx.ip)
+    return True
+
+# Versions of the opcodes that need more than the stack taking the ExecutionContext.
+def op_toaltstack_ctx(ctx):
+    return op_toaltstack(ctx.stack, ctx.altstack)
+
+def op_fromaltstack_ctx(ctx):
+    return op_fromaltstack(ctx.stack, ctx.altstack)
+
+def op_checksig_ctx(ctx):
+    return op_checksig(ctx.stack, ctx.z)
+
+def op_checksigverify_ctx(ctx):
+    return op_checksigverify(ctx.stack, ctx.z)
+
+def op_checkmultisig_ctx(ctx):
+    return op_checkmultisig(ctx.stack, ctx.z)
+
+def op_checkmultisigverify_ctx(ctx):
+    return op_checkmultisigverify(ctx.stack, ctx.z)
+
+# Flat table indexed by opcode of the opcodes that need more than the stack. Every entry takes an
+# ExecutionContext and returns False if the script fails. Opcodes that aren't defined fail.
+OP_CODE_TABLE = [op_invalid] * 256
+OP_CODE_TABLE[99] = op_if_jump
+OP_CODE_TABLE[100] = op_notif_jump
+OP_CODE_TABLE[103] = op_else_jump
+OP_CODE_TABLE[107] = op_toaltstack_ctx
+OP_CODE_TABLE[108] = op_fromaltstack_ctx
+OP_CODE_TABLE[172] = op_checksig_ctx
+OP_CODE_TABLE[173] = op_checksigverify_ctx
+OP_CODE_TABLE[174] = op_checkmultisig_ctx
+OP_CODE_TABLE[175] = op_checkmultisigverify_ctx
+OP_CODE_TABLE[177] = op_checklocktimeverify
+OP_CODE_TABLE[178] = op_checksequenceverify
+
+# Flat table indexed by opcode of the opcodes that only use the stack, None for the rest. The interpreter calls
+# them with the stack itself, so dispatching most opcodes is a single list index and call.
+STACK_OP_TABLE = [None] * 256
+for code, operation in OP_CODE_FUNCTIONS.items():
+    if OP_CODE_TABLE[code] is op_invalid:
+        STACK_OP_TABLE[code] = operation
+STACK_OP_TABLE[104] = op_endif
+
 OP_CODE_NAMES = {
     0: 'OP_0',
     76: 'OP_PUSHDATA1',
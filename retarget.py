@@ -0,0 +1,104 @@
+from io import BytesIO
+from unittest import TestCase
+
+from block import Block, bits_target
+from helper import target_to_bits
+
+
+# Difficulty rules of a network.
+class RetargetParams:
+
+    def __init__(self, name, pow_limit, interval=2016, target_spacing=600, allow_min_difficulty=False,
+                 no_retargeting=False):
+        self.name = name
+        # highest target allowed, that is the lowest difficulty.
+        self.pow_limit = pow_limit
+        self.pow_limit_bits = target_to_bits(pow_limit)
+        # the difficulty is adjusted every interval blocks to get a block every target_spacing seconds.
+        self.interval = interval
+        self.target_spacing = target_spacing
+        self.target_timespan = interval * target_spacing
+        # testnet and regtest allow a block with the lowest difficulty when it comes more than
+        # twice the target spacing after the previous one.
+        self.allow_min_difficulty = allow_min_difficulty
+        # regtest never adjusts the difficulty.
+        self.no_retargeting = no_retargeting
+
+    def __repr__(self):
+        return 'RetargetParams({})'.format(self.name)
+
+
+MAINNET = RetargetParams('mainnet', 2**224 - 1)
+TESTNET = RetargetParams('testnet', 2**224 - 1, allow_min_difficulty=True)
+REGTEST = RetargetParams('regtest', 2**255 - 1, allow_min_difficulty=True, no_retargeting=True)
+
+
+# Computes the bits every header of a chain must have.
+# The bits of every difficulty period (epoch) are computed once, when its first block is appended, and
+# remembered along with the hash of the block before it, so a cached epoch is recomputed if that block was
+# replaced by a rewind. Every other header only needs a dict lookup.
+class Retarget:
+
+    def __init__(self, params=MAINNET):
+        self.params = params
+        # epoch -> (hash of the last block of the previous epoch, bits of the epoch).
+        self.epochs = {}
+
+    # Returns the bits for the block after previous, the last block of an epoch, first being the first block
+    # of that epoch. Like Bitcoin Core, the time is measured over the 2015 intervals of the epoch.
+    def next_bits(self, previous, first):
+        params = self.params
+        if params.no_retargeting:
+            return previous.bits
+        timespan = previous.timestamp - first.timestamp
+        # the difficulty changes by a factor of 4 at most.
+        timespan = min(max(timespan, params.target_timespan // 4), params.target_timespan * 4)
+        target = bits_target(previous.bits) * timespan // params.target_timespan
+        return target_to_bits(min(target, params.pow_limit))
+
+    # Returns the bits of the epoch, which is the bits its first block must have. chain is a HeaderChain
+    # with at least the blocks up to the first one of the epoch.
+    def epoch_bits(self, chain, epoch):
+        start = epoch * self.params.interval
+        key = chain.hash_at(start - 1) if start > 0 else None
+        cached = self.epochs.get(epoch)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        if epoch == 0:
+            bits = chain.header(0).bits
+        else:
+            bits = self.next_bits(chain.header(start - 1), chain.header(start - self.params.interval))
+        self.epochs[epoch] = (key, bits)
+        return bits
+
+    # Returns the bits header must have at height in chain, which has the blocks up to height - 1.
+    def expected_bits(self, chain, height, header):
+        params = self.params
+        epoch, position = divmod(height, params.interval)
+        if position != 0 and params.allow_min_difficulty:
+            if header.timestamp > chain.header(height - 1).timestamp + 2 * params.target_spacing:
+                return params.pow_limit_bits
+        # Otherwise a block has the bits of its epoch. On testnet Bitcoin Core looks for the last block that
+        # doesn't have the lowest difficulty or starts the epoch, and every such block has the epoch's bits.
+        return self.epoch_bits(chain, epoch)
+
+
+class RetargetTest(TestCase):
+
+    def header(self, timestamp, bits):
+        return Block(1, b'\x00' * 32, b'\x00' * 32, timestamp, bytes.fromhex(bits), b'\x00' * 4)
+
+    def test_next_bits(self):
+        retarget = Retarget(MAINNET)
+        # first and last blocks of a mainnet epoch (page 175).
+        first = Block.parse(BytesIO(bytes.fromhex('000000201ecd89664fd205a37566e694269ed76e425803003628ab010000000000000000bfcade29d080d9aae8fd461254b041805ae442749f2a40100440fc0e3d5868e55019345954d80118a1721b2e')))
+        previous = Block.parse(BytesIO(bytes.fromhex('00000020fdf740b0e49cf75bb3d5168fb3586f7613dcc5cd89675b0100000000000000002e37b144c0baced07eb7e7b64da916cd3121f2427005551aeb0ec6a6402ac7d7f0e4235954d801187f5da9f5')))
+        self.assertEqual(retarget.next_bits(previous, first).hex(), '00157617')
+        # slower than 4 times the target timespan, and capped at the lowest difficulty.
+        self.assertEqual(retarget.next_bits(self.header(first.timestamp + 10**8, 'ffff001d'), first).hex(), 'ffff001d')
+        previous = self.header(first.timestamp + 100, '54d80118')
+        self.assertEqual(retarget.next_bits(previous, first),
+                         target_to_bits(bits_target(bytes.fromhex('54d80118')) // 4))
+        self.assertEqual(Retarget(REGTEST).next_bits(previous, first).hex(), '54d80118')
+        self.assertEqual(REGTEST.pow_limit_bits.hex(), 'ffff7f20')
+        self.assertEqual(TESTNET.pow_limit_bits.hex(), 'ffff001d')
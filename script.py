@@ -1,12 +1,15 @@
+from functools import lru_cache
 from io import BytesIO
 from logging import getLogger
 from unittest import TestCase
 import hashlib
 
+import bech32
 from helper import (
+    decode_base58_with_prefix,
     encode_varint,
+    hash160,
     int_to_little_endian,
-    little_endian_to_int,
     read_varint,
     h160_to_p2pkh_address,
     h160_to_p2sh_address,
@@ -15,8 +18,13 @@ from helper import (
 )
 
 from op import (
-    OP_CODE_FUNCTIONS,
     OP_CODE_NAMES,
+    OP_CODE_TABLE,
+    STACK_OP_TABLE,
+    ExecutionBudget,
+    ExecutionContext,
+    MAX_PUBKEYS_PER_MULTISIG,
+    encode_num,
     op_hash160,
     op_equal,
     op_verify
@@ -24,6 +32,9 @@ from op import (
 
 LOGGER = getLogger(__name__)
 
+# number of parsed RedeemScripts and WitnessScripts kept by Script.parse_raw.
+SCRIPT_CACHE_SIZE = 4096
+
 
 # Takes the 20-byte hash160 part of the address and returns a p2pkh ScriptPubKey - page 140.
 def p2pkh_script(h160):
@@ -35,12 +46,147 @@ def p2wpkh_script(h160):
     return Script([0x00, h160])
 
 
+# Takes the 20-byte hash160 of a RedeemScript and returns a p2sh ScriptPubKey - page 152.
+def p2sh_script(h160):
+    return Script([0xa9, h160, 0x87])
+
+
 # Takes a hash and returns the p2wsh ScriptPubKey.
 def p2wsh_script(h256):
     return Script([0x00, h256])
 
 
+# Takes an address and returns its ScriptPubKey and whether it's a testnet address. Opposite of Script.address.
+# Handles base58 p2pkh and p2sh addresses and bech32 segwit addresses. Raises ValueError for anything else.
+def address_to_script(address):
+    hrp = address.rpartition('1')[0].lower()
+    if hrp in ('bc', 'tb'):
+        witver, witprog = bech32.decode(hrp, address)
+        if witver is None:
+            raise ValueError('bad address {}'.format(address))
+        # version 0 is OP_0, the rest are OP_1 to OP_16.
+        opcode = witver + 0x50 if witver > 0 else 0x00
+        return Script([opcode, bytes(witprog)]), hrp == 'tb'
+    try:
+        prefix, h160 = decode_base58_with_prefix(address)
+    except OverflowError:
+        # the number is too large for 25 bytes, the string is too long to be an address.
+        raise ValueError('bad address {}'.format(address))
+    if prefix in (0x00, 0x6f):
+        return p2pkh_script(h160), prefix == 0x6f
+    if prefix in (0x05, 0xc4):
+        return p2sh_script(h160), prefix == 0xc4
+    raise ValueError('unknown address prefix {}'.format(prefix))
+
+
+# Parses the script serialized in raw (bytes or memoryview) from offset to end, without the length prefix,
+# and returns its commands as a tuple: opcodes as ints and elements as bytes.
+def parse_script_cmds(raw, offset=0, end=None):
+    if end is None:
+        end = len(raw)
+    cmds = []
+    i = offset
+    while i < end:
+        # this byte's value determines if we have an opcode or an element.
+        current = raw[i]
+        i += 1
+        # for a number between 1 and 75, we know the next n bytes are an element.
+        if 1 <= current <= 75:
+            n = current
+        # 76, 77 and 78 are OP_PUSHDATA1, OP_PUSHDATA2 and OP_PUSHDATA4: the next 1, 2 or 4 bytes
+        # tell us how many bytes the next element is.
+        elif 76 <= current <= 78:
+            size = 1 << (current - 76)
+            if i + size > end:
+                raise SyntaxError('Parsing script failed.')
+            n = int.from_bytes(raw[i:i + size], 'little')
+            i += size
+        # else it's an opcode.
+        else:
+            cmds.append(current)
+            continue
+        # the element has to be within the script.
+        if i + n > end:
+            raise SyntaxError('Parsing script failed.')
+        cmds.append(bytes(raw[i:i + n]))
+        i += n
+    return tuple(cmds)
+
+
+# Same as parse_script_cmds for a whole bytes script, but remembers the last SCRIPT_CACHE_SIZE results.
+# The tuples are shared, so they must not be modified.
+@lru_cache(maxsize=SCRIPT_CACHE_SIZE)
+def cached_script_cmds(raw):
+    return parse_script_cmds(raw)
+
+
+# Builds the jump table used by Script.evaluate for the conditionals in cmds.
+# Each OP_IF/OP_NOTIF index maps to (index of its OP_ELSE or None, index of its OP_ENDIF) and the
+# first OP_ELSE of each conditional maps to the index of its OP_ENDIF.
+# Returns None if the conditionals are not balanced. boundaries are the indexes where the scripts combined in
+# cmds start, as a conditional can't span two scripts.
+def conditional_jumps(cmds, boundaries=()):
+    jumps = {}
+    # [if index, else index] for every conditional that hasn't been closed yet.
+    open_ifs = []
+    for i, cmd in enumerate(cmds):
+        if open_ifs and i in boundaries:
+            return None
+        if type(cmd) != int:
+            continue
+        if cmd in (99, 100):
+            open_ifs.append([i, None])
+        elif cmd == 103:
+            if len(open_ifs) == 0:
+                return None
+            if open_ifs[-1][1] is None:
+                open_ifs[-1][1] = i
+        elif cmd == 104:
+            if len(open_ifs) == 0:
+                return None
+            if_index, else_index = open_ifs.pop()
+            jumps[if_index] = (else_index, i)
+            if else_index is not None:
+                jumps[else_index] = i
+    if len(open_ifs) > 0:
+        return None
+    return jumps
+
+
+# List of script commands that tells the Script it belongs to when it's modified, so the Script can drop
+# the serialization and hashes it has cached.
+class ScriptCommands(list):
+
+    __slots__ = ('script',)
+
+    def __init__(self, cmds, script):
+        super().__init__(cmds)
+        self.script = script
+
+    # copies and pickles are plain lists, not tied to the script.
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+# every list method that modifies the list clears the cached values of the script first.
+def _invalidating(method):
+    def wrapper(self, *args, **kwargs):
+        self.script.invalidate()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'clear', 'reverse', 'sort'):
+    setattr(ScriptCommands, _name, _invalidating(getattr(list, _name)))
+
+# marks a cached value that hasn't been computed, as None is a valid template.
+_NOT_CACHED = object()
+
+
 # the Script object represents the command set that requires evaluation.
+# The serialization and the values derived from it are computed once and kept until cmds changes.
 class Script:
 
     def __init__(self, cmds=None):
@@ -49,54 +195,65 @@ class Script:
         else:
             # each command is either an opcode to be executed or an element to be pushed onto the stack.
             self.cmds = cmds
+        # indexes of cmds where each script starts when this is a combination of scripts (see __add__).
+        self.boundaries = ()
+
+    @property
+    def cmds(self):
+        return self._cmds
+
+    @cmds.setter
+    def cmds(self, cmds):
+        self._cmds = ScriptCommands(cmds, self)
+        self.invalidate()
+
+    # only the commands and the serialization are pickled, to send scripts to other processes.
+    def __getstate__(self):
+        return {'cmds': list(self._cmds), 'raw': self._raw}
+
+    def __setstate__(self, state):
+        self.cmds = state['cmds']
+        self._raw = state['raw']
+        self.boundaries = ()
+
+    # Drops the cached serialization and hashes. Called whenever cmds changes.
+    def invalidate(self):
+        self._raw = None
+        self._hash160 = None
+        self._sha256 = None
+        self._template = _NOT_CACHED
 
     # takes a bytes stream and returns a Script object.
     @classmethod
     def parse(cls, s):
         # script serialization always starts with the length of the script.
         length = read_varint(s)
-        cmds = []
-        count = 0
-        # parse until whole script has been parsed.
-        while count < length:
-            # this byte's value determines if we have an opcode or an element.
-            current = s.read(1)
-            count += 1
-            # this converts the current byte into an int.
-            current_byte_as_int = current[0]
-            print('curr byte', current_byte_as_int)
-            # for a number between 1 and 75, we know the next n bytes are an element.
-            if current_byte_as_int >= 1 and current_byte_as_int <= 75:
-                n = current_byte_as_int
-                # push the element into the stack.
-                cmds.append(s.read(n))
-                # update the count.
-                count += n
-            # 76 is OP_PUSHDATA1, so the next byte tells us how many bytes the next element is.
-            elif current_byte_as_int == 76:
-                # n is the number of bytes to read
-                n = little_endian_to_int(s.read(1))
-                # push the element into the stack.
-                cmds.append(s.read(n))
-                # update the count.
-                count += n + 1
-            # 77 is OP_PUSHDATA2, so the next 2 bytes tell us how many bytes the next element is.
-            elif current_byte_as_int == 77:
-                n = little_endian_to_int(s.read(2))
-                cmds.append(s.read(n))
-                count += n + 2
-            # else we push the opcode onto the stack
-            else:
-                op_code = current_byte_as_int
-                cmds.append(op_code)
-        # script should have consumed exactly the number of bytes expected. If not we raise an error.
-        print("count, length", count, length)
-        if count != length:
+        raw = s.read(length)
+        # script should have exactly the number of bytes expected. If not we raise an error.
+        if len(raw) != length:
             raise SyntaxError('Parsing script failed.')
-        return cls(cmds)
+        script = cls(parse_script_cmds(raw))
+        # the original bytes are kept, so serializing gives them back exactly.
+        script._raw = raw
+        return script
+
+    # takes a script serialization without the length prefix, like a RedeemScript or a WitnessScript,
+    # and returns a Script object. The same scripts are spent over and over, so parsing is cached.
+    @classmethod
+    def parse_raw(cls, raw):
+        raw = bytes(raw)
+        script = cls(cached_script_cmds(raw))
+        script._raw = raw
+        return script
 
     # returns the serialization of the Script object.
     def raw_serialize(self):
+        if self._raw is None:
+            self._raw = self._encode()
+        return self._raw
+
+    # encodes the commands.
+    def _encode(self):
         result = b''
         for cmd in self.cmds:
             # if it's an integer, we know it's an opcode because of the parse method.
@@ -114,11 +271,15 @@ class Script:
                 elif length > 75 and length < 256:
                     result += int_to_little_endian(76, 1)
                     result += int_to_little_endian(length, 1)
-                # for any element with length between 256 and 520, we put a OP_PUSHDATA2 first,
+                # for any element with length between 256 and 65535, we put a OP_PUSHDATA2 first,
                 # then encode the length as 2 bytes, followed by the element.
-                elif length >= 256 and length <= 520:
+                elif length >= 256 and length < 0x10000:
                     result += int_to_little_endian(77, 1)
                     result += int_to_little_endian(length, 2)
+                # longer elements use OP_PUSHDATA4 and 4 bytes for the length.
+                elif length < 0x100000000:
+                    result += int_to_little_endian(78, 1)
+                    result += int_to_little_endian(length, 4)
                 else:
                     raise ValueError('cmd is too long.')
                 # we encode the cmd
@@ -131,100 +292,125 @@ class Script:
         length = len(result)
         return encode_varint(length) + result
 
+    # hash160 of the serialization (without length), what p2sh ScriptPubKeys commit to.
+    def hash160(self):
+        if self._hash160 is None:
+            self._hash160 = hash160(self.raw_serialize())
+        return self._hash160
+
+    # sha256 of the serialization (without length), what p2wsh ScriptPubKeys commit to.
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = sha256(self.raw_serialize())
+        return self._sha256
+
     # to evaluate a script, we need to combine the ScriptPubKey (lockbox) and ScriptSig fields (unlocking password).
     # to evaluate the 2 together, we take the commands from the ScriptSig and ScriptPubKey and combine them.
+    # Where the second script starts is remembered, since the opcode limit applies to each script.
     def __add__(self, other):
-        return Script(self.cmds + other.cmds)
+        script = Script(self.cmds + other.cmds)
+        offset = len(self.cmds)
+        script.boundaries = self.boundaries + (offset,) + tuple(offset + b for b in other.boundaries)
+        return script
 
     # z is the signature (scriptsig)
-    def evaluate(self, z, witness, version=None, locktime=None, sequence=None):
-        # get a copy of the commands array.
-        cmds = self.cmds.copy()
-        stack = []
-        altstack = []
-        # execute until commands array is empty.
-        while len(cmds) > 0:
-            cmd = cmds.pop(0)
-            print("cmd", cmd)
-            # if command is an opcode.
+    # The commands are executed by moving an instruction pointer (ip) over an immutable tuple of commands.
+    # IF/NOTIF/ELSE/ENDIF don't copy or splice commands, they jump using a precomputed jump table.
+    # budget is an ExecutionBudget enforcing the consensus limits. Pass one to read the reason of a failure
+    # (budget.error) or the resources used (budget.metrics()) afterwards.
+    # Like Bitcoin Core, every opcode counts towards the opcode limit, including those in branches that aren't
+    # executed, and the count starts over with each script: ScriptSig, ScriptPubKey, RedeemScript, WitnessScript.
+    def evaluate(self, z, witness, version=None, locktime=None, sequence=None, budget=None):
+        ctx = ExecutionContext(z, locktime, sequence, version, budget)
+        budget = ctx.budget
+        ctx.cmds = tuple(self.cmds)
+        ctx.jumps = conditional_jumps(ctx.cmds, self.boundaries)
+        if ctx.jumps is None:
+            LOGGER.info('unbalanced conditional')
+            return False
+        # index where the next of the combined scripts starts, -1 once there are no more.
+        boundaries = list(self.boundaries)
+        boundary = boundaries.pop(0) if boundaries else -1
+        stack = ctx.stack
+        # execute until the instruction pointer gets to the end of the commands.
+        while ctx.ip < len(ctx.cmds):
+            if ctx.ip == boundary:
+                budget.new_script()
+                boundary = boundaries.pop(0) if boundaries else -1
+            cmd = ctx.cmds[ctx.ip]
+            ctx.ip += 1
+            # if command is an opcode, its function is looked up in STACK_OP_TABLE, which takes just the stack,
+            # and otherwise in OP_CODE_TABLE, which takes the execution context. Flow control opcodes
+            # move ctx.ip using the jump table.
             if type(cmd) == int:
-                # get the function that executes the opcode from the OP_CODE_FUNCTIONS array.
-                operation = OP_CODE_FUNCTIONS[cmd]
-                # 99 and 100 are OP_IF and OP_NOTIF. They require manipulations of the cmds array based on
-                # the top element of the stack.
-                if cmd in (99, 100):
-                    # if executing the opcode returns False (fails)
-                    if not operation(stack, cmds):
-                        LOGGER.info(f"bad op: {OP_CODE_NAMES[cmd]}")
-                        return False
-                # 107 and 108 are OP_TOALTSTACK and OP_FROMALTSTACK respectively. They move stack elements
-                # to an alternate stack (altstack)
-                elif cmd in (107, 108):
-                    # if executing the opcode returns False (fails)
-                    if not operation(stack, altstack):
-                        LOGGER.info(f"bad op: {OP_CODE_NAMES[cmd]}")
-                        return False
-                # 172, 173, 174 and 175 are OP_CHECKSIG, OP_CHECKSIGVERIFY, OP_CHECKMULTISIG and OP_CHECKMULTISIGVERIFY
-                # all require the signature hash z for validation.
-                elif cmd in (172, 173, 174, 175):
-                    # if executing the opcode returns False (fails)
-                    if not operation(stack, z):
-                        LOGGER.info(f"bad op: {OP_CODE_NAMES[cmd]}")
-                        return False
-                # 177 is OP_CHECKLOCKTIMEVERIFY. Requires locktime and sequence.
-                elif cmd == 177:
-                    # if executing the opcode returns False (fails)
-                    if not operation(stack, locktime, sequence):
-                        LOGGER.info(f"bad op: {OP_CODE_NAMES[cmd]}")
-                        return False
-                # 177 is OP_CHECKSEQUENCEVERIFY. Requires sequence and version.
-                elif cmd == 178:
-                    # if executing the opcode returns False (fails)
-                    if not operation(stack, version, sequence):
-                        LOGGER.info(f"bad op: {OP_CODE_NAMES[cmd]}")
-                        return False
-                else:
-                    # if executing the opcode returns False (fails)
-                    if not operation(stack):
-                        LOGGER.info(f"bad op: {OP_CODE_NAMES[cmd]}")
-                        return False
+                if not budget.count_op(cmd, stack):
+                    LOGGER.info(budget.error)
+                    return False
+                operation = STACK_OP_TABLE[cmd]
+                # if executing the opcode returns False (fails)
+                if not (operation(stack) if operation is not None else OP_CODE_TABLE[cmd](ctx)):
+                    if budget.error is None:
+                        budget.error = f"bad op: {OP_CODE_NAMES.get(cmd, cmd)} at {ctx.ip - 1}"
+                    LOGGER.info(budget.error)
+                    return False
+                if not budget.check_stack(stack, ctx.altstack):
+                    LOGGER.info(budget.error)
+                    return False
             # if cmd is not an opcode, it's an element. We push it to the stack.
             else:
+                if not budget.push(cmd):
+                    LOGGER.info(budget.error)
+                    return False
                 stack.append(cmd)
+                if not budget.check_stack(stack, ctx.altstack):
+                    LOGGER.info(budget.error)
+                    return False
+                # commands added by the witness special rules go after the remaining ones.
+                extension = None
                 # We check if the commands follow the p2wsh special rule.
                 if len(stack) == 2 and stack[0] == b'' and len(stack[1]) == 32:
                     # The top element is the sha256 hash of the WitnessScript.
                     s256 = stack.pop()
                     # The second element is the witness version.
                     stack.pop()
-                    # Everything but the WitnessScript is added to the command set.
-                    cmds.extend(witness[:-1])
                     witness_script = witness[-1]
                     s256_calculated = sha256(witness_script)
                     if s256 != s256_calculated:
-                        print(
+                        LOGGER.info(
                             f"Bad sha256 {s256.hex()} vs. {s256_calculated.hex()}")
                         return False
-                    stream = BytesIO(encode_varint(
-                        len(witness_script)) + witness_script)
-                    witness_script_cmds = Script.parse(stream).cmds
-                    cmds.extend(witness_script_cmds)
+                    witness_script_cmds = cached_script_cmds(witness_script)
+                    # Everything but the WitnessScript is added to the command set, followed by the WitnessScript.
+                    extension = tuple(witness[:-1]) + tuple(witness_script_cmds)
                 # We check if the commands follow the p2wpkh special rule - page 235.
                 if len(stack) == 2 and stack[0] == b'' and len(stack[1]) == 20:
                     h160 = stack.pop()
                     stack.pop()
-                    cmds.extend(witness)
-                    cmds.extend(p2pkh_script(h160).cmds)
+                    extension = tuple(witness) + tuple(p2pkh_script(h160).cmds)
+                # the remaining commands and the extension become the new command tuple. This happens at most
+                # a couple of times per evaluation, so the copy keeps evaluation linear.
+                if extension is not None:
+                    ctx.cmds = ctx.cmds[ctx.ip:] + extension
+                    ctx.ip = 0
+                    boundary = -1
+                    budget.new_script()
+                    ctx.jumps = conditional_jumps(ctx.cmds)
+                    if ctx.jumps is None:
+                        LOGGER.info('unbalanced conditional')
+                        return False
                 # we check if next commands form the pattern that executes the special p2sh rule - page 152 and 156.
                 # if that is the case, the last cmd appended would be the RedeemScript, which is an element.
                 # That's why we check for the next 3 commands only.
                 # Specifically, we check that they are: OP_HASH160 (0xa9), a hash element and OP_EQUAL(0x87).
-                if len(cmds) == 3 and cmds[0] == 0xa9 and type(cmds[1]) == bytes and len(cmds[1]) == 20 and cmds[2] == 0x87:
-                    # we run the sequence manually.
-                    cmds.pop()
+                cmds, ip = ctx.cmds, ctx.ip
+                if len(cmds) - ip == 3 and cmds[ip] == 0xa9 and type(cmds[ip + 1]) == bytes and len(cmds[ip + 1]) == 20 and cmds[ip + 2] == 0x87:
                     # the only value we need to save is the hash, the other two we know are OP_HASH160 and OP_EQUAL.
-                    h160 = cmds.pop()
-                    cmds.pop()
+                    h160 = cmds[ip + 1]
+                    # we run the sequence manually, so we skip the 3 commands. OP_HASH160 and OP_EQUAL still count.
+                    if not budget.skip_ops(cmds, ip, ip + 3):
+                        LOGGER.info(budget.error)
+                        return False
+                    ctx.ip += 3
                     # first we perform the op_hash160 on the current stack, which hashes the top element of the stack.
                     if not op_hash160(stack):
                         return False
@@ -238,14 +424,15 @@ class Script:
                         LOGGER.info('bad p2sh h160')
                         return False
                     # if we got to this point, we know cmd is the RedeemScrtipt.
-                    # to be able to parse it, we need to prepend its length.
-                    redeem_script = encode_varint(len(cmd)) + cmd
-                    # we convert the script into a stream of bytes.
-                    stream = BytesIO(redeem_script)
-                    # we get the parsed script
-                    parsed_script = Script.parse(stream)
-                    # we extend the commands set with the commands from the parsed RedeemScript.
-                    cmds.extend(parsed_script.cmds)
+                    # the commands from the parsed RedeemScript are all that's left to execute.
+                    ctx.cmds = cached_script_cmds(cmd)
+                    ctx.ip = 0
+                    boundary = -1
+                    budget.new_script()
+                    ctx.jumps = conditional_jumps(ctx.cmds)
+                    if ctx.jumps is None:
+                        LOGGER.info('unbalanced conditional')
+                        return False
         # if stack is empty after running all the commands, we fail the script returning False.
         if len(stack) == 0:
             return False
@@ -280,11 +467,63 @@ class Script:
     def is_p2pk_script_pubkey(self):
         return len(self.cmds) == 2 and type(self.cmds[0]) == bytes and self.cmds[1] == 172
 
+    # Returns (m, list of sec pubkeys) if this is a bare m-of-n multisig script:
+    # OP_m, <n sec pubkeys>, OP_n, OP_CHECKMULTISIG (0xae). Returns None otherwise.
+    def multisig_keys(self):
+        cmds = self.cmds
+        if len(cmds) < 4 or cmds[-1] != 0xae:
+            return None
+        m, n = cmds[0], cmds[-2]
+        # OP_1 to OP_16 are 0x51 to 0x60.
+        if type(m) != int or type(n) != int or not 0x51 <= m <= n <= 0x60:
+            return None
+        pubkeys = cmds[1:-2]
+        if len(pubkeys) != n - 0x50 or any(type(sec) != bytes for sec in pubkeys):
+            return None
+        return m - 0x50, list(pubkeys)
+
+    # Counts the signature operations in this script without executing it, same as Bitcoin Core's GetSigOpCount.
+    # OP_CHECKSIG(VERIFY) counts 1 and OP_CHECKMULTISIG(VERIFY) counts 20, or, if accurate is True and it follows
+    # OP_1 to OP_16, the number of keys. Accurate counting is used for RedeemScripts and WitnessScripts.
+    def sigop_count(self, accurate=False):
+        count = 0
+        previous = None
+        for cmd in self.cmds:
+            if cmd in (172, 173):
+                count += 1
+            elif cmd in (174, 175):
+                if accurate and type(previous) == int and 0x51 <= previous <= 0x60:
+                    count += previous - 0x50
+                else:
+                    count += MAX_PUBKEYS_PER_MULTISIG
+            previous = cmd
+        return count
+
+    # Classifies this ScriptPubKey into one of the standard templates, so callers can decide once how to
+    # verify the inputs that spend it. Returns None for non-standard scripts.
+    def template(self):
+        if self._template is _NOT_CACHED:
+            self._template = self._classify()
+        return self._template
+
+    def _classify(self):
+        if self.is_p2pkh_script_pubkey():
+            return 'p2pkh'
+        if self.is_p2sh_script_pubkey():
+            return 'p2sh'
+        if self.is_p2wpkh_script_pubkey():
+            return 'p2wpkh'
+        if self.is_p2wsh_script_pubkey():
+            return 'p2wsh'
+        if self.is_p2pk_script_pubkey():
+            return 'p2pk'
+        if self.multisig_keys() is not None:
+            return 'multisig'
+        return None
+
     # Returns the address corresponding to the script
     def address(self, testnet=False):
-        print('address', self.cmds)
         if self.is_p2pkh_script_pubkey():  # p2pkh
-            print('p2pkh')
             # hash160 is the 3rd cmd
             h160 = self.cmds[2]
             # convert to p2pkh address using h160_to_p2pkh_address (remember testnet)
@@ -297,15 +536,157 @@ class Script:
         elif self.is_p2wpkh_script_pubkey():
             witver = self.cmds[0]
             script = self.cmds[1]
-            print('bech32 addr', script_to_bech32(script, witver, testnet))
             return script_to_bech32(script, witver, testnet)
         elif self.is_p2wsh_script_pubkey():
             witver = self.cmds[0]
             script = self.cmds[1]
-            print('bech32 addr', script_to_bech32(script, witver, testnet))
             return script_to_bech32(script, witver, testnet)
         elif self.is_p2pk_script_pubkey():
             return 'P2PK'
         elif self.cmds[0] == 106:
             return 'OP_RETURN'
         raise ValueError('Unknown ScriptPubKey')
+
+
+class ScriptTest(TestCase):
+
+    def test_evaluate_p2pk(self):
+        z = 0x7c076ff316692a3d7eb3c3bb0f8b1488cf72e1afcd929e29307032997a838a3d
+        sec = bytes.fromhex('04887387e452b8eacc4acfde10d9aaf7f6d9a0f975aabb10d006e4da568744d06c61de6d95231cd89026e286df3b6ae4a894a3378e393e93a0f45b666329a0ae34')
+        sig = bytes.fromhex('3045022000eff69ef2b1bd93a66ed5219add4fb51e11a840f404876325a1e8ffe0529a2c022100c7207fee197d27c618aea621406f6bf5ef6fca38681d82b2f06fddbdce6feab601')
+        script_pubkey = Script([sec, 0xac])
+        script_sig = Script([sig])
+        self.assertTrue((script_sig + script_pubkey).evaluate(z, None))
+        self.assertFalse((script_sig + script_pubkey).evaluate(z + 1, None))
+
+    def test_evaluate_conditionals(self):
+        # OP_IF OP_2 OP_ELSE OP_3 OP_ENDIF OP_2 OP_EQUAL
+        branch = [0x63, 0x52, 0x67, 0x53, 0x68, 0x52, 0x87]
+        self.assertTrue(Script([0x51] + branch).evaluate(0, None))
+        self.assertFalse(Script([0x00] + branch).evaluate(0, None))
+        # OP_NOTIF takes the other branch.
+        self.assertTrue(Script([0x00, 0x64] + branch[1:]).evaluate(0, None))
+        # nested conditionals: OP_1 OP_IF OP_0 OP_IF OP_5 OP_ELSE OP_6 OP_ENDIF OP_ELSE OP_7 OP_ENDIF OP_6 OP_EQUAL
+        nested = [0x51, 0x63, 0x00, 0x63, 0x55, 0x67, 0x56, 0x68, 0x67, 0x57, 0x68, 0x56, 0x87]
+        self.assertTrue(Script(nested).evaluate(0, None))
+        # an IF without its ENDIF, or an ENDIF without its IF, fails.
+        self.assertFalse(Script([0x51, 0x63, 0x51]).evaluate(0, None))
+        self.assertFalse(Script([0x51, 0x51, 0x68]).evaluate(0, None))
+
+    def test_evaluate_locktime(self):
+        # <100> OP_CHECKLOCKTIMEVERIFY OP_DROP OP_1 fails without a transaction's locktime and sequence.
+        script = Script([encode_num(100), 0xb1, 0x75, 0x51])
+        self.assertFalse(script.evaluate(0, None))
+        self.assertTrue(script.evaluate(0, None, locktime=100, sequence=0))
+        # <10> OP_CHECKSEQUENCEVERIFY OP_DROP OP_1 needs the version too.
+        script = Script([encode_num(10), 0xb2, 0x75, 0x51])
+        self.assertFalse(script.evaluate(0, None, sequence=10))
+        self.assertTrue(script.evaluate(0, None, version=2, sequence=10))
+
+    def test_evaluate_many_branches(self):
+        # OP_1 OP_IF OP_1 OP_ELSE OP_0 OP_ENDIF OP_VERIFY, many times over. Runs in linear time.
+        cmds = [0x51] + [0x51, 0x63, 0x51, 0x67, 0x00, 0x68, 0x69] * 20000
+        self.assertTrue(Script(cmds).evaluate(0, None, budget=ExecutionBudget(max_ops=len(cmds))))
+        self.assertEqual(conditional_jumps(cmds[:8]), {2: (4, 6), 4: 6})
+        # with the consensus limits it stops at the 202nd opcode.
+        budget = ExecutionBudget()
+        self.assertFalse(Script(cmds).evaluate(0, None, budget=budget))
+        self.assertEqual(budget.error, 'more than 201 opcodes')
+        self.assertEqual(budget.metrics()['ops'], 202)
+
+    def test_evaluate_op_count(self):
+        # opcodes in a branch that isn't executed count too.
+        budget = ExecutionBudget()
+        self.assertFalse(Script([b'\x00', 99] + [97] * 300 + [104, 81]).evaluate(0, None, budget=budget))
+        self.assertEqual(budget.error, 'more than 201 opcodes')
+        self.assertTrue(Script([b'\x00', 99] + [97] * 199 + [104, 81]).evaluate(0, None))
+        self.assertFalse(Script([b'\x00', 99] + [97] * 200 + [104, 81]).evaluate(0, None))
+        # the limit applies to the ScriptSig and the ScriptPubKey separately.
+        self.assertFalse(Script([97] * 300 + [81]).evaluate(0, None))
+        budget = ExecutionBudget()
+        self.assertTrue((Script([97] * 150) + Script([97] * 150 + [81])).evaluate(0, None, budget=budget))
+        self.assertEqual(budget.metrics()['ops'], 300)
+        # and a conditional can't start in one and end in the other.
+        self.assertFalse((Script([0x51, 0x63]) + Script([0x68, 0x51])).evaluate(0, None))
+
+    def test_parse(self):
+        element = b'\xab' * 300
+        # OP_DUP, a direct push, OP_PUSHDATA1, OP_PUSHDATA2 and OP_PUSHDATA4 pushes.
+        raw = (b'\x76' + b'\x02ab' + b'\x4c\x03abc' + b'\x4d\x2c\x01' + element
+               + b'\x4e\x04\x00\x00\x00abcd')
+        cmds = (0x76, b'ab', b'abc', element, b'abcd')
+        self.assertEqual(parse_script_cmds(raw), cmds)
+        self.assertEqual(Script.parse(BytesIO(encode_varint(len(raw)) + raw)).cmds, list(cmds))
+        # it can parse part of a buffer without copying it first.
+        self.assertEqual(parse_script_cmds(memoryview(b'xx' + raw + b'yy'), 2, 2 + len(raw)), cmds)
+        for truncated in (raw[:-1], b'\x4c', b'\x4e\x04\x00'):
+            with self.assertRaises(SyntaxError):
+                parse_script_cmds(truncated)
+        with self.assertRaises(SyntaxError):
+            Script.parse(BytesIO(b'\x05\x76'))
+        # RedeemScripts and WitnessScripts are parsed once.
+        witness_script = Script([0x51, element, 0x75])
+        raw = witness_script.raw_serialize()
+        hits = cached_script_cmds.cache_info().hits
+        self.assertEqual(Script.parse_raw(raw).cmds, witness_script.cmds)
+        self.assertEqual(Script.parse_raw(raw).cmds, witness_script.cmds)
+        self.assertEqual(cached_script_cmds.cache_info().hits, hits + 1)
+
+    def test_cached_serialization(self):
+        h160 = bytes(range(20))
+        script = p2pkh_script(h160)
+        raw = script.raw_serialize()
+        self.assertIs(script.raw_serialize(), raw)
+        self.assertEqual(script.template(), 'p2pkh')
+        self.assertEqual(script.hash160(), hash160(raw))
+        # any change to the commands drops the cached values.
+        script.cmds[2] = bytes(20)
+        self.assertEqual(script.raw_serialize(), p2pkh_script(bytes(20)).raw_serialize())
+        script.cmds.pop()
+        self.assertIsNone(script.template())
+        self.assertEqual(script.hash160(), hash160(script.raw_serialize()))
+        script.cmds = [0x00, h160]
+        self.assertEqual(script.template(), 'p2wpkh')
+        self.assertEqual(script.sha256(), sha256(b'\x00\x14' + h160))
+        # parsed scripts keep their original bytes, even if the pushes are not minimal.
+        raw = b'\x4c\x02ab\x87'
+        script = Script.parse(BytesIO(encode_varint(len(raw)) + raw))
+        self.assertEqual(script.cmds, [b'ab', 0x87])
+        self.assertEqual(script.raw_serialize(), raw)
+        script.cmds.append(0x69)
+        self.assertEqual(script.raw_serialize(), b'\x02ab\x87\x69')
+
+    def test_sigop_count(self):
+        sec = bytes.fromhex('022626e955ea6ea6d98850c994f9107b036b1334f18ca8830bfff1295d21cfdb70')
+        # 2-of-3 multisig followed by OP_CHECKSIGVERIFY.
+        script = Script([0x52, sec, sec, sec, 0x53, 0xae, sec, 0xad])
+        self.assertEqual(script.sigop_count(), 21)
+        self.assertEqual(script.sigop_count(accurate=True), 4)
+        self.assertEqual(p2pkh_script(b'\x00' * 20).sigop_count(), 1)
+
+    def test_evaluate_limits(self):
+        # an element over 520 bytes can't be pushed.
+        budget = ExecutionBudget()
+        self.assertFalse(Script([b'\x01' * 521, 0x75, 0x51]).evaluate(0, None, budget=budget))
+        self.assertIn('element limit', budget.error)
+        self.assertTrue(Script([b'\x01' * 520, 0x75, 0x51]).evaluate(0, None))
+        # pushing the 1001st element fails.
+        budget = ExecutionBudget()
+        self.assertFalse(Script([b'\x01'] * 1001).evaluate(0, None, budget=budget))
+        self.assertIn('stack size 1001', budget.error)
+        self.assertEqual(budget.max_stack_depth, 1001)
+        self.assertTrue(Script([b'\x01'] * 1000).evaluate(0, None))
+        # moving elements to the altstack doesn't help.
+        budget = ExecutionBudget()
+        script = Script([b'\x01'] * 500 + [0x6b] * 100 + [b'\x01'] * 501)
+        self.assertFalse(script.evaluate(0, None, budget=budget))
+        self.assertIn('stack size 1001', budget.error)
+        # sigops are counted, multisig ones by the number of keys.
+        budget = ExecutionBudget(max_sigops=2)
+        self.assertFalse(Script([0x00, 0x00, 0x00, 0x00, 0x53, 0xae]).evaluate(0, None, budget=budget))
+        self.assertEqual(budget.error, 'more than 2 sigops')
+        # failing opcodes are reported with their position.
+        budget = ExecutionBudget()
+        self.assertFalse(Script([0x51, 0x00, 0x69]).evaluate(0, None, budget=budget))
+        self.assertEqual(budget.error, 'bad op: OP_VERIFY at 2')
+        self.assertEqual(budget.metrics(), {'ops': 1, 'sigops': 0, 'bytes_pushed': 0, 'max_stack_depth': 2})
@@ -1,13 +1,18 @@
 from io import BytesIO
 from unittest import TestCase
-from script import Script, p2pkh_script
+from unittest.mock import patch
+from urllib.parse import urlsplit
+from script import Script, p2pkh_script, p2wsh_script
 
+import asyncio
 import json
 import requests
+import time
 
 from helper import (
     hash256,
     hash160,
+    sha256,
     int_to_little_endian,
     little_endian_to_int,
     read_varint,
@@ -17,6 +22,14 @@ from helper import (
 
 from ecc import (PrivateKey)
 
+from op import (
+    ExecutionBudget,
+    decode_num,
+    encode_num,
+    op_checkmultisig,
+    op_checksig,
+)
+
 # class to be able to access the UTXO set end look up individual transactions and be able to get input amounts.
 
 
@@ -57,6 +70,146 @@ class TxFetcher:
         for k, raw_hex in disk_cache.items():
             cls.cache[k] = Tx.parse(BytesIO(bytes.fromhex(raw_hex)))
 
+# asyncio version of TxFetcher, used when many transactions have to be fetched at once.
+# Requests for a tx id that is already being fetched are coalesced into the same HTTP request,
+# connections are kept alive and reused, and at most max_connections requests run at the same time.
+class AsyncTxFetcher:
+
+    def __init__(self, testnet=False, url=None, max_connections=8, cache=None):
+        self.testnet = testnet
+        if url is None:
+            url = TxFetcher.get_url(testnet)
+        parsed_url = urlsplit(url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port or 80
+        self.max_connections = max_connections
+        # by default we share the cache with TxFetcher so both fetchers know about the same transactions.
+        if cache is None:
+            cache = TxFetcher.cache
+        self.cache = cache
+        # idle keep-alive connections as (reader, writer) pairs.
+        self._pool = []
+        # tx id -> task that is fetching it, so concurrent callers share a single request.
+        self._in_flight = {}
+        # created lazily so it belongs to the event loop that runs the requests.
+        self._semaphore = None
+        # number of HTTP requests sent, useful to know how many requests were coalesced.
+        self.request_count = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    # fetches a single transaction, reusing an in-flight request for the same tx id if there is one.
+    async def fetch(self, tx_id, fresh=False):
+        if not fresh and tx_id in self.cache:
+            self.cache[tx_id].testnet = self.testnet
+            return self.cache[tx_id]
+        task = self._in_flight.get(tx_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(tx_id))
+            self._in_flight[tx_id] = task
+            task.add_done_callback(
+                lambda _: self._in_flight.pop(tx_id, None))
+        # shield the shared task so a cancelled caller doesn't cancel it for everybody else.
+        return await asyncio.shield(task)
+
+    # fetches all the given transactions concurrently and returns them in the same order.
+    # Repeated tx ids only cost one request.
+    async def fetch_many(self, tx_ids, fresh=False):
+        return await asyncio.gather(*[self.fetch(tx_id, fresh) for tx_id in tx_ids])
+
+    # closes every idle connection in the pool.
+    async def close(self):
+        while self._pool:
+            _, writer = self._pool.pop()
+            writer.close()
+            await writer.wait_closed()
+
+    async def _fetch(self, tx_id):
+        body = await self._get('/tx/{}.hex'.format(tx_id))
+        try:
+            raw = bytes.fromhex(body.decode('ascii').strip())
+        except ValueError:
+            raise ValueError('unexpected response: {}'.format(body))
+        tx = Tx.parse(BytesIO(raw), testnet=self.testnet)
+        # make sure the tx we got matches to the hash we requested
+        if tx.id() != tx_id:
+            raise RuntimeError(
+                'server lied: {} vs {}'.format(tx.id(), tx_id))
+        self.cache[tx_id] = tx
+        return tx
+
+    # sends a GET request over a pooled connection and returns the response body.
+    async def _get(self, path):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        async with self._semaphore:
+            reused = len(self._pool) > 0
+            if reused:
+                reader, writer = self._pool.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                status, body, keep_alive = await self._request(reader, writer, path)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # the server may have closed an idle connection, so we retry once on a new one.
+                if not reused:
+                    raise
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                status, body, keep_alive = await self._request(reader, writer, path)
+            if keep_alive:
+                self._pool.append((reader, writer))
+            else:
+                writer.close()
+        if status != 200:
+            raise ValueError('unexpected response: {} {}'.format(status, body))
+        return body
+
+    # minimal HTTP/1.1 exchange: sends the request and reads the status, headers and body.
+    # Returns the status code, the body and whether the connection can be reused.
+    async def _request(self, reader, writer, path):
+        self.request_count += 1
+        request = 'GET {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n'.format(
+            path, self.host)
+        writer.write(request.encode('ascii'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by server')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip().lower()
+        keep_alive = status_line.startswith(
+            b'HTTP/1.1') and headers.get('connection') != 'close'
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # skip the (usually empty) trailer.
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            # without a length the body ends when the server closes the connection.
+            body = await reader.read()
+            keep_alive = False
+        return status, body, keep_alive
+
+
 # class that represents a Bitcoin transaction - page 88
 
 
@@ -75,6 +228,17 @@ class Tx:
         self._hash_prevouts = None
         self._hash_sequence = None
         self._hash_outputs = None
+        # validation cost estimates, computed on first use. Code that changes the inputs, the outputs or their
+        # scripts directly has to call invalidate() afterwards.
+        self.invalidate()
+
+    # Drops the cached sizes and sigop counts, so they are computed again for the transaction as it is now.
+    def invalidate(self):
+        self._size = None
+        self._base_size = None
+        self._legacy_sigops = None
+        self._p2sh_sigops = None
+        self._witness_sigops = None
 
     def __repr__(self):
         tx_inputs = ''
@@ -90,7 +254,13 @@ class Tx:
         return self.hash().hex()
 
     # binary hash of the legacy serialization in little endian.
+    # The witness is not part of the txid, so segwit transactions are hashed without it.
     def hash(self):
+        return hash256(self.serialize_legacy())[::-1]
+
+    # binary hash of the full serialization, witness included, in little endian. It's the same as hash()
+    # for legacy transactions.
+    def wtxid(self):
         return hash256(self.serialize())[::-1]
 
     # method that defines which parse method to use: segwit or legacy - page 231.
@@ -109,7 +279,6 @@ class Tx:
     # receives a stream of bytes and returns a Tx object
     @classmethod
     def parse_legacy(cls, stream, testnet=False):
-        print("Normal")
         # s.read(n) will return n bytes
         # version has 4 bytes, little-endian, interpret as int
         version = little_endian_to_int(stream.read(4))
@@ -135,7 +304,6 @@ class Tx:
     # Parser when tx is segwit.
     @classmethod
     def parse_segwit(cls, s, testnet=False):
-        print("Segwit")
         version = little_endian_to_int(s.read(4))
         # Marker and flag are 2 bytes after version - page 232.
         marker_and_flag = s.read(2)
@@ -222,20 +390,22 @@ class Tx:
         return result
 
     # returns the implied fee of the transaction in satoshis.
-    def fee(self):
+    # utxo_set is an optional UtxoSet (see utxo.py) to value the inputs without fetching the previous transactions.
+    def fee(self, utxo_set=None):
         total_input = 0
         # loop over the inputs summing their values.
         for tx_input in self.tx_inputs:
-            total_input += tx_input.value(self.testnet)
+            total_input += tx_input.value(self.testnet, utxo_set)
         total_output = 0
         # loop over the outputs summing their values.
         for tx_output in self.tx_outputs:
-            total_output += tx_output.amount()
+            total_output += tx_output.amount
         # fee equals total inputs - total outputs
         return total_input - total_output
 
     # Returns the hash of the signature (z) for this transaction.
-    def sig_hash(self, input_index, redeeem_script=None):
+    # utxo_set is an optional UtxoSet (see utxo.py) to find the output being spent, like in fee.
+    def sig_hash(self, input_index, redeeem_script=None, utxo_set=None):
         # we need to manually start serializing the tx.
         result = int_to_little_endian(self.version, 4)
         # add number of inputs.
@@ -249,7 +419,7 @@ class Tx:
                     script_sig = redeeem_script
                 else:
                     # if this is the input I want to find the hash for, script_sig is prev_tx's scriptpubkey
-                    script_sig = tx_in.script_pubkey(self.testnet)
+                    script_sig = tx_in.script_pubkey(self.testnet, utxo_set)
             else:
                 # if it's not the input we're looking for, script_sig is left empty.
                 script_sig = None
@@ -270,9 +440,10 @@ class Tx:
         # convert the result to an integer using int.from_bytes(x, 'big')
         return int.from_bytes(h256, 'big')
 
-    def sig_hash_bip143(self, input_index, redeem_script=None, witness_script=None):
+    def sig_hash_bip143(self, input_index, redeem_script=None, witness_script=None, utxo_set=None):
         '''Returns the integer representation of the hash that needs to get
-        signed for index input_index'''
+        signed for index input_index. utxo_set is an optional UtxoSet to find
+        the output being spent'''
         tx_in = self.tx_inputs[input_index]
         # per BIP143 spec
         s = int_to_little_endian(self.version, 4)
@@ -284,15 +455,97 @@ class Tx:
             script_code = p2pkh_script(redeem_script.cmds[1]).serialize()
         else:
             script_code = p2pkh_script(tx_in.script_pubkey(
-                self.testnet).cmds[1]).serialize()
+                self.testnet, utxo_set).cmds[1]).serialize()
         s += script_code
-        s += int_to_little_endian(tx_in.value(), 8)
+        s += int_to_little_endian(tx_in.value(self.testnet, utxo_set), 8)
         s += int_to_little_endian(tx_in.sequence, 4)
         s += self.hash_outputs()
         s += int_to_little_endian(self.locktime, 4)
         s += int_to_little_endian(SIGHASH_ALL, 4)
         return int.from_bytes(hash256(s), 'big')
 
+    # Size in bytes of the serialized transaction, including the witness.
+    # It's cached: call invalidate() after changing the transaction directly.
+    def size(self):
+        if self._size is None:
+            self._size = len(self.serialize())
+        return self._size
+
+    # Weight as defined in BIP141: the size without the witness counts 4 times, the witness once.
+    # It's cached: call invalidate() after changing the transaction directly.
+    def weight(self):
+        if self._base_size is None:
+            self._base_size = len(self.serialize_legacy())
+        return self._base_size * 3 + self.size()
+
+    # Virtual size: weight / 4 rounded up. Comes from the cached weight, see invalidate().
+    def vsize(self):
+        return (self.weight() + 3) // 4
+
+    # Signature operations in the ScriptSigs and ScriptPubKeys, counted without the number of keys of multisigs.
+    # It's cached: call invalidate() after changing the transaction directly.
+    def legacy_sigops(self):
+        if self._legacy_sigops is None:
+            count = 0
+            for tx_in in self.tx_inputs:
+                if tx_in.script_sig is not None:
+                    count += tx_in.script_sig.sigop_count()
+            for tx_out in self.tx_outputs:
+                count += tx_out.script_pubkey.sigop_count()
+            self._legacy_sigops = count
+        return self._legacy_sigops
+
+    # Signature operations in the RedeemScripts of the p2sh inputs. Looks up the outputs being spent, in utxo_set
+    # if given. It's cached: call invalidate() after changing the transaction directly.
+    def p2sh_sigops(self, utxo_set=None):
+        if self._p2sh_sigops is None:
+            count = 0
+            if not self.is_coinbase():
+                for tx_in in self.tx_inputs:
+                    if tx_in.script_pubkey(self.testnet, utxo_set).is_p2sh_script_pubkey():
+                        redeem_script = self._redeem_script(tx_in)
+                        if redeem_script is not None:
+                            count += redeem_script.sigop_count(accurate=True)
+            self._p2sh_sigops = count
+        return self._p2sh_sigops
+
+    # Signature operations of the witness programs: 1 per p2wpkh input, and the ones in the WitnessScript of
+    # p2wsh inputs. Nested (p2sh) witness programs are taken from the RedeemScript.
+    # It's cached: call invalidate() after changing the transaction directly.
+    def witness_sigops(self, utxo_set=None):
+        if self._witness_sigops is None:
+            count = 0
+            if not self.is_coinbase():
+                for tx_in in self.tx_inputs:
+                    program = tx_in.script_pubkey(self.testnet, utxo_set)
+                    if program.is_p2sh_script_pubkey():
+                        program = self._redeem_script(tx_in)
+                        if program is None:
+                            continue
+                    if program.is_p2wpkh_script_pubkey():
+                        count += 1
+                    elif program.is_p2wsh_script_pubkey() and len(tx_in.witness) > 0:
+                        count += Script.parse_raw(tx_in.witness[-1]).sigop_count(accurate=True)
+            self._witness_sigops = count
+        return self._witness_sigops
+
+    # Total signature operations cost as in BIP141: legacy and p2sh sigops weigh 4, witness ones 1.
+    # Comes from the cached counts, see invalidate().
+    def sigop_cost(self, utxo_set=None):
+        if self.is_coinbase():
+            return self.legacy_sigops() * 4
+        return (self.legacy_sigops() + self.p2sh_sigops(utxo_set)) * 4 + self.witness_sigops(utxo_set)
+
+    # The RedeemScript is the last element of the ScriptSig. Returns None if there isn't one.
+    @staticmethod
+    def _redeem_script(tx_in):
+        if tx_in.script_sig is None or len(tx_in.script_sig.cmds) == 0:
+            return None
+        cmd = tx_in.script_sig.cmds[-1]
+        if type(cmd) != bytes:
+            return None
+        return Script.parse_raw(cmd)
+
     # Method necessary for calculating z per BIP143 spec - method used in sig_hash_bip143()
     def hash_prevouts(self):
         if self._hash_prevouts is None:
@@ -321,73 +574,150 @@ class Tx:
             self._hash_outputs = hash256(all_outputs)
         return self._hash_outputs
 
+    # Verifies inputs that spend the most common templates directly: the hash check and the signature check,
+    # without going through the script interpreter. Handles p2pkh, p2wpkh, p2sh-p2wpkh and p2wsh multisig.
+    # Returns True or False, or None if the input doesn't have one of those shapes and has to be evaluated.
+    # utxo_set is an optional UtxoSet to find the outputs being spent, needed by the signature hash.
+    def verify_standard_input(self, input_index, script_pubkey, utxo_set=None):
+        tx_in = self.tx_inputs[input_index]
+        template = script_pubkey.template()
+        script_sig = tx_in.script_sig.cmds if tx_in.script_sig is not None else []
+        witness = tx_in.witness
+        if template == 'p2pkh':
+            if len(script_sig) != 2 or type(script_sig[0]) != bytes or type(script_sig[1]) != bytes:
+                return None
+            sig, sec = script_sig
+            # a 32 or 20 byte element after an empty one would trigger the witness rules in the interpreter.
+            if len(sec) not in (33, 65):
+                return None
+            if hash160(sec) != script_pubkey.cmds[2]:
+                return False
+            return self._check_sig(sig, sec, self.sig_hash(input_index, utxo_set=utxo_set))
+        if template == 'p2wpkh' and len(script_sig) == 0:
+            return self._verify_p2wpkh(input_index, script_pubkey, witness, utxo_set=utxo_set)
+        if template == 'p2sh' and len(script_sig) == 1 and type(script_sig[0]) == bytes:
+            redeem = script_sig[0]
+            # the RedeemScript has to be OP_0 <20-byte hash>, serialized as 0x00 0x14 <hash>.
+            if len(redeem) != 22 or redeem[:2] != b'\x00\x14':
+                return None
+            if hash160(redeem) != script_pubkey.cmds[1]:
+                return False
+            return self._verify_p2wpkh(input_index, Script([0x00, redeem[2:]]), witness, nested=True,
+                                       utxo_set=utxo_set)
+        if template == 'p2wsh' and len(script_sig) == 0 and len(witness) > 0 and type(witness[-1]) == bytes:
+            witness_script_raw = witness[-1]
+            if sha256(witness_script_raw) != script_pubkey.cmds[1]:
+                return False
+            witness_script = Script.parse_raw(witness_script_raw)
+            multisig = witness_script.multisig_keys()
+            if multisig is None:
+                return None
+            m, pubkeys = multisig
+            # dummy element, m signatures and the WitnessScript.
+            if len(witness) != m + 2 or any(type(sig) != bytes for sig in witness[1:-1]):
+                return None
+            z = self.sig_hash_bip143(input_index, witness_script=witness_script, utxo_set=utxo_set)
+            dummy = witness[0] if type(witness[0]) == bytes else encode_num(witness[0])
+            stack = [dummy] + witness[1:-1] + \
+                [encode_num(m)] + pubkeys + [encode_num(len(pubkeys))]
+            if not op_checkmultisig(stack, z):
+                return False
+            return decode_num(stack.pop()) != 0
+        return None
+
+    def _verify_p2wpkh(self, input_index, script_pubkey, witness, nested=False, utxo_set=None):
+        if len(witness) != 2 or type(witness[0]) != bytes or type(witness[1]) != bytes:
+            return None
+        sig, sec = witness
+        if hash160(sec) != script_pubkey.cmds[1]:
+            return False
+        if nested:
+            z = self.sig_hash_bip143(input_index, redeem_script=script_pubkey, utxo_set=utxo_set)
+        else:
+            z = self.sig_hash_bip143(input_index, utxo_set=utxo_set)
+        return self._check_sig(sig, sec, z)
+
+    # Runs OP_CHECKSIG on a signature and a sec pubkey. Returns whether the signature is valid.
+    @staticmethod
+    def _check_sig(sig, sec, z):
+        stack = [sig, sec]
+        if not op_checksig(stack, z):
+            return False
+        return decode_num(stack.pop()) != 0
+
     # Returns whether the input at the given index (in self.tx_inputs array) has a valid signature.
-    def verify_input(self, input_index):
+    # If budget (an ExecutionBudget) is given, the script interpreter is always used and the budget
+    # has the resources used and the reason of a failure afterwards. utxo_set is an optional UtxoSet to find
+    # the output being spent without fetching the previous transaction.
+    def verify_input(self, input_index, budget=None, utxo_set=None):
         # get the wanted input.
         tx_in = self.tx_inputs[input_index]
+        script_pubkey = tx_in.script_pubkey(self.testnet, utxo_set)
+        # standard inputs are verified directly, everything else goes through the script interpreter.
+        if budget is None:
+            result = self.verify_standard_input(input_index, script_pubkey, utxo_set)
+            if result is not None:
+                return result
         # check whether it's a p2sh input.
-        if tx_in.script_pubkey(self.testnet).is_p2sh_script_pubkey():
+        if script_pubkey.is_p2sh_script_pubkey():
             # If it is, we know the last cmd of the ScriptSig is the RedeemScript - page 151
             cmd = tx_in.script_sig.cmds[-1]
             # Now we parse it.
-            # Parse the redeem script.
-            raw_redeem = int_to_little_endian(len(cmd), 1) + cmd
-            redeem_script = Script.parse(BytesIO(raw_redeem))
+            redeem_script = Script.parse_raw(cmd)
             # If the RedeemScript follows the p2wpkh special rule, which means the script is OP_0 followed by <20-byte hash>
             # This if handles the p2sh-p2wpkh case, as it's inside the p2sh if.
             if redeem_script.is_p2wpkh_script_pubkey():
                 # The segwit transaction signature hash calculation is specified in BIP0143 - page 233.
-                z = self.sig_hash_bip143(input_index, redeem_script)
+                z = self.sig_hash_bip143(input_index, redeem_script, utxo_set=utxo_set)
                 witness = tx_in.witness
             # This elif takes care of p2sh-p2wsh.
             elif redeem_script.is_p2wsh_script_pubkey():
-                command = tx_in.witness[-1]
-                raw_witness = encode_varint(len(command)) + command
-                witness_script = Script.parse(BytesIO(raw_witness))
+                witness_script = Script.parse_raw(tx_in.witness[-1])
                 z = self.sig_hash_bip143(
-                    input_index, witness_script=witness_script)
+                    input_index, witness_script=witness_script, utxo_set=utxo_set)
                 witness = tx_in.witness
             else:
-                z = self.sig_hash(input_index, redeem_script)
+                z = self.sig_hash(input_index, redeem_script, utxo_set)
                 witness = None
         else:
             # This if handles the p2wpkh case.
-            if tx_in.script_pubkey(self.testnet).is_p2wpkh_script_pubkey():
-                z = self.sig_hash_bip143(input_index)
+            if script_pubkey.is_p2wpkh_script_pubkey():
+                z = self.sig_hash_bip143(input_index, utxo_set=utxo_set)
                 witness = tx_in.witness
             # This elif handles the p2wsh case.
-            elif tx_in.script_pubkey(self.testnet).is_p2wsh_script_pubkey():
-                command = tx_in.witness[-1]
-                raw_witness = encode_varint(len(command)) + command
-                witness_script = Script.parse(BytesIO(raw_witness))
+            elif script_pubkey.is_p2wsh_script_pubkey():
+                witness_script = Script.parse_raw(tx_in.witness[-1])
                 z = self.sig_hash_bip143(
-                    input_index, witness_script=witness_script)
+                    input_index, witness_script=witness_script, utxo_set=utxo_set)
                 witness = tx_in.witness
             else:
                 # compute the signature hash for input.
-                z = self.sig_hash(input_index)
+                z = self.sig_hash(input_index, utxo_set=utxo_set)
                 witness = None
-        # combine scripts.
-        combined_script = tx_in.script_sig + tx_in.script_pubkey(self.testnet)
+        # combine scripts. A missing ScriptSig is the same as an empty one.
+        script_sig = tx_in.script_sig if tx_in.script_sig is not None else Script()
+        combined_script = script_sig + script_pubkey
         # evaluate them.
-        return combined_script.evaluate(z, witness=witness)
+        return combined_script.evaluate(z, witness=witness, version=self.version,
+                                        locktime=self.locktime, sequence=tx_in.sequence, budget=budget)
 
     # Returns whether this transaction is valid. page 135.
-    def verify(self):
+    # With utxo_set, an optional UtxoSet, the outputs being spent are looked up there instead of fetched.
+    def verify(self, utxo_set=None):
         # if tx is creating new bitcoins return False.
-        if self.fee() < 0:
+        if self.fee(utxo_set) < 0:
             return False
         for i in range(len(self.tx_inputs)):
             # check if every input has the correct scriptsig.
-            if not self.verify_input(i):
+            if not self.verify_input(i, utxo_set=utxo_set):
                 return False
         return True
 
     # Generates the scriptsig for the input at the given index (in self.tx_inputs array) - page 141.
     # Returns True if the scriptsig was generated correctly, False otherwise.
-    def sign_input(self, input_index, private_key):
+    def sign_input(self, input_index, private_key, utxo_set=None):
         # calculate z for the given input.
-        z = self.sig_hash(input_index)
+        z = self.sig_hash(input_index, utxo_set=utxo_set)
         # create a signature object for the private key and z.
         sig_obj = private_key.sign(z)
         # get the DER signature from the signature object.
@@ -398,10 +728,11 @@ class Tx:
         sec = private_key.point.sec()
         # create the scriptsig, which is comprised of the sec pubkey and the signature.
         script_sig = Script([sig, sec])
-        # add the ScriptSig to the given input.
+        # add the ScriptSig to the given input. It changes the size of the transaction.
         self.tx_inputs[input_index].script_sig = script_sig
+        self.invalidate()
         # verify the input was signed correctly.
-        return self.verify_input(input_index)
+        return self.verify_input(input_index, utxo_set=utxo_set)
 
     # returns whether the transaction is a coinbase transaction - page 164.
     def is_coinbase(self):
@@ -429,6 +760,10 @@ class TxIn:
         self.prev_index = prev_index
         self.script_sig = script_sig
         self.sequence = sequence
+        # witness items, only used by segwit transactions.
+        self.witness = []
+        # the output being spent, when it's already known (validate_block resolves them in bulk).
+        self.prevout = None
 
    # receives a bytes stream, returns a TxIn object
     @classmethod
@@ -438,7 +773,6 @@ class TxIn:
         # prev_index is 4 bytes, little endian, interpreted as integer.
         prev_index = little_endian_to_int(stream.read(4))
         script_sig = Script.parse(stream)
-        print('ss', script_sig.serialize().hex())
         # sequence is 4 bytes, little endian, interpreted as integer.
         sequence = little_endian_to_int(stream.read(4))
         # returns an object of the same class.
@@ -463,23 +797,34 @@ class TxIn:
     def fetch_tx(self, testnet=False):
         return TxFetcher.fetch(self.prev_tx.hex(), testnet=testnet)
 
-    # returns the value of this tx input.
-    def value(self, testnet=False):
+    # returns the output this input spends: prevout if it's already known, otherwise the output in utxo_set,
+    # an optional UtxoSet (see utxo.py), and without one the output of the previous transaction, fetched.
+    def prev_output(self, testnet=False, utxo_set=None):
+        if self.prevout is not None:
+            return self.prevout
+        if utxo_set is not None:
+            coin = utxo_set.get(self.prev_tx, self.prev_index)
+            # with a UTXO set, a missing output means it's spent or never existed, so we don't go to the network.
+            if coin is None:
+                raise KeyError('output {}:{} is not in the UTXO set'.format(
+                    self.prev_tx.hex(), self.prev_index))
+            return coin
         # we fetch the previous transaction
         tx = self.fetch_tx(testnet=testnet)
-        # we return the amount of the tx output at the given index = this tx's spendable amount.
-        return tx.tx_outputs[self.prev_index].amount
+        # the output at the given index is the one this input spends.
+        return tx.tx_outputs[self.prev_index]
+
+    # returns the value of this tx input.
+    def value(self, testnet=False, utxo_set=None):
+        # we return the amount of the output being spent = this tx's spendable amount.
+        return self.prev_output(testnet, utxo_set).amount
 
     # Returns the ScriptPubKey for the output that this inputs is trying to spend.
-    def script_pubkey(self, testnet=False):
-        '''Get the ScriptPubKey by looking up the tx hash
+    def script_pubkey(self, testnet=False, utxo_set=None):
+        '''Get the ScriptPubKey of the output being spent
         Returns a Script object
         '''
-        # use self.fetch_tx to get the transaction
-        tx = self.fetch_tx(testnet=testnet)
-        # get the output at self.prev_index
-        # return the script_pubkey property
-        return tx.tx_outputs[self.prev_index].script_pubkey
+        return self.prev_output(testnet, utxo_set).script_pubkey
 
 # class that represents a transaction output
 
@@ -570,3 +915,231 @@ class TxTest(TestCase):
         stream = BytesIO(raw_tx)
         tx = Tx.parse(stream)
         self.assertEqual(tx.fee(), 140500)
+
+    def test_cost(self):
+        # legacy p2sh 2-of-2 multisig: the RedeemScript's sigops count 4 times.
+        tx = TxFetcher.fetch(
+            '46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b')
+        self.assertEqual((tx.size(), tx.weight(), tx.vsize()), (404, 1616, 404))
+        self.assertEqual((tx.legacy_sigops(), tx.p2sh_sigops(), tx.witness_sigops()), (3, 2, 0))
+        self.assertEqual(tx.sigop_cost(), 20)
+        # p2sh-p2wpkh: the witness is discounted.
+        tx = TxFetcher.fetch(
+            'c586389e5e4b3acb9d6c8be1c19ae8ab2795397633176f5a6442a261bbdefc3a')
+        self.assertEqual((tx.size(), tx.weight(), tx.vsize()), (216, 534, 134))
+        self.assertEqual((tx.legacy_sigops(), tx.p2sh_sigops(), tx.witness_sigops()), (0, 0, 1))
+        self.assertEqual(tx.sigop_cost(), 1)
+        # results are cached, so they don't look up the previous outputs again.
+        with patch.object(TxIn, 'script_pubkey', side_effect=AssertionError):
+            self.assertEqual(tx.sigop_cost(), 1)
+        # p2wsh: sigops come from the WitnessScript.
+        tx = TxFetcher.fetch(
+            '78457666f82c28aa37b74b506745a7c7684dc7842a52a457b09f09446721e11c', testnet=True)
+        self.assertEqual(tx.witness_sigops(), 1)
+        # signing changes the size, so it drops the cached values.
+        private_key = PrivateKey(8675309)
+        tx_in = TxIn(hash256(b'funding'), 0)
+        tx_in.prevout = TxOut(100000, p2pkh_script(private_key.point.hash160()))
+        tx = Tx(1, [tx_in], [TxOut(90000, p2pkh_script(private_key.point.hash160()))], 0)
+        unsigned_vsize = tx.vsize()
+        self.assertTrue(tx.sign_input(0, private_key))
+        self.assertGreater(tx.vsize(), unsigned_vsize)
+        self.assertEqual(tx.vsize(), len(tx.serialize()))
+        # changing an output directly keeps the cached values until invalidate() is called.
+        signed_vsize = tx.vsize()
+        tx.tx_outputs[0].script_pubkey = Script([0x6a])
+        self.assertEqual(tx.vsize(), signed_vsize)
+        tx.invalidate()
+        self.assertEqual(tx.vsize(), signed_vsize - 24)
+        self.assertEqual(tx.vsize(), len(tx.serialize()))
+
+    def test_verify_p2pkh(self):
+        tx = TxFetcher.fetch(
+            '452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03')
+        self.assertTrue(tx.verify())
+        tx = TxFetcher.fetch(
+            '5418099cc755cb9dd3ebc6cf1a7888ad53a1a3beb5a025bce89eb1bf7f1650a2', testnet=True)
+        self.assertTrue(tx.verify())
+
+    def test_verify_p2sh(self):
+        tx = TxFetcher.fetch(
+            '46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b')
+        self.assertTrue(tx.verify())
+        # the interpreter reports what the 2-of-2 RedeemScript used.
+        budget = ExecutionBudget()
+        self.assertTrue(tx.verify_input(0, budget))
+        self.assertEqual(budget.sigop_count, 2)
+        self.assertIsNone(budget.error)
+
+    def test_verify_p2wpkh(self):
+        tx = TxFetcher.fetch(
+            'd869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c', testnet=True)
+        self.assertTrue(tx.verify())
+
+    def test_verify_p2sh_p2wpkh(self):
+        tx = TxFetcher.fetch(
+            'c586389e5e4b3acb9d6c8be1c19ae8ab2795397633176f5a6442a261bbdefc3a')
+        self.assertTrue(tx.verify())
+
+    def test_verify_p2wsh(self):
+        tx = TxFetcher.fetch(
+            '78457666f82c28aa37b74b506745a7c7684dc7842a52a457b09f09446721e11c', testnet=True)
+        self.assertTrue(tx.verify())
+
+    def test_verify_p2sh_p2wsh(self):
+        tx = TxFetcher.fetch(
+            '954f43dbb30ad8024981c07d1f5eb6c9fd461e2cf1760dd1283f052af746fc88', testnet=True)
+        self.assertTrue(tx.verify())
+
+    def test_verify_standard_input(self):
+        # these inputs are verified without running the script interpreter.
+        standard = [
+            ('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03', False),
+            ('d869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c', True),
+            ('c586389e5e4b3acb9d6c8be1c19ae8ab2795397633176f5a6442a261bbdefc3a', False),
+        ]
+        for tx_id, testnet in standard:
+            tx = TxFetcher.fetch(tx_id, testnet=testnet)
+            for i, tx_in in enumerate(tx.tx_inputs):
+                script_pubkey = tx_in.script_pubkey(testnet)
+                self.assertTrue(tx.verify_standard_input(i, script_pubkey))
+        # p2sh multisig and p2wsh with a WitnessScript that isn't multisig go through the interpreter.
+        tx = TxFetcher.fetch(
+            '46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b')
+        self.assertIsNone(tx.verify_standard_input(
+            0, tx.tx_inputs[0].script_pubkey()))
+        tx = TxFetcher.fetch(
+            '78457666f82c28aa37b74b506745a7c7684dc7842a52a457b09f09446721e11c', testnet=True)
+        self.assertIsNone(tx.verify_standard_input(
+            0, tx.tx_inputs[0].script_pubkey(True)))
+        # a different sighash makes the signature check fail.
+        tx = TxFetcher.fetch(
+            '452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03')
+        # the fetcher caches the tx, so it's restored for the other tests.
+        tx.locktime += 1
+        try:
+            self.assertFalse(tx.verify_standard_input(
+                0, tx.tx_inputs[0].script_pubkey()))
+        finally:
+            tx.locktime -= 1
+
+    def test_verify_p2wsh_multisig(self):
+        private_keys = [PrivateKey(secret) for secret in (1001, 1002, 1003)]
+        # 2-of-3 WitnessScript.
+        witness_script = Script(
+            [0x52] + [k.point.sec() for k in private_keys] + [0x53, 0xae])
+        script_pubkey = p2wsh_script(sha256(witness_script.raw_serialize()))
+        tx_in = TxIn(hash256(b'funding'), 0)
+        tx_in.prevout = TxOut(100000, script_pubkey)
+        tx = Tx(1, [tx_in], [TxOut(90000, script_pubkey)], 0, segwit=True)
+        z = tx.sig_hash_bip143(0, witness_script=witness_script)
+        sigs = [k.sign(z).der() + SIGHASH_ALL.to_bytes(1, 'big')
+                for k in private_keys[:2]]
+        tx_in.witness = [b''] + sigs + [witness_script.raw_serialize()]
+        self.assertTrue(tx.verify_standard_input(0, script_pubkey))
+        self.assertTrue(tx.verify_input(0))
+        # the generic interpreter agrees.
+        with patch.object(Tx, 'verify_standard_input', return_value=None):
+            self.assertTrue(tx.verify_input(0))
+        # signatures must be in the order of the public keys.
+        tx_in.witness = [b''] + sigs[::-1] + [witness_script.raw_serialize()]
+        self.assertFalse(tx.verify_standard_input(0, script_pubkey))
+        with patch.object(Tx, 'verify_standard_input', return_value=None):
+            self.assertFalse(tx.verify_input(0))
+        tx_in.witness = [b''] + sigs + [witness_script.raw_serialize()]
+        tx_in.witness[1] = sigs[0][:-2] + b'\x00\x01'
+        self.assertFalse(tx.verify_standard_input(0, script_pubkey))
+
+
+class AsyncTxFetcherTest(TestCase):
+    cache_file = './tx.cache'
+    tx_ids = [
+        'd1c789a9c60383bf715f3f6ad9d14b91fe55f3deb369fe5d9280cb1a01793f81',
+        '45f3f79066d251addc04fd889f776c73afab1cb22559376ff820e6166c5e3ad6',
+        '452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03',
+    ]
+
+    # Stand-in for the tx server that serves the transactions in tx.cache, so AsyncTxFetcher can be tested offline.
+    # http.server and threading are only used by these tests, so they are imported here.
+    @staticmethod
+    def handler_class():
+        from http.server import BaseHTTPRequestHandler
+
+        class TxCacheRequestHandler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server = self.server
+                with server.lock:
+                    server.requests[self.path] = server.requests.get(self.path, 0) + 1
+                    server.connections.add(self.client_address)
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                # give other requests the chance to overlap with this one.
+                time.sleep(0.05)
+                tx_id = self.path[len('/tx/'):-len('.hex')]
+                raw_hex = server.txs.get(tx_id)
+                with server.lock:
+                    server.active -= 1
+                if raw_hex is None:
+                    self.send_response(404)
+                    body = b'not found'
+                else:
+                    self.send_response(200)
+                    body = raw_hex.encode('ascii')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return TxCacheRequestHandler
+
+    def setUp(self):
+        from http.server import ThreadingHTTPServer
+        from threading import Lock, Thread
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), self.handler_class())
+        self.server.txs = json.loads(open(self.cache_file, 'r').read())
+        self.server.lock = Lock()
+        self.server.requests = {}
+        self.server.connections = set()
+        self.server.active = 0
+        self.server.max_active = 0
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch_many(self, *tx_id_lists, max_connections=2):
+        async def run():
+            async with AsyncTxFetcher(url=self.url, max_connections=max_connections, cache={}) as fetcher:
+                return await asyncio.gather(*[fetcher.fetch_many(tx_ids) for tx_ids in tx_id_lists])
+        return asyncio.run(run())
+
+    def test_fetch_many(self):
+        tx_ids = [self.tx_ids[0], self.tx_ids[1],
+                  self.tx_ids[0], self.tx_ids[2]]
+        txs = self.fetch_many(tx_ids)[0]
+        self.assertEqual([tx.id() for tx in txs], tx_ids)
+        self.assertIs(txs[0], txs[2])
+
+    def test_coalescing(self):
+        self.fetch_many(self.tx_ids, self.tx_ids[::-1], self.tx_ids[:1])
+        for tx_id in self.tx_ids:
+            self.assertEqual(self.server.requests['/tx/{}.hex'.format(tx_id)], 1)
+
+    def test_concurrency_limit(self):
+        self.fetch_many(self.tx_ids, max_connections=2)
+        self.assertLessEqual(self.server.max_active, 2)
+        # three requests over at most two keep-alive connections.
+        self.assertLessEqual(len(self.server.connections), 2)
+
+    def test_not_found(self):
+        with self.assertRaises(ValueError):
+            self.fetch_many(['00' * 32])
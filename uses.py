@@ -8,6 +8,7 @@ from block import Block, GENESIS_BLOCK, LOWEST_BITS
 from helper import calculate_new_bits, decode_base58
 from bloomfilter import BloomFilter
 from merkleblock import MerkleBlock
+from addressindex import AddressIndex
 import time
 
 """
@@ -125,6 +126,12 @@ How to connect to a node and ask for some headers.
 #         previous = header
 #         # Increase block height.
 #         count += 1
+#
+# # The same checks, including testnet's difficulty rules, are done by HeaderChain (see retarget.py), and
+# # HeaderSync downloads all the headers into it.
+# with HeaderChain('headers.dat') as chain:
+#     HeaderSync(chain, [node]).sync()
+#     print(chain.height, chain.tip_hash().hex(), chain.chainwork())
 
 """
 Getting Transactions of Interest from a full node - page 218.
@@ -136,6 +143,8 @@ Getting Transactions of Interest from a full node - page 218.
 # address = 'mqdZtV16UixrjvkW5eQfpMiyspZYEoJSxV'
 # # Takes an address and returns the hash it came from.
 # h160 = decode_base58(address)
+# # Outputs paying to the address are found by their ScriptPubKey, without encoding addresses.
+# watched = AddressIndex([address])
 # node = SimpleNode('testnet.programmingbitcoin.com',
 #                   testnet=True, logging=False)
 # # We are creating a bloom filter that's 30 bytes and uses 5 hash functions and 90210 as its tweak.
@@ -176,7 +185,7 @@ Getting Transactions of Interest from a full node - page 218.
 #     else:
 #         for i, tx_out in enumerate(message.tx_outputs):
 #             # We're looking for the output that points to our address.
-#             if tx_out.script_pubkey.address(testnet=True) == address:
+#             if watched.match(tx_out.script_pubkey) is not None:
 #                 # We found our utxo, set prev_tx, prev_index and prev_amount.
 #                 prev_tx = message.hash()
 #                 prev_index = i
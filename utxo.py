@@ -0,0 +1,314 @@
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import patch
+
+from ecc import PrivateKey, S256Point
+from helper import (
+    encode_varint,
+    hash160,
+    int_to_little_endian,
+    read_varint,
+)
+from script import Script, p2pkh_script, p2sh_script, p2wpkh_script
+
+# special script sizes used by the ScriptPubKey compression, same as Bitcoin Core's ScriptCompressor.
+NUM_SPECIAL_SCRIPTS = 6
+# confirmations a coinbase output needs before it can be spent.
+COINBASE_MATURITY = 100
+
+
+# Compresses an amount in satoshis so round numbers take very few bytes (Bitcoin Core's CompressAmount).
+# Trailing zeros are removed and stored as an exponent, and the last non zero digit is stored in base 9.
+def compress_amount(n):
+    if n == 0:
+        return 0
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n * 9 + d - 1) * 10 + e
+    else:
+        return 1 + (n - 1) * 10 + 9
+
+
+# Opposite of compress_amount.
+def decompress_amount(x):
+    if x == 0:
+        return 0
+    x -= 1
+    e = x % 10
+    x //= 10
+    if e < 9:
+        d = x % 9 + 1
+        x //= 9
+        n = x * 10 + d
+    else:
+        n = x + 1
+    while e:
+        n *= 10
+        e -= 1
+    return n
+
+
+# Compresses a ScriptPubKey. Standard scripts are stored as a 1-byte type followed by a hash or a public key's
+# x coordinate, anything else is stored as a varint of its size plus NUM_SPECIAL_SCRIPTS followed by the script.
+def compress_script(script_pubkey):
+    cmds = script_pubkey.cmds
+    if script_pubkey.is_p2pkh_script_pubkey():
+        return b'\x00' + cmds[2]
+    if script_pubkey.is_p2sh_script_pubkey():
+        return b'\x01' + cmds[1]
+    if script_pubkey.is_p2pk_script_pubkey():
+        sec = cmds[0]
+        if len(sec) == 33 and sec[0] in (2, 3):
+            return sec
+        if len(sec) == 65 and sec[0] == 4:
+            try:
+                point = S256Point.parse(sec)
+            except ValueError:
+                point = None
+            # only valid points can be stored compressed, as we need to be able to recover y.
+            if point is not None:
+                return bytes([4 | (point.y.num & 1)]) + sec[1:33]
+    raw = script_pubkey.raw_serialize()
+    return encode_varint(len(raw) + NUM_SPECIAL_SCRIPTS) + raw
+
+
+# Reads a compressed ScriptPubKey from a stream and returns the Script object.
+def decompress_script(stream):
+    script_type = read_varint(stream)
+    if script_type == 0:
+        return p2pkh_script(stream.read(20))
+    if script_type == 1:
+        return p2sh_script(stream.read(20))
+    if script_type in (2, 3):
+        return Script([bytes([script_type]) + stream.read(32), 0xac])
+    if script_type in (4, 5):
+        point = S256Point.parse(bytes([script_type - 2]) + stream.read(32))
+        return Script([point.sec(compressed=False), 0xac])
+    length = script_type - NUM_SPECIAL_SCRIPTS
+    return Script.parse(BytesIO(encode_varint(length) + stream.read(length)))
+
+
+# An unspent output. It only keeps what is needed to validate the inputs that spend it.
+class Coin:
+
+    def __init__(self, amount, script_pubkey, height, coinbase=False):
+        self.amount = amount
+        self.script_pubkey = script_pubkey
+        # height of the block that created the output.
+        self.height = height
+        # coinbase outputs need COINBASE_MATURITY confirmations before they can be spent (see connect_block).
+        self.coinbase = coinbase
+
+    def __repr__(self):
+        return f"{self.amount}:{self.script_pubkey} at {self.height}"
+
+    # Receives a stream with a packed coin and returns a Coin object.
+    @classmethod
+    def parse(cls, stream):
+        code = read_varint(stream)
+        amount = decompress_amount(read_varint(stream))
+        script_pubkey = decompress_script(stream)
+        return cls(amount, script_pubkey, code >> 1, code & 1 == 1)
+
+    # Returns the packed coin: height and coinbase flag, compressed amount and compressed ScriptPubKey.
+    def serialize(self):
+        result = encode_varint(self.height * 2 + int(self.coinbase))
+        result += encode_varint(compress_amount(self.amount))
+        result += compress_script(self.script_pubkey)
+        return result
+
+
+# The set of unspent transaction outputs, keyed by outpoint (txid, vout).
+# Coins are kept packed in memory and only unpacked when they are looked up.
+class UtxoSet:
+
+    def __init__(self):
+        # outpoint -> packed coin.
+        self.coins = {}
+        # block hash -> coins spent by each transaction of the block, needed to disconnect it.
+        self.undo = {}
+
+    def __len__(self):
+        return len(self.coins)
+
+    def __contains__(self, outpoint):
+        return self.outpoint_key(*outpoint) in self.coins
+
+    # The key of an outpoint is the 32-byte txid followed by the output index as 4 bytes LE.
+    @staticmethod
+    def outpoint_key(prev_tx, prev_index):
+        return prev_tx + int_to_little_endian(prev_index, 4)
+
+    # Adds an output to the set. OP_RETURN outputs can never be spent, so they are not stored.
+    def add(self, prev_tx, prev_index, tx_out, height, coinbase=False):
+        script_pubkey = tx_out.script_pubkey
+        if len(script_pubkey.cmds) > 0 and script_pubkey.cmds[0] == 0x6a:
+            return
+        coin = Coin(tx_out.amount, script_pubkey, height, coinbase)
+        self.coins[self.outpoint_key(prev_tx, prev_index)] = coin.serialize()
+
+    # Returns the Coin for the given outpoint or None if it's not in the set.
+    def get(self, prev_tx, prev_index):
+        packed = self.coins.get(self.outpoint_key(prev_tx, prev_index))
+        if packed is None:
+            return None
+        return Coin.parse(BytesIO(packed))
+
+    # Looks up a list of (txid, vout) outpoints at once. Missing outpoints are returned as None.
+    def get_many(self, outpoints):
+        return [self.get(prev_tx, prev_index) for prev_tx, prev_index in outpoints]
+
+    # Adds the outputs of the block's transactions to the set and removes the outputs they spend.
+    # If any input spends a missing output, or a coinbase output with less than COINBASE_MATURITY confirmations,
+    # a RuntimeError is raised. On any error the set is left as it was.
+    def connect_block(self, block_message, height):
+        block_undo = []
+        try:
+            for tx in block_message.txns:
+                tx_undo = []
+                block_undo.append(tx_undo)
+                if not tx.is_coinbase():
+                    for tx_in in tx.tx_inputs:
+                        key = self.outpoint_key(tx_in.prev_tx, tx_in.prev_index)
+                        packed = self.coins.pop(key, None)
+                        if packed is None:
+                            raise RuntimeError('missing or spent output {}:{}'.format(
+                                tx_in.prev_tx.hex(), tx_in.prev_index))
+                        tx_undo.append((key, packed))
+                        # the packed coin starts with its height times 2 plus the coinbase flag.
+                        code = read_varint(BytesIO(packed))
+                        if code & 1 and height - (code >> 1) < COINBASE_MATURITY:
+                            raise RuntimeError('premature spend of coinbase output {}:{}'.format(
+                                tx_in.prev_tx.hex(), tx_in.prev_index))
+                tx_hash = tx.hash()
+                for i, tx_out in enumerate(tx.tx_outputs):
+                    self.add(tx_hash, i, tx_out, height, tx.is_coinbase())
+        except BaseException:
+            self._undo_txs(block_message.txns[:len(block_undo)], block_undo)
+            raise
+        self.undo[block_message.hash()] = block_undo
+
+    # Reverts connect_block: removes the block's outputs and restores the outputs it spent.
+    def disconnect_block(self, block_message):
+        block_undo = self.undo.pop(block_message.hash(), None)
+        if block_undo is None:
+            raise RuntimeError('block {} is not connected'.format(
+                block_message.hash().hex()))
+        self._undo_txs(block_message.txns, block_undo)
+
+    # Transactions are undone in reverse order so outputs created and spent in the same block disappear.
+    def _undo_txs(self, txns, block_undo):
+        for tx, tx_undo in reversed(list(zip(txns, block_undo))):
+            tx_hash = tx.hash()
+            for i in range(len(tx.tx_outputs)):
+                self.coins.pop(self.outpoint_key(tx_hash, i), None)
+            for key, packed in tx_undo:
+                self.coins[key] = packed
+
+
+class UtxoSetTest(TestCase):
+
+    def test_compress_amount(self):
+        for amount in (0, 1, 10, 546, 50 * 100000000, 123456789, 21000000 * 100000000):
+            self.assertEqual(decompress_amount(
+                compress_amount(amount)), amount)
+        self.assertEqual(compress_amount(50 * 100000000), 0x32)
+
+    def test_compress_script(self):
+        point = PrivateKey(8675309).point
+        h160 = hash160(b'redeem script')
+        scripts = [
+            (p2pkh_script(h160), 21),
+            (p2sh_script(h160), 21),
+            (Script([point.sec(), 0xac]), 33),
+            (Script([point.sec(compressed=False), 0xac]), 33),
+            (p2wpkh_script(h160), 23),
+        ]
+        for script_pubkey, length in scripts:
+            compressed = compress_script(script_pubkey)
+            self.assertEqual(len(compressed), length)
+            decompressed = decompress_script(BytesIO(compressed))
+            self.assertEqual(decompressed.serialize(),
+                             script_pubkey.serialize())
+
+    def test_connect_disconnect(self):
+        from network import BlockMessage
+        from tx import Tx, TxIn, TxOut
+        h160 = hash160(b'owner')
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x01']))],
+                      [TxOut(50 * 100000000, p2pkh_script(h160))], 0)
+        block_1 = BlockMessage(1, b'\x00' * 32, b'\x00' * 32, 0,
+                               b'\xff\xff\x00\x1d', b'\x00' * 4, 1, [coinbase])
+        utxo_set = UtxoSet()
+        utxo_set.connect_block(block_1, 1)
+        self.assertEqual(len(utxo_set), 1)
+        coin = utxo_set.get(coinbase.hash(), 0)
+        self.assertEqual(coin.amount, 50 * 100000000)
+        self.assertEqual(coin.height, 1)
+        self.assertTrue(coin.coinbase)
+        # block 2 spends the coinbase and then, in a second tx, the output created by the first one.
+        tx_1 = Tx(1, [TxIn(coinbase.hash(), 0)],
+                  [TxOut(49 * 100000000, p2pkh_script(h160)), TxOut(0, Script([0x6a, b'data']))], 0)
+        tx_2 = Tx(1, [TxIn(tx_1.hash(), 0)],
+                  [TxOut(48 * 100000000, p2wpkh_script(h160))], 0)
+        coinbase_2 = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x02']))],
+                        [TxOut(50 * 100000000, p2pkh_script(h160))], 0)
+        block_2 = BlockMessage(1, block_1.hash(), b'\x00' * 32, 0,
+                               b'\xff\xff\x00\x1d', b'\x00' * 4, 3, [coinbase_2, tx_1, tx_2])
+        # the coinbase can't be spent until it has 100 confirmations.
+        with self.assertRaisesRegex(RuntimeError, 'premature spend of coinbase'):
+            utxo_set.connect_block(block_2, 100)
+        self.assertEqual(len(utxo_set), 1)
+        utxo_set.connect_block(block_2, 101)
+        self.assertNotIn((coinbase.hash(), 0), utxo_set)
+        self.assertNotIn((tx_1.hash(), 0), utxo_set)
+        self.assertNotIn((tx_1.hash(), 1), utxo_set)
+        self.assertEqual(utxo_set.get(tx_2.hash(), 0).amount, 48 * 100000000)
+        # inputs are valued using the UTXO set instead of fetching the previous transaction.
+        spend = Tx(1, [TxIn(tx_2.hash(), 0)],
+                   [TxOut(47 * 100000000, p2pkh_script(h160))], 0)
+        self.assertEqual(spend.fee(utxo_set), 100000000)
+        self.assertEqual(spend.tx_inputs[0].script_pubkey(utxo_set=utxo_set).serialize(),
+                         p2wpkh_script(h160).serialize())
+        with self.assertRaises(KeyError):
+            Tx(1, [TxIn(tx_1.hash(), 0)], [], 0).fee(utxo_set)
+        utxo_set.disconnect_block(block_2)
+        self.assertEqual(len(utxo_set), 1)
+        self.assertEqual(utxo_set.get(coinbase.hash(), 0).amount, 50 * 100000000)
+        # spending a missing output leaves the set untouched.
+        with self.assertRaises(RuntimeError):
+            utxo_set.connect_block(BlockMessage(1, block_1.hash(), b'\x00' * 32, 0, b'\xff\xff\x00\x1d',
+                                                b'\x00' * 4, 2, [coinbase_2, tx_2]), 101)
+        self.assertEqual(len(utxo_set), 1)
+        # so does any other error, like an output that can't be stored after the coinbase was spent.
+        with patch.object(utxo_set, 'add', side_effect=[None, ValueError('full')]):
+            with self.assertRaises(ValueError):
+                utxo_set.connect_block(BlockMessage(1, block_1.hash(), b'\x00' * 32, 0, b'\xff\xff\x00\x1d',
+                                                    b'\x00' * 4, 2, [coinbase_2, tx_1]), 101)
+        self.assertEqual(len(utxo_set), 1)
+        self.assertEqual(utxo_set.get(coinbase.hash(), 0).amount, 50 * 100000000)
+
+    def test_verify(self):
+        from tx import Tx, TxFetcher, TxIn, TxOut
+        private_key = PrivateKey(8675309)
+        h160 = private_key.point.hash160()
+        utxo_set = UtxoSet()
+        prev_tx = hash160(b'funding')[:16] * 2
+        utxo_set.add(prev_tx, 0, TxOut(100000, p2pkh_script(h160)), 1)
+        utxo_set.add(prev_tx, 1, TxOut(50000, p2wpkh_script(h160)), 1)
+        tx = Tx(1, [TxIn(prev_tx, 0), TxIn(prev_tx, 1)], [TxOut(140000, p2pkh_script(h160))], 0, segwit=True)
+        # signing, fees, sigops and verification use the set, never the network.
+        with patch.object(TxFetcher, 'fetch', side_effect=AssertionError('fetched')):
+            self.assertTrue(tx.sign_input(0, private_key, utxo_set))
+            z = tx.sig_hash_bip143(1, utxo_set=utxo_set)
+            tx.tx_inputs[1].witness = [private_key.sign(z).der() + b'\x01', private_key.point.sec()]
+            self.assertTrue(tx.verify(utxo_set))
+            self.assertEqual(tx.fee(utxo_set), 10000)
+            self.assertEqual(tx.sigop_cost(utxo_set), 4 + 1)
+            tx.tx_outputs[0].amount = 150001
+            self.assertFalse(tx.verify(utxo_set))
@@ -0,0 +1,326 @@
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import patch
+
+from ecc import PrivateKey
+from helper import hash160, merkle_root
+from merkle import txids_merkle_root
+from network import BlockMessage
+from script import Script, p2pkh_script
+from tx import Tx, TxIn, TxOut
+from utxo import COINBASE_MATURITY, UtxoSet
+
+# minimum number of inputs verified by each task sent to the worker pool. Big transactions are split in bigger
+# tasks, one per worker.
+MIN_INPUTS_PER_TASK = 16
+
+
+# Outcome of validate_block. It's truthy only if the block is valid.
+class BlockValidationResult:
+
+    def __init__(self):
+        self.valid = False
+        # stage that failed and why.
+        self.stage = None
+        self.error = None
+        # stage name -> seconds spent in it.
+        self.timings = {}
+
+    def __repr__(self):
+        if self.valid:
+            return 'valid block {}'.format(self.timings)
+        return 'invalid block at {}: {}'.format(self.stage, self.error)
+
+    def __bool__(self):
+        return self.valid
+
+
+# Verifies the scripts of some inputs of a transaction. Runs in the worker pool, so it has to be a module function.
+# raw_tx is the serialized transaction, which pickles much faster than the Tx objects, and prevouts are the outputs
+# spent by the inputs at input_indices. The transaction is parsed again here, so the caller's objects aren't touched.
+# Returns None if all inputs are valid, (input index, reason) for the first one that isn't.
+def verify_inputs(raw_tx, input_indices, prevouts):
+    tx = Tx.parse(BytesIO(raw_tx))
+    for i, prevout in zip(input_indices, prevouts):
+        tx.tx_inputs[i].prevout = prevout
+    for i in input_indices:
+        try:
+            if not tx.verify_input(i):
+                return i, 'script evaluation failed'
+        except Exception as e:
+            return i, repr(e)
+    return None
+
+
+# Validates a whole block: header proof of work, merkle root, block structure, prevouts, amounts and scripts.
+# block_message is a BlockMessage or its raw serialization. prevout_provider is anything with a
+# get_many(outpoints) method, like UtxoSet, that returns the spent outputs (or None) for a list of (txid, vout).
+# height is the height the block would have, used to reject coinbase outputs spent before COINBASE_MATURITY
+# confirmations. Outputs returned by the provider are only known to be coinbase if they have a coinbase attribute, like Coin.
+# Script checks run in executor (a concurrent.futures executor). By default a process pool of max_workers processes
+# is created and shut down by every call, which costs the start of the processes, so a caller validating many blocks
+# should pass its own long-lived executor. The block's objects are left as they were: the spent outputs are kept in
+# a local map, not in the inputs. Validation stops at the first stage that fails, and the result has the time spent in every stage.
+def validate_block(block_message, prevout_provider, height, executor=None, max_workers=None):
+    result = BlockValidationResult()
+    stage = None
+    start = time.perf_counter()
+
+    def next_stage(name):
+        nonlocal stage, start
+        now = time.perf_counter()
+        if stage is not None:
+            result.timings[stage] = now - start
+        stage, start = name, now
+
+    def fail(error):
+        result.stage = stage
+        result.error = error
+        next_stage(None)
+        return result
+
+    next_stage('parse')
+    if isinstance(block_message, (bytes, bytearray)):
+        try:
+            block_message = BlockMessage.parse(BytesIO(block_message))
+        except Exception as e:
+            return fail(repr(e))
+    txns = block_message.txns
+    if len(txns) == 0:
+        return fail('block has no transactions')
+
+    next_stage('header')
+    header = block_message.header()
+    if not header.check_pow():
+        return fail('bad proof of work')
+
+    # txids are computed once and reused by the rest of the stages.
+    next_stage('txids')
+    txids = [tx.hash() for tx in txns]
+
+    next_stage('merkle_root')
+    root, mutated = txids_merkle_root(txids)
+    if root != block_message.merkle_root:
+        return fail('merkle root mismatch')
+    if mutated:
+        return fail('mutated merkle tree')
+
+    next_stage('structure')
+    if not txns[0].is_coinbase():
+        return fail('first transaction is not a coinbase')
+    # position of each transaction in the block, to resolve outputs spent in the same block.
+    tx_positions = {}
+    spent = set()
+    for i, (tx, txid) in enumerate(zip(txns, txids)):
+        if i > 0 and tx.is_coinbase():
+            return fail('coinbase at position {}'.format(i))
+        if txid in tx_positions:
+            return fail('duplicate transaction {}'.format(txid.hex()))
+        tx_positions[txid] = i
+        if i > 0:
+            for tx_in in tx.tx_inputs:
+                outpoint = (tx_in.prev_tx, tx_in.prev_index)
+                if outpoint in spent:
+                    return fail('double spend of {}:{}'.format(
+                        tx_in.prev_tx.hex(), tx_in.prev_index))
+                spent.add(outpoint)
+
+    next_stage('prevouts')
+    # (txid, vout) -> the output it refers to.
+    prevouts = {}
+    missing = []
+    for i, tx in enumerate(txns[1:], 1):
+        for tx_in in tx.tx_inputs:
+            outpoint = (tx_in.prev_tx, tx_in.prev_index)
+            position = tx_positions.get(tx_in.prev_tx)
+            if position is None:
+                missing.append(outpoint)
+            elif position == 0:
+                # the coinbase of this block has no confirmations at all.
+                return fail('premature spend of coinbase {}:{}'.format(tx_in.prev_tx.hex(), tx_in.prev_index))
+            elif position < i and tx_in.prev_index < len(txns[position].tx_outputs):
+                prevouts[outpoint] = txns[position].tx_outputs[tx_in.prev_index]
+            else:
+                return fail('bad in-block spend of {}:{}'.format(
+                    tx_in.prev_tx.hex(), tx_in.prev_index))
+    # everything that isn't created in this block is resolved with a single call.
+    for outpoint, prevout in zip(missing, prevout_provider.get_many(missing)):
+        if prevout is None:
+            return fail('missing prevout {}:{}'.format(outpoint[0].hex(), outpoint[1]))
+        if getattr(prevout, 'coinbase', False) and height - prevout.height < COINBASE_MATURITY:
+            return fail('premature spend of coinbase {}:{}'.format(outpoint[0].hex(), outpoint[1]))
+        prevouts[outpoint] = prevout
+
+    next_stage('amounts')
+    for tx in txns[1:]:
+        total_input = sum(prevouts[(tx_in.prev_tx, tx_in.prev_index)].amount for tx_in in tx.tx_inputs)
+        if total_input < sum(tx_out.amount for tx_out in tx.tx_outputs):
+            return fail('outputs exceed inputs in {}'.format(tx.id()))
+
+    next_stage('scripts')
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    # A transaction's inputs are split in at most one task per worker, so a big transaction is sent to each
+    # worker once instead of once every MIN_INPUTS_PER_TASK inputs.
+    workers = max_workers or os.cpu_count() or 1
+    futures = {}
+    try:
+        for tx in txns[1:]:
+            raw_tx = tx.serialize()
+            tx_prevouts = [prevouts[(tx_in.prev_tx, tx_in.prev_index)] for tx_in in tx.tx_inputs]
+            chunk = max(MIN_INPUTS_PER_TASK, -(-len(tx.tx_inputs) // workers))
+            for first in range(0, len(tx.tx_inputs), chunk):
+                indices = range(first, min(first + chunk, len(tx.tx_inputs)))
+                future = executor.submit(verify_inputs, raw_tx, indices, tx_prevouts[first:first + chunk])
+                futures[future] = tx
+        for future in as_completed(futures):
+            try:
+                failure = future.result()
+            except Exception as e:
+                # the task itself failed, like a worker process that died.
+                failure = None, repr(e)
+            if failure is not None:
+                # stop as soon as any input fails, pending checks are dropped.
+                for pending in futures:
+                    pending.cancel()
+                index, reason = failure
+                if index is None:
+                    return fail('task for {}: {}'.format(futures[future].id(), reason))
+                return fail('input {} of {}: {}'.format(index, futures[future].id(), reason))
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    next_stage(None)
+    result.valid = True
+    return result
+
+
+class ValidateBlockTest(TestCase):
+
+    def setUp(self):
+        self.private_key = PrivateKey(8675309)
+        h160 = self.private_key.point.hash160()
+        # the output funding the block's first transaction lives in the UTXO set.
+        self.utxo_set = UtxoSet()
+        funding_txid = hash160(b'funding')[:16] * 2
+        self.utxo_set.add(funding_txid, 0, TxOut(100000, p2pkh_script(h160)), 1)
+        tx_1 = Tx(1, [TxIn(funding_txid, 0)], [TxOut(90000, p2pkh_script(h160))], 0)
+        tx_1.tx_inputs[0].prevout = self.utxo_set.get(funding_txid, 0)
+        tx_1.sign_input(0, self.private_key)
+        # the second transaction spends the output of the first one in the same block.
+        tx_2 = Tx(1, [TxIn(tx_1.hash(), 0)], [TxOut(80000, p2pkh_script(h160))], 0)
+        tx_2.tx_inputs[0].prevout = tx_1.tx_outputs[0]
+        tx_2.sign_input(0, self.private_key)
+        # validate_block finds the spent outputs by itself.
+        tx_1.tx_inputs[0].prevout = tx_2.tx_inputs[0].prevout = None
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x02']))],
+                      [TxOut(5000000000, p2pkh_script(h160))], 0)
+        self.txns = [coinbase, tx_1, tx_2]
+
+    # builds a block with the lowest possible difficulty and finds a nonce for it.
+    def block(self, txns, root=None):
+        if root is None:
+            root = merkle_root([tx.hash()[::-1] for tx in txns])[::-1]
+        block = BlockMessage(0x20000000, b'\x00' * 32, root, 1231006505,
+                             bytes.fromhex('ffff7f20'), b'\x00' * 4, len(txns), txns)
+        nonce = 0
+        while not block.header().check_pow():
+            nonce += 1
+            block.nonce = nonce.to_bytes(4, 'little')
+        return block
+
+    def test_valid_block(self):
+        block = self.block(self.txns)
+        with ThreadPoolExecutor(2) as executor:
+            result = validate_block(block, self.utxo_set, 2, executor)
+        self.assertTrue(result.valid)
+        self.assertEqual(list(result.timings), [
+            'parse', 'header', 'txids', 'merkle_root', 'structure', 'prevouts', 'amounts', 'scripts'])
+        # the default worker pool runs the script checks in other processes.
+        self.assertTrue(validate_block(block, self.utxo_set, 2))
+        # the spent outputs aren't stored in the block's inputs.
+        self.assertTrue(all(tx_in.prevout is None for tx in self.txns for tx_in in tx.tx_inputs))
+
+    def test_bad_signature(self):
+        script_sig = self.txns[2].tx_inputs[0].script_sig
+        sig = bytearray(script_sig.cmds[0])
+        sig[10] ^= 1
+        script_sig.cmds[0] = bytes(sig)
+        with ThreadPoolExecutor(2) as executor:
+            result = validate_block(self.block(self.txns), self.utxo_set, 2, executor)
+        self.assertFalse(result.valid)
+        self.assertEqual(result.stage, 'scripts')
+        self.assertIn('input 0 of {}'.format(self.txns[2].id()), result.error)
+
+    def test_early_failures(self):
+        block = self.block(self.txns, root=b'\x00' * 32)
+        result = validate_block(block, self.utxo_set, 2)
+        self.assertEqual(result.stage, 'merkle_root')
+        block.nonce = b'\xff' * 4
+        while block.header().check_pow():
+            block.nonce = (int.from_bytes(block.nonce, 'little') - 1).to_bytes(4, 'little')
+        self.assertEqual(validate_block(block, self.utxo_set, 2).stage, 'header')
+        # the last transaction repeated has the same merkle root.
+        result = validate_block(self.block(self.txns + self.txns[-1:], root=self.block(self.txns).merkle_root),
+                                self.utxo_set, 2)
+        self.assertEqual((result.stage, result.error), ('merkle_root', 'mutated merkle tree'))
+        result = validate_block(self.block(self.txns), UtxoSet(), 2)
+        self.assertEqual(result.stage, 'prevouts')
+        self.assertNotIn('scripts', result.timings)
+        result = validate_block(self.block(self.txns[1:]), self.utxo_set, 2)
+        self.assertEqual(result.stage, 'structure')
+
+    def test_coinbase_maturity(self):
+        h160 = self.private_key.point.hash160()
+        # a coinbase of this same block can't be spent.
+        spend = Tx(1, [TxIn(self.txns[0].hash(), 0)], [TxOut(10000, p2pkh_script(h160))], 0)
+        result = validate_block(self.block(self.txns + [spend]), self.utxo_set, 2)
+        self.assertEqual(result.stage, 'prevouts')
+        self.assertIn('premature spend of coinbase', result.error)
+        # a coinbase in the set needs 100 confirmations.
+        coinbase_txid = hash160(b'old coinbase')[:16] * 2
+        self.utxo_set.add(coinbase_txid, 0, TxOut(100000, p2pkh_script(h160)), 1, True)
+        spend = Tx(1, [TxIn(coinbase_txid, 0)], [TxOut(90000, p2pkh_script(h160))], 0)
+        spend.tx_inputs[0].prevout = self.utxo_set.get(coinbase_txid, 0)
+        spend.sign_input(0, self.private_key)
+        spend.tx_inputs[0].prevout = None
+        block = self.block([self.txns[0], spend])
+        result = validate_block(block, self.utxo_set, 100)
+        self.assertEqual(result.stage, 'prevouts')
+        self.assertIn('premature spend of coinbase', result.error)
+        with ThreadPoolExecutor(2) as executor:
+            self.assertTrue(validate_block(block, self.utxo_set, 101, executor))
+
+    def test_task_error(self):
+        with ThreadPoolExecutor(2) as executor, patch('validation.verify_inputs', side_effect=MemoryError):
+            result = validate_block(self.block(self.txns), self.utxo_set, 2, executor)
+        self.assertFalse(result.valid)
+        self.assertEqual(result.stage, 'scripts')
+        self.assertIn('MemoryError', result.error)
+
+    def test_inputs_split_by_worker(self):
+        h160 = self.private_key.point.hash160()
+        funding_txid = hash160(b'many inputs')[:16] * 2
+        for i in range(8):
+            self.utxo_set.add(funding_txid, i, TxOut(1000, p2pkh_script(h160)), 1)
+        tx = Tx(1, [TxIn(funding_txid, i) for i in range(8)], [TxOut(7000, p2pkh_script(h160))], 0)
+        for i, tx_in in enumerate(tx.tx_inputs):
+            tx_in.prevout = self.utxo_set.get(funding_txid, i)
+            tx.sign_input(i, self.private_key)
+        for tx_in in tx.tx_inputs:
+            tx_in.prevout = None
+        block = self.block([self.txns[0], tx])
+        with ThreadPoolExecutor(2) as executor, patch('validation.MIN_INPUTS_PER_TASK', 2):
+            with patch.object(executor, 'submit', wraps=executor.submit) as submit:
+                self.assertTrue(validate_block(block, self.utxo_set, 2, executor, max_workers=2))
+            # 8 inputs are sent in one task of 4 inputs per worker instead of 4 tasks of MIN_INPUTS_PER_TASK.
+            self.assertEqual(submit.call_count, 2)
+            with patch.object(executor, 'submit', wraps=executor.submit) as submit:
+                self.assertTrue(validate_block(block, self.utxo_set, 2, executor, max_workers=1))
+            self.assertEqual(submit.call_count, 1)